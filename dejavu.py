@@ -2,11 +2,17 @@ import argparse
 import json
 import sys
 from argparse import RawTextHelpFormatter
+from contextlib import nullcontext
 from os.path import isdir
 
 from dejavu import Dejavu
+from dejavu.logic.profiler import Profiler
+from dejavu.logic.recognizer.archive_recognizer import ArchiveRecognizer
+from dejavu.logic.recognizer.directory_recognizer import DirectoryRecognizer
 from dejavu.logic.recognizer.file_recognizer import FileRecognizer
 from dejavu.logic.recognizer.microphone_recognizer import MicrophoneRecognizer
+from dejavu.logic.recognizer.stream_recognizer import StreamRecognizer
+from dejavu.logic.server import serve
 
 DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
 
@@ -44,10 +50,40 @@ if __name__ == '__main__':
                              'playing through the microphone or in a file.\n'
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
-                             '--recognize file path/to/file \n')
+                             '--recognize file path/to/file \n'
+                             '--recognize archive path/to/long_file \n'
+                             '--recognize stream path/to/pipe_or_file \n'
+                             '--recognize stream - (16 bits PCM, WAV or raw, from stdin) \n')
+    parser.add_argument('--checkpoint', default=None,
+                        help='With --recognize archive, checkpoint file used to resume the scan.\n'
+                             'Defaults to path/to/long_file.checkpoint.json')
+    parser.add_argument('--follow', action='store_true',
+                        help='With --recognize stream, wait for more data at the end of the file.')
+    parser.add_argument('-d', '--recognize-dir', nargs=2,
+                        help='Recognize every file of a directory, writing one JSON line per file.\n'
+                             'Usage: \n'
+                             '--recognize-dir path/to/directory extension \n')
+    parser.add_argument('--output', default=None,
+                        help='With --recognize-dir, file the JSON lines are written to (stdout by default).')
+    parser.add_argument('-s', '--serve', nargs='?', const='127.0.0.1:8000',
+                        help='Serve recognition requests over HTTP.\n'
+                             'Usage: \n'
+                             '--serve (listens on 127.0.0.1:8000) \n'
+                             '--serve host:port \n')
+    parser.add_argument('--build-bloom', default=None,
+                        help='Build the Bloom filter of the stored hashes and save it, replacing the previous one.\n'
+                             'Run it periodically when songs are deleted by other processes.\n'
+                             'Usage: \n'
+                             '--build-bloom path/to/bloom_filter \n')
+    parser.add_argument('--profile', default=None,
+                        help='Profile the action and write the sampled stacks (flame graph format), the cProfile\n'
+                             'statistics and the time and memory of each stage to a directory.\n'
+                             'Usage: \n'
+                             '--profile path/to/directory \n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if not args.fingerprint and not args.recognize and not args.recognize_dir and not args.serve \
+            and not args.build_bloom:
         parser.print_help()
         sys.exit(0)
 
@@ -56,29 +92,54 @@ if __name__ == '__main__':
         config_file = DEFAULT_CONFIG_FILE
 
     djv = init(config_file)
-    if args.fingerprint:
-        # Fingerprint all files in a directory
-        if len(args.fingerprint) == 2:
-            directory = args.fingerprint[0]
-            extension = args.fingerprint[1]
-            print(f"Fingerprinting all .{extension} files in the {directory} directory")
-            djv.fingerprint_directory(directory, ["." + extension], 4)
-
-        elif len(args.fingerprint) == 1:
-            filepath = args.fingerprint[0]
-            if isdir(filepath):
-                print("Please specify an extension if you'd like to fingerprint a directory!")
-                sys.exit(1)
-            djv.fingerprint_file(filepath)
-
-    elif args.recognize:
-        # Recognize audio source
-        songs = None
-        source = args.recognize[0]
-        opt_arg = args.recognize[1]
-
-        if source in ('mic', 'microphone'):
-            songs = djv.recognize(MicrophoneRecognizer, seconds=opt_arg)
-        elif source == 'file':
-            songs = djv.recognize(FileRecognizer, opt_arg)
-        print(songs)
+    # the whole action is profiled, until it ends or is interrupted
+    with Profiler(args.profile) if args.profile else nullcontext():
+        if args.serve:
+            host, _, port = args.serve.rpartition(':')
+            serve(djv, host or '127.0.0.1', int(port))
+
+        elif args.build_bloom:
+            bloom = djv.db.build_bloom_filter()
+            bloom.save(args.build_bloom)
+            print(json.dumps(bloom.stats()))
+
+        elif args.fingerprint:
+            # Fingerprint all files in a directory
+            if len(args.fingerprint) == 2:
+                directory = args.fingerprint[0]
+                extension = args.fingerprint[1]
+                print(f"Fingerprinting all .{extension} files in the {directory} directory")
+                djv.fingerprint_directory(directory, ["." + extension], 4)
+
+            elif len(args.fingerprint) == 1:
+                filepath = args.fingerprint[0]
+                if isdir(filepath):
+                    print("Please specify an extension if you'd like to fingerprint a directory!")
+                    sys.exit(1)
+                djv.fingerprint_file(filepath)
+
+        elif args.recognize_dir:
+            directory, extension = args.recognize_dir
+            summary = djv.recognize(DirectoryRecognizer, directory, ["." + extension], output=args.output)
+            # the totals go to stderr when the results are written to stdout
+            print(json.dumps(summary), file=sys.stderr if args.output is None else sys.stdout)
+
+        elif args.recognize:
+            # Recognize audio source
+            songs = None
+            source = args.recognize[0]
+            opt_arg = args.recognize[1]
+
+            if source in ('mic', 'microphone'):
+                songs = djv.recognize(MicrophoneRecognizer, seconds=opt_arg)
+            elif source == 'file':
+                songs = djv.recognize(FileRecognizer, opt_arg)
+            elif source == 'archive':
+                checkpoint = args.checkpoint or f"{opt_arg}.checkpoint.json"
+                songs = djv.recognize(ArchiveRecognizer, opt_arg, checkpoint=checkpoint)
+            elif source == 'stream':
+                # match events are printed as soon as they happen, one JSON per line
+                djv.recognize(StreamRecognizer, opt_arg, follow=args.follow,
+                              on_match=lambda event: print(json.dumps(event), flush=True))
+                sys.exit(0)
+            print(songs)
@@ -1,22 +1,40 @@
+import asyncio
 import multiprocessing
 import os
 import sys
 import traceback
-from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from time import time
 from typing import Dict, List, Tuple
 
+import numpy as np
+
 import dejavu.logic.decoder as decoder
 from dejavu.base_classes.base_database import get_database
-from dejavu.config.settings import (DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+from dejavu.config.settings import (ASYNC_CPU_EXECUTOR, ASYNC_CPU_WORKERS, BLOOM_FILTER_PATH,
+                                    DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
                                     DEFAULT_WINDOW_SIZE, FIELD_FILE_SHA1,
                                     FIELD_TOTAL_HASHES, FIELD_AUDIO_DURATION,
                                     FINGERPRINTED_CONFIDENCE, AUDIO_DURATION,
                                     FINGERPRINTED_HASHES, HASHES_MATCHED,
-                                    INPUT_CONFIDENCE, INPUT_HASHES, OFFSET,
-                                    OFFSET_SECS, SONG_ID, SONG_NAME, TOPN,
+                                    INPUT_CONFIDENCE, INPUT_HASHES,
+                                    LOOKUP_COALESCE, METRICS, OFFSET,
+                                    OFFSET_SECS, PROGRESSIVE_BATCH_SIZE,
+                                    PROGRESSIVE_MARGIN, PROGRESSIVE_MATCHING,
+                                    PROGRESSIVE_FREQUENT_HASHES,
+                                    PROGRESSIVE_MIN_COUNT, RESULT_CACHE_SIZE,
+                                    SONG_ID, SONG_NAME,
+                                    TOPN, TWO_STAGE_CANDIDATES,
+                                    TWO_STAGE_MATCHING, TWO_STAGE_SAMPLE_RATE,
                                     RETURN_AUDIO_INFO)
+from dejavu.logic.alignment import grouped_top_matches, top_matches
+from dejavu.logic.coalescer import LookupCoalescer
 from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.matches import MatchAccumulator, in_bitmap, sample_hashes
+from dejavu.logic.metrics import MetricsRegistry, get_metrics, set_metrics
+from dejavu.logic.profiler import Profiler, profiled_map
+from dejavu.logic.result_cache import ResultCache
 
 
 class Dejavu:
@@ -26,27 +44,53 @@ class Dejavu:
         # initialize db
         db_cls = get_database(config.get("database_type", "mysql").lower())
 
-        self.db = db_cls(**config.get("database", {}))
+        self.db = db_cls(replicas=config.get("database_replicas"), **config.get("database", {}))
         self.db.setup()
+        # hashes ruled out by the Bloom filter of the stored hashes are not looked up.
+        bloom_filter = self.config.get("bloom_filter", BLOOM_FILTER_PATH)
+        if bloom_filter:
+            self.db.use_bloom_filter(bloom_filter)
 
         # if we should limit seconds fingerprinted,
         # None|-1 means use entire track
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
-        self.__load_fingerprinted_audio_hashes()
 
-    def __load_fingerprinted_audio_hashes(self) -> None:
+        # query the input hashes progressively, stopping as soon as the result is clear.
+        self.progressive = self.config.get("progressive_matching", PROGRESSIVE_MATCHING)
+        # rows of the most repeated hashes of the catalog, progressive matching queries them last. Loaded on
+        # first use, and again after the catalog changes.
+        self.frequent_hashes = self.config.get("progressive_frequent_hashes", PROGRESSIVE_FREQUENT_HASHES)
+        self.hash_frequencies = None
+        # look up a sample of the input hashes first and then all of them only against the best candidates.
+        self.two_stage = self.config.get("two_stage_matching", TWO_STAGE_MATCHING)
+        self.two_stage_sample_rate = self.config.get("two_stage_sample_rate", TWO_STAGE_SAMPLE_RATE)
+        self.two_stage_candidates = self.config.get("two_stage_candidates", TWO_STAGE_CANDIDATES)
+        # name of a registered catalog subset recognition is restricted to, None means the whole catalog.
+        self.subset = self.config.get("subset", None)
+        # fingerprint lookups go through the coalescer when concurrent recognitions should share queries.
+        self.lookups = self.db
+        if self.config.get("coalesce_lookups", LOOKUP_COALESCE):
+            self.lookups = LookupCoalescer(self.db)
+        # results of audio already recognized, answered again without decoding or querying it.
+        cache_size = self.config.get("result_cache_size", RESULT_CACHE_SIZE)
+        self.result_cache = ResultCache(cache_size) if cache_size else None
+        # executor of the CPU bound stages of the async API, created on first use unless one is given.
+        self.cpu_executor = None
+        # stage metrics and recognition traces are recorded by the registry of the process, see
+        # dejavu.logic.metrics. It records nothing unless enabled.
+        if self.config.get("metrics", METRICS) and not get_metrics().enabled:
+            set_metrics(MetricsRegistry())
+        self.metrics = get_metrics()
+
+    def __catalog_changed(self) -> None:
         """
-        Keeps a dictionary with the hashes of the fingerprinted songs, in that way is possible to check
-        whether or not an audio file was already processed.
+        Drops the cached results and hash frequencies, which may not hold anymore.
         """
-        # get songs previously indexed
-        self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
-        for song in self.songs:
-            song_hash = song[FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+        self.hash_frequencies = None
 
     def get_fingerprinted_songs(self) -> List[Dict[str, any]]:
         """
@@ -63,15 +107,25 @@ class Dejavu:
         :param song_ids: song ids to delete from the database.
         """
         self.db.delete_songs_by_id(song_ids)
+        # the deleted hashes can't be removed from the Bloom filter, so it is built again without them.
+        if self.db.bloom is not None:
+            self.db.bloom = self.db.build_bloom_filter()
+            self.db.save_bloom_filter(merge=False)
+        self.__catalog_changed()
 
-    def fingerprint_directory(self, path: str, extensions: str, nprocesses: int = None) -> None:
+    def fingerprint_directory(self, path: str, extensions: str, nprocesses: int = None, profile: str = None) -> None:
         """
         Given a directory and a set of extensions it fingerprints all files that match each extension specified.
 
         :param path: path to the directory.
         :param extensions: list of file extensions to consider.
         :param nprocesses: amount of processes to fingerprint the files within the directory.
+        :param profile: directory the profile of the run is written to, see dejavu.logic.profiler.Profiler.
         """
+        if profile:
+            with Profiler(profile):
+                return self.fingerprint_directory(path, extensions, nprocesses)
+
         # Try to use the maximum amount of processes if not given.
         try:
             nprocesses = nprocesses or multiprocessing.cpu_count()
@@ -82,11 +136,16 @@ class Dejavu:
 
         pool = multiprocessing.Pool(nprocesses)
 
+        filenames = [filename for filename, _ in decoder.find_files(path, extensions)]
+        file_hashes = {filename: decoder.unique_hash(filename) for filename in filenames}
+        fingerprinted = self.db.get_songs_by_hashes(list(set(file_hashes.values())))
+
         filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
+        for filename in filenames:
             # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.songhashes_set:
+            if file_hashes[filename] in fingerprinted:
                 print(f"{filename} already fingerprinted, continuing...")
+                get_metrics().count("songs_skipped")
                 continue
 
             filenames_to_fingerprint.append(filename)
@@ -95,7 +154,7 @@ class Dejavu:
         worker_input = list(zip(filenames_to_fingerprint, [self.limit] * len(filenames_to_fingerprint)))
 
         # Send off our tasks
-        iterator = pool.imap_unordered(Dejavu._fingerprint_worker, worker_input)
+        iterator = profiled_map(pool, Dejavu._fingerprint_worker, worker_input)
 
         # Loop till we have all of them
         while True:
@@ -107,17 +166,15 @@ class Dejavu:
                 break
             except Exception:
                 print("Failed fingerprinting")
+                get_metrics().count("fingerprint_failures")
                 # Print traceback because we can't reraise it here
                 traceback.print_exc(file=sys.stdout)
             else:
-                sid = self.db.insert_song(song_name, file_hash, len(hashes), song_duration)
-
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_song_fingerprinted(sid)
-                self.__load_fingerprinted_audio_hashes()
+                self.__insert_song(song_name, hashes, file_hash, song_duration)
 
         pool.close()
         pool.join()
+        self.db.save_bloom_filter()
 
     def fingerprint_file(self, file_path: str, song_name: str = None) -> None:
         """
@@ -131,32 +188,69 @@ class Dejavu:
         song_hash = decoder.unique_hash(file_path)
         song_name = song_name or song_name_from_path
         # don't refingerprint already fingerprinted files
-        if song_hash in self.songhashes_set:
+        if self.db.get_songs_by_hashes([song_hash]):
             print(f"{song_name} already fingerprinted, continuing...")
+            get_metrics().count("songs_skipped")
         else:
             song_name, hashes, file_hash, song_duration = Dejavu._fingerprint_worker(
                 (file_path, self.limit, song_name)
             )
+            self.__insert_song(song_name, hashes, file_hash, song_duration)
+            self.db.save_bloom_filter()
+
+    def __insert_song(self, song_name: str, hashes: List[Tuple[str, int]], file_hash: str,
+                      song_duration: int) -> None:
+        """
+        Stores a fingerprinted song and its hashes.
+        """
+        metrics = get_metrics()
+        with metrics.span("insert", hashes=len(hashes)):
             sid = self.db.insert_song(song_name, file_hash, len(hashes), song_duration)
 
             self.db.insert_hashes(sid, hashes)
             self.db.set_song_fingerprinted(sid)
-            self.__load_fingerprinted_audio_hashes()
+        metrics.count("songs_fingerprinted")
+        metrics.count("hashes_inserted", len(hashes))
+        self.__catalog_changed()
 
-    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS) -> Tuple[List[Tuple[str, int]], float]:
+    def generate_fingerprints(self, samples: List[int], Fs=DEFAULT_FS,
+                              with_strength: bool = False) -> Tuple[List[Tuple[str, int]], float]:
         f"""
         Generate the fingerprints for the given sample data (channel).
 
         :param samples: list of ints which represents the channel info of the given audio file.
         :param Fs: sampling rate which defaults to {DEFAULT_FS}.
+        :param with_strength: if True each tuple also carries the strength of the hash.
         :return: a list of tuples for hash and its corresponding offset, together with the generation time.
         """
         t = time()
-        hashes = fingerprint(samples, Fs=Fs)
+        hashes = fingerprint(samples, Fs=Fs, with_strength=with_strength)
         fingerprint_time = time() - t
         return hashes, fingerprint_time
 
-    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
+    async def generate_fingerprints_async(self, samples: List[int], Fs=DEFAULT_FS) \
+            -> Tuple[List[Tuple[str, int]], float]:
+        """
+        Async counterpart of `generate_fingerprints`, the fingerprints are generated on the CPU executor.
+        """
+        t = time()
+        hashes = await self.run_cpu(fingerprint, samples, Fs=Fs)
+        return hashes, time() - t
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """
+        Runs a CPU bound function (decoding, fingerprinting) on the CPU executor, a thread or process pool
+        as set by `ASYNC_CPU_EXECUTOR`, without blocking the event loop.
+
+        :param func: function to run, it must be picklable with a process pool.
+        :return: its result.
+        """
+        if self.cpu_executor is None:
+            executor_cls = ProcessPoolExecutor if ASYNC_CPU_EXECUTOR == 'process' else ThreadPoolExecutor
+            self.cpu_executor = executor_cls(max_workers=ASYNC_CPU_WORKERS)
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor, partial(func, *args, **kwargs))
+
+    def find_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[MatchAccumulator, Dict[str, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
 
@@ -166,11 +260,92 @@ class Dejavu:
 
         """
         t = time()
-        matches, dedup_hashes = self.db.return_matches(hashes)
+        if self.two_stage:
+            matches, dedup_hashes = self.find_matches_two_stage(hashes, self.two_stage_sample_rate,
+                                                                self.two_stage_candidates)
+        else:
+            matches, dedup_hashes = self.lookups.return_matches(hashes, subset=self.subset)
         query_time = time() - t
 
         return matches, dedup_hashes, query_time
 
+    async def find_matches_async(self, hashes: List[Tuple[str, int]]) \
+            -> Tuple[MatchAccumulator, Dict[str, int], float]:
+        """
+        Async counterpart of `find_matches`, the lookups run on the I/O executor of the database (and are
+        merged with the concurrent ones when lookups are coalesced).
+        """
+        return await self.db.run_io(self.find_matches, hashes)
+
+    def find_matches_two_stage(self, hashes: List[Tuple[str, int]],
+                               sample_rate: float = TWO_STAGE_SAMPLE_RATE,
+                               candidates: int = TWO_STAGE_CANDIDATES) -> Tuple[MatchAccumulator, Dict[str, int]]:
+        """
+        Coarse to fine search: a sample of the hashes is looked up first and songs are ranked by the raw
+        amount of hashes they matched, then every hash is looked up but only against the best candidates.
+
+        :param hashes: list of tuples for hashes and their corresponding offsets
+        :param sample_rate: fraction of the hashes looked up on the first stage.
+        :param candidates: number of songs that make it to the second stage.
+        :return: a tuple containing the matches found against the db for the candidate songs and a dictionary
+         which counts the different hashes matched for each song (with the song id as key).
+        """
+        sample = sample_hashes(hashes, sample_rate)
+        if not sample:
+            return self.lookups.return_matches(hashes, subset=self.subset)
+
+        _, votes = self.lookups.return_matches(sample, subset=self.subset)
+        if not votes:
+            return MatchAccumulator(), {}
+
+        song_filter = sorted(votes, key=lambda sid: (-votes[sid], sid))[:candidates]
+        return self.lookups.return_matches(hashes, song_filter=song_filter, subset=self.subset)
+
+    def get_hash_frequencies(self) -> Dict[str, int]:
+        """
+        :return: the rows of the most repeated hashes of the catalog, by hash, loaded the first time.
+        """
+        if self.hash_frequencies is None:
+            self.hash_frequencies = self.db.get_hash_frequencies(self.frequent_hashes) if self.frequent_hashes else {}
+        return self.hash_frequencies
+
+    def find_matches_progressive(self, hashes: Dict[Tuple[str, int], float],
+                                 batch_size: int = PROGRESSIVE_BATCH_SIZE,
+                                 margin: int = PROGRESSIVE_MARGIN,
+                                 min_count: int = PROGRESSIVE_MIN_COUNT) \
+            -> Tuple[MatchAccumulator, Dict[str, int], float, int]:
+        """
+        Queries the given hashes in batches, rarest first, and stops as soon as the leading song has at least
+        `min_count` aligned matches and beats the runner-up by `margin` of them. Rarity is known for the
+        `progressive_frequent_hashes` most repeated hashes of the catalog, the rest count as rare, and hashes
+        equally rare are queried strongest first (by the amplitude of the weaker of their two peaks).
+
+        :param hashes: dictionary with the (hash, offset) tuples as keys and their strength as values.
+        :param batch_size: number of hashes queried on each batch.
+        :param margin: aligned matches the leading song must have over the second one.
+        :param min_count: aligned matches the leading song must have.
+        :return: a tuple containing the matches found against the db, a dictionary which counts the different
+         hashes matched for each song (with the song id as key), the time that the queries took and the
+         amount of hashes queried.
+        """
+        t = time()
+        frequencies = self.get_hash_frequencies()
+        ordered = sorted(hashes, key=lambda h: (frequencies.get(h[0].upper(), 1), -hashes[h]))
+
+        matches = MatchAccumulator()
+        queried_hashes = 0
+        for index in range(0, len(ordered), batch_size):
+            batch = ordered[index: index + batch_size]
+            self.lookups.return_matches(batch, matches, subset=self.subset)
+            queried_hashes += len(batch)
+
+            _, _, counts = top_matches(*matches.histogram(), topn=2)
+            if counts.size and counts[0] >= min_count and counts[0] - (counts[1] if counts.size > 1 else 0) >= margin:
+                break
+        query_time = time() - t
+
+        return matches, matches.dedup_hashes, query_time, queried_hashes
+
     def find_matches_chunk(self, hashes_group, options) -> Tuple[List[Tuple[int, int]], Dict[str, int], float]:
         """
         Finds the corresponding matches on the fingerprinted audios for the given hashes.
@@ -181,74 +356,170 @@ class Dejavu:
 
         """
         t = time()
+        if self.subset and 'subset' not in options:
+            options = {**options, 'subset': self.subset}
         results = self.db.return_matches_chunk(hashes_group, options)
         query_time = time() - t
 
         return results, query_time
 
-    def align_matches(self, matches: List[Tuple[int, int]], dedup_hashes: Dict[str, int], queried_hashes: int,
+    def align_matches(self, matches: MatchAccumulator, dedup_hashes: Dict[str, int], queried_hashes: int,
                       topn: int = TOPN) -> List[Dict[str, any]]:
         """
         Finds hash matches that align in time with other matches and finds
         consensus about which hashes are "true" signal from the audio.
 
-        :param matches: matches from the database
+        :param matches: accumulator with the (sid, offset_difference) matches from the database
         :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song
         (key is the song id).
         :param queried_hashes: amount of hashes sent for matching against the db
         :param topn: number of results being returned back.
         :return: a list of dictionaries (based on topn) with match information.
         """
-        # count offset occurrences per song and keep only the maximum ones.
-        sorted_matches = sorted(matches, key=lambda m: (m[0], m[1]))
-        counts = [(*key, len(list(group))) for key, group in groupby(sorted_matches, key=lambda m: (m[0], m[1]))]
-        songs_matches = sorted(
-            [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
-            key=lambda count: count[2], reverse=True
-        )
-
-        songs_result = []
-        for song_id, offset, count in songs_matches[0:topn]:  # consider topn elements in the result
-            if (RETURN_AUDIO_INFO):
+        with get_metrics().span("align"):
+            # count offset occurrences per song and keep only the maximum ones.
+            songs_matches = zip(*(column.tolist() for column in top_matches(*matches.histogram(), topn=topn)))
+
+            songs_result = []
+            for song_id, offset, count in songs_matches:  # consider topn elements in the result
+                songs_result.append(self._song_match(song_id, offset, count, dedup_hashes, queried_hashes))
+
+        return songs_result
+
+    def align_matches_chunks(self, hashes_group: Dict[int, Dict], topn: int = TOPN) -> Dict[int, List[Dict[str, any]]]:
+        """
+        Same as `align_matches` for every chunk returned by `find_matches_chunk`, aligning all of them at once.
+
+        :param hashes_group: dictionary of chunks, each one with its 'matches', 'dedup_hashes' and 'hashes'.
+        :param topn: number of results being returned back for each chunk.
+        :return: a dictionary with the list of match dictionaries (based on topn) of each chunk.
+        """
+        with get_metrics().span("align", chunks=len(hashes_group)):
+            chunk_ids = list(hashes_group)
+            histograms = [hashes_group[i]['matches'].histogram() for i in chunk_ids]
+            groups = np.repeat(np.arange(len(chunk_ids)), [song_ids.size for song_ids, _, _ in histograms])
+            if histograms:
+                song_ids, offsets, counts = (np.concatenate(column) for column in zip(*histograms))
+            else:
+                song_ids = offsets = counts = np.empty(0, dtype=np.int64)
+            top = grouped_top_matches(groups, song_ids, offsets, counts, topn=topn)
+
+            songs = {}  # song info is shared among chunks
+            chunks_result = {i: [] for i in chunk_ids}
+            for group, song_id, offset, count in zip(*(column.tolist() for column in top)):
+                chunk = hashes_group[chunk_ids[group]]
+                chunks_result[chunk_ids[group]].append(
+                    self._song_match(song_id, offset, count, chunk['dedup_hashes'], len(chunk['hashes']), songs)
+                )
+
+        return chunks_result
+
+    def _song_match(self, song_id: int, offset: int, count: int, dedup_hashes: Dict[str, int],
+                    queried_hashes: int, songs: Dict[int, Dict[str, str]] = None) -> Dict[str, any]:
+        """
+        Builds the match information of a song.
+
+        :param song_id: song identifier.
+        :param offset: best aligned offset difference.
+        :param count: matches aligned on that offset.
+        :param dedup_hashes: dictionary containing the hashes matched without duplicates for each song.
+        :param queried_hashes: amount of hashes sent for matching against the db.
+        :param songs: optional cache of the song info retrieved from the database.
+        :return: a dictionary with the match information.
+        """
+        if (RETURN_AUDIO_INFO):
+            if songs is None or song_id not in songs:
                 song = self.db.get_song_by_id(song_id)
-                song_name = song.get(SONG_NAME, None)
-                song_hashes = song.get(FIELD_TOTAL_HASHES, None)
-                song_duration = song.get(FIELD_AUDIO_DURATION, None)
+                if songs is not None:
+                    songs[song_id] = song
             else:
-                song_name = ""
-                song_hashes = 1
-                song_duration = 1
-
-            nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
-            hashes_matched = dedup_hashes[song_id]
-
-            avg_counts_hashes_matched = round(count * 100 / hashes_matched, 2)
-
-            song = {
-                "count": count,
-                "avg_counts_hashes_matched": avg_counts_hashes_matched,
-                SONG_ID: song_id,
-                SONG_NAME: song_name,
-                INPUT_HASHES: queried_hashes,
-                FINGERPRINTED_HASHES: song_hashes,
-                AUDIO_DURATION: song_duration,
-                HASHES_MATCHED: hashes_matched,
-                # Percentage regarding hashes matched vs hashes from the input.
-                INPUT_CONFIDENCE: round(hashes_matched / queried_hashes * 100, 2),
-                # Percentage regarding hashes matched vs hashes fingerprinted in the db.
-                FINGERPRINTED_CONFIDENCE: round(hashes_matched / song_hashes * 100, 2),
-                OFFSET: offset,
-                OFFSET_SECS: nseconds,
-                FIELD_FILE_SHA1: 0 # song.get(FIELD_FILE_SHA1, None).encode("utf8")
-            }
-
-            songs_result.append(song)
+                song = songs[song_id]
+            song_name = song.get(SONG_NAME, None)
+            song_hashes = song.get(FIELD_TOTAL_HASHES, None)
+            song_duration = song.get(FIELD_AUDIO_DURATION, None)
+        else:
+            song_name = ""
+            song_hashes = 1
+            song_duration = 1
+
+        nseconds = round(float(offset) / DEFAULT_FS * DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO, 5)
+        hashes_matched = dedup_hashes[song_id]
+
+        avg_counts_hashes_matched = round(count * 100 / hashes_matched, 2)
+
+        return {
+            "count": count,
+            "avg_counts_hashes_matched": avg_counts_hashes_matched,
+            SONG_ID: song_id,
+            SONG_NAME: song_name,
+            INPUT_HASHES: queried_hashes,
+            FINGERPRINTED_HASHES: song_hashes,
+            AUDIO_DURATION: song_duration,
+            HASHES_MATCHED: hashes_matched,
+            # Percentage regarding hashes matched vs hashes from the input.
+            INPUT_CONFIDENCE: round(hashes_matched / queried_hashes * 100, 2),
+            # Percentage regarding hashes matched vs hashes fingerprinted in the db.
+            FINGERPRINTED_CONFIDENCE: round(hashes_matched / song_hashes * 100, 2),
+            OFFSET: offset,
+            OFFSET_SECS: nseconds,
+            FIELD_FILE_SHA1: 0 # song.get(FIELD_FILE_SHA1, None).encode("utf8")
+        }
+
+    def recognition_options(self) -> Dict[str, any]:
+        """
+        :return: the options recognition results depend on, which are part of their cache keys.
+        """
+        return {
+            "topn": TOPN,
+            "limit": self.limit,
+            "subset": self.subset,
+            "progressive": (self.progressive, self.frequent_hashes),
+            "two_stage": (self.two_stage, self.two_stage_sample_rate, self.two_stage_candidates)
+        }
+
+    def catalog_match(self, file_hash: str) -> Tuple[List[Dict[str, any]], int]:
+        """
+        Recognizes a file that is itself in the catalog by its SHA1, without decoding it.
 
-        return songs_result
+        :param file_hash: SHA1 of the file.
+        :return: the match of its song, as given by `align_matches`, and the duration of the song in milliseconds,
+         or None if the file is not in the catalog or its song is outside of the subset recognitions are
+         restricted to.
+        """
+        song = self.db.get_songs_by_hashes([file_hash]).get(file_hash)
+        if song is None:
+            return None
+
+        song_id, total_hashes = song[SONG_ID], song[FIELD_TOTAL_HASHES]
+        # its fingerprints would not match either, the file must be recognized as any other.
+        if self.subset and not in_bitmap(self.db.get_subset(self.subset), np.array([song_id]))[0]:
+            return None
 
-    def recognize(self, recognizer, *options, **kwoptions) -> Dict[str, any]:
+        matches = [self._song_match(song_id, 0, total_hashes, {song_id: total_hashes}, total_hashes, {song_id: song})]
+        return matches, song[FIELD_AUDIO_DURATION]
+
+    def recognize(self, recognizer, *options, profile: str = None, **kwoptions) -> Dict[str, any]:
+        if profile:
+            with Profiler(profile):
+                return self.recognize(recognizer, *options, **kwoptions)
+
+        r = recognizer(self)
+        with get_metrics().span("recognize", trace=True, recognizer=recognizer.__name__):
+            return r.recognize(*options, **kwoptions)
+
+    async def recognize_async(self, recognizer, *options, timeout: float = None, **kwoptions) -> Dict[str, any]:
+        """
+        Async counterpart of `recognize`, e.g. `await djv.recognize_async(FileRecognizer, path, timeout=10)`.
+        CPU stages run on the CPU executor and database I/O on the I/O one, so a single event loop can serve
+        many concurrent recognitions.
+
+        :param recognizer: recognizer class.
+        :param timeout: seconds after which the recognition is cancelled with asyncio.TimeoutError, None to wait.
+        :return: the results of the recognizer.
+        """
         r = recognizer(self)
-        return r.recognize(*options, **kwoptions)
+        with get_metrics().span("recognize", trace=True, recognizer=recognizer.__name__):
+            return await asyncio.wait_for(r.recognize_async(*options, **kwoptions), timeout)
 
     @staticmethod
     def _fingerprint_worker(arguments):
@@ -3,6 +3,7 @@ import importlib
 from typing import Dict, List, Tuple
 
 from dejavu.config.settings import DATABASES
+from dejavu.logic.matches import MatchAccumulator, QueryHashes
 
 
 class BaseDatabase(object, metaclass=abc.ABCMeta):
@@ -84,6 +85,27 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def get_songs_by_hashes(self, file_hashes: List[str], batch_size: int = 1000) -> Dict[str, Dict[str, str]]:
+        """
+        Looks fully fingerprinted songs up by the SHA1 of their files.
+
+        :param file_hashes: SHA1 of the files, in hexadecimal format.
+        :param batch_size: number of hashes looked up by each query.
+        :return: a dictionary with the info of the songs found, by file SHA1.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_hash_frequencies(self, limit: int) -> Dict[str, int]:
+        """
+        Counts the rows of the most repeated hashes of the catalog.
+
+        :param limit: number of hashes returned.
+        :return: a dictionary with the rows of each hash stored more than once, by hash.
+        """
+        pass
+
     @abc.abstractmethod
     def get_song_by_id(self, song_id: int) -> Dict[str, str]:
         """
@@ -152,16 +174,18 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
 
     @abc.abstractmethod
-    def return_matches(self, hashes: List[Tuple[str, int]], batch_size: int = 1000) \
-            -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def return_matches(self, hashes: List[Tuple[str, int]], matches: MatchAccumulator = None,
+                       song_filter: List[int] = None, subset: str = None) -> Tuple[MatchAccumulator, Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
 
         :param hashes: A sequence of tuples in the format (hash, offset)
             - hash: Part of a sha1 hash, in hexadecimal format
             - offset: Offset this hash was created from/at.
-        :param batch_size: number of query's batches.
-        :return: a list of (sid, offset_difference) tuples and a
+        :param matches: accumulator to add the matches to, a new one is created if not given.
+        :param song_filter: if given, only fingerprints of these song ids are considered.
+        :param subset: if given, only fingerprints of the songs in this registered subset are considered.
+        :return: a MatchAccumulator with the (sid, offset_difference) pairs and a
         dictionary with the amount of hashes matched (not considering
         duplicated hashes) in each song.
             - song id: Song identifier
@@ -169,6 +193,19 @@ class BaseDatabase(object, metaclass=abc.ABCMeta):
         """
         pass
 
+    @abc.abstractmethod
+    def return_matches_batch(self, queries: List[Tuple[QueryHashes, MatchAccumulator]],
+                             song_filter: List[int] = None, subset: str = None) -> int:
+        """
+        Searches the database for the hashes of several queries with a single lookup.
+
+        :param queries: list of (query hashes, accumulator to add their matches to) tuples.
+        :param song_filter: if given, only fingerprints of these song ids are considered.
+        :param subset: if given, only fingerprints of the songs in this registered subset are considered.
+        :return: the amount of distinct hashes looked up.
+        """
+        pass
+
     @abc.abstractmethod
     def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
         """
@@ -1,4 +1,5 @@
 import abc
+import asyncio
 from time import time
 from typing import Dict, List, Tuple
 
@@ -11,8 +12,13 @@ class BaseRecognizer(object, metaclass=abc.ABCMeta):
     def __init__(self, dejavu):
         self.dejavu = dejavu
         self.Fs = DEFAULT_FS
+        # amount of hashes sent to the database by the last recognition.
+        self.queried_hashes = 0
 
     def _recognize(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
+        if self.dejavu.progressive:
+            return self._recognize_progressive(*data)
+
         fingerprint_times = []
         hashes = set()  # to remove possible duplicated fingerprints we built a set.
         for channel in data:
@@ -20,14 +26,88 @@ class BaseRecognizer(object, metaclass=abc.ABCMeta):
             fingerprint_times.append(fingerprint_time)
             hashes |= set(fingerprints)
 
+        self.queried_hashes = len(hashes)
+        cache = self.dejavu.result_cache
+        if cache is not None:
+            # the same audio gives the same hashes, whatever file or stream it comes from.
+            key = cache.hashes_key(hashes, self.dejavu.recognition_options())
+            final_results = cache.get(key)
+            if final_results is not None:
+                return final_results, np.sum(fingerprint_times), 0, 0
+
         matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
 
         t = time()
         final_results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
         align_time = time() - t
 
+        if cache is not None:
+            cache.put(key, final_results)
+
+        return final_results, np.sum(fingerprint_times), query_time, align_time
+
+    async def _recognize_async(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
+        """
+        Async counterpart of `_recognize`: channels are fingerprinted concurrently on the CPU executor and the
+        database is queried from the I/O executor, so the event loop is never blocked.
+        """
+        if self.dejavu.progressive:
+            # progressive lookups are interleaved with the alignment, they run as a whole on the I/O executor.
+            return await self.dejavu.db.run_io(self._recognize_progressive, *data)
+
+        fingerprints = await asyncio.gather(*(self.dejavu.generate_fingerprints_async(channel, Fs=self.Fs)
+                                              for channel in data))
+        fingerprint_times = [fingerprint_time for _, fingerprint_time in fingerprints]
+        hashes = set()  # to remove possible duplicated fingerprints we built a set.
+        for channel_fingerprints, _ in fingerprints:
+            hashes |= set(channel_fingerprints)
+
+        self.queried_hashes = len(hashes)
+        cache = self.dejavu.result_cache
+        if cache is not None:
+            key = cache.hashes_key(hashes, self.dejavu.recognition_options())
+            final_results = cache.get(key)
+            if final_results is not None:
+                return final_results, np.sum(fingerprint_times), 0, 0
+
+        matches, dedup_hashes, query_time = await self.dejavu.find_matches_async(hashes)
+
+        # aligning may fetch the information of the songs from the database.
+        t = time()
+        final_results = await self.dejavu.db.run_io(self.dejavu.align_matches, matches, dedup_hashes, len(hashes))
+        align_time = time() - t
+
+        if cache is not None:
+            cache.put(key, final_results)
+
+        return final_results, np.sum(fingerprint_times), query_time, align_time
+
+    def _recognize_progressive(self, *data) -> Tuple[List[Dict[str, any]], int, int, int]:
+        fingerprint_times = []
+        hashes = {}  # (hash, offset) => strength, keeping the strongest one among channels.
+        for channel in data:
+            fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=self.Fs,
+                                                                               with_strength=True)
+            fingerprint_times.append(fingerprint_time)
+            for hsh, offset, strength in fingerprints:
+                if strength > hashes.get((hsh, offset), float("-inf")):
+                    hashes[(hsh, offset)] = strength
+
+        matches, dedup_hashes, query_time, self.queried_hashes = self.dejavu.find_matches_progressive(hashes)
+
+        t = time()
+        final_results = self.dejavu.align_matches(matches, dedup_hashes, self.queried_hashes)
+        align_time = time() - t
+
         return final_results, np.sum(fingerprint_times), query_time, align_time
 
     @abc.abstractmethod
     def recognize(self) -> Dict[str, any]:
         pass  # base class does nothing
+
+    async def recognize_async(self, *options, **kwoptions) -> Dict[str, any]:
+        """
+        Async counterpart of `recognize`. Recognizers without a staged implementation run `recognize` as a
+        whole on the I/O executor.
+        """
+        return await self.dejavu.db.run_io(self.recognize, *options, **kwoptions)
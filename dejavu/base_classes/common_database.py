@@ -1,9 +1,28 @@
 import abc
-from typing import Dict, List, Tuple
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import cycle
+from time import time
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
 
 from dejavu.base_classes.base_database import BaseDatabase
-from dejavu.config.settings import (FINGERPRINTS_TABLENAME, FIELD_SONG_ID,
-                                    FIELD_HASH, FIELD_OFFSET)
+from dejavu.config.settings import (ASYNC_IO_WORKERS, BLOOM_FILTER_ERROR_RATE,
+                                    BLOOM_FILTER_GROWTH, BLOOM_FILTER_MIN_CAPACITY,
+                                    BLOOM_FILTER_RELOAD,
+                                    FIELD_FILE_SHA1,
+                                    FINGERPRINTS_TABLENAME, FIELD_SONG_ID,
+                                    FIELD_HASH, FIELD_OFFSET, MATCH_FETCH_SIZE,
+                                    REPLICA_FALLBACK_TO_PRIMARY,
+                                    REPLICA_STALENESS, SUBSET_FILTER)
+from dejavu.logic.alignment import grouped_histogram
+from dejavu.logic.bloom import BloomFilter
+from dejavu.logic.matches import (HASH_DTYPE, MatchAccumulator, QueryHashes,
+                                  in_bitmap, rows_to_columns, song_bitmap)
+from dejavu.logic.metrics import get_metrics
 
                                     
 
@@ -15,6 +34,53 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
     def __init__(self):
         super().__init__()
+        # cursor factories of the read replicas, subclasses fill this list in from their own options.
+        self.replica_cursors = []
+        self._replica_cycle = None
+        self._last_write = 0.0
+        self.replica_staleness = REPLICA_STALENESS
+        self.replica_fallback = REPLICA_FALLBACK_TO_PRIMARY
+        # bitmaps of the catalog subsets already loaded, by name.
+        self._subsets: Dict[str, np.ndarray] = {}
+        self.subset_filter = SUBSET_FILTER
+        # threads the async methods run the blocking queries on, created on first use.
+        self.io_executor = None
+        # filter of the stored hashes query hashes are checked against, see `use_bloom_filter`.
+        self.bloom = None
+        self.bloom_path = None
+        self._bloom_mtime = None
+        self._bloom_checked = 0.0
+        # whether hashes were added to the filter since it was last saved.
+        self._bloom_dirty = False
+
+    def set_replicas(self, replica_cursors: List) -> None:
+        """
+        Registers the cursor factories of the read replicas, queries on the recognition path are spread
+        among them in a round-robin fashion while writes stay on the primary.
+
+        :param replica_cursors: list of cursor factories, one per replica.
+        """
+        self.replica_cursors = list(replica_cursors)
+        self._replica_cycle = cycle(self.replica_cursors) if self.replica_cursors else None
+
+    def read_cursor(self, **options):
+        """
+        Returns a cursor suitable for read only queries. Replicas are used unless there are none configured
+        or this instance wrote to the primary less than `replica_staleness` seconds ago, in which case the
+        replicas might not have the new rows yet and the primary is used instead.
+
+        :param options: options given to the cursor.
+        :return: a cursor context manager.
+        """
+        if self._replica_cycle is None or time() - self._last_write < self.replica_staleness:
+            return self.cursor(**options)
+        return next(self._replica_cycle)(**options)
+
+    def _mark_write(self) -> None:
+        """
+        Records that the primary has just been written, see `read_cursor`.
+        """
+        self._last_write = time()
 
     def before_fork(self) -> None:
         """
@@ -45,10 +111,14 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         Called when the database should be cleared of all data.
         """
+        self._mark_write()
         with self.cursor() as cur:
+            # subsets reference songs, so they are dropped first.
+            cur.execute(self.DROP_SUBSETS)
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
 
+        self._subsets.clear()
         self.setup()
 
     def delete_unfingerprinted_songs(self) -> None:
@@ -56,6 +126,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         Called to remove any song entries that do not have any fingerprints
         associated with them.
         """
+        self._mark_write()
         with self.cursor() as cur:
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
@@ -89,6 +160,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
         :param song_id: song identifier.
         """
+        self._mark_write()
         with self.cursor() as cur:
             cur.execute(self.UPDATE_SONG_FINGERPRINTED, (song_id,))
 
@@ -98,10 +170,40 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
         :return: a dictionary with the songs info.
         """
-        with self.cursor(dictionary=True) as cur:
+        with self.read_cursor(dictionary=True) as cur:
             cur.execute(self.SELECT_SONGS)
             return list(cur)
 
+    def get_songs_by_hashes(self, file_hashes: List[str], batch_size: int = 1000) -> Dict[str, Dict[str, str]]:
+        """
+        Looks fully fingerprinted songs up by the SHA1 of their files, through the index on it, so there is
+        no need to keep the whole catalog in memory to know whether a file was already fingerprinted.
+
+        :param file_hashes: SHA1 of the files, in hexadecimal format.
+        :param batch_size: number of hashes looked up by each query.
+        :return: a dictionary with the info of the songs found, by file SHA1.
+        """
+        songs = {}
+        for index in range(0, len(file_hashes), batch_size):
+            batch = file_hashes[index: index + batch_size]
+            with self.read_cursor(dictionary=True) as cur:
+                cur.execute(self.SELECT_SONGS_BY_SHA1 % ', '.join([self.IN_MATCH] * len(batch)), batch)
+                songs.update((song[FIELD_FILE_SHA1], song) for song in cur)
+
+        return songs
+
+    def get_hash_frequencies(self, limit: int) -> Dict[str, int]:
+        """
+        Counts the rows of the most repeated hashes of the catalog. The whole table is aggregated, so it is
+        meant to be called once and its result kept.
+
+        :param limit: number of hashes returned.
+        :return: a dictionary with the rows of each hash stored more than once, by hash.
+        """
+        with self.read_cursor() as cur:
+            cur.execute(self.SELECT_HASH_FREQUENCIES, (limit,))
+            return {hsh: count for hsh, count in cur}
+
     def get_song_by_id(self, song_id: int) -> Dict[str, str]:
         """
         Brings the song info from the database.
@@ -109,9 +211,17 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param song_id: song identifier.
         :return: a song by its identifier. Result must be a Dictionary.
         """
-        with self.cursor(dictionary=True) as cur:
+        with self.read_cursor(dictionary=True) as cur:
             cur.execute(self.SELECT_SONG, (song_id,))
-            return cur.fetchone()
+            song = cur.fetchone()
+
+        # the song may have been just inserted and not replicated yet.
+        if song is None and self.replica_fallback and self.replica_cursors:
+            with self.cursor(dictionary=True) as cur:
+                cur.execute(self.SELECT_SONG, (song_id,))
+                song = cur.fetchone()
+
+        return song
 
     def insert(self, fingerprint: str, song_id: int, offset: int):
         """
@@ -121,6 +231,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param song_id: Song identifier this fingerprint is off
         :param offset: The offset this fingerprint is from.
         """
+        self._mark_write()
         with self.cursor() as cur:
             cur.execute(self.INSERT_FINGERPRINT, (fingerprint, song_id, offset))
 
@@ -173,6 +284,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         """
         values = [(song_id, hsh, int(offset)) for hsh, offset in hashes]
 
+        self._mark_write()
         with self.cursor() as cur:
             for index in range(0, len(hashes), batch_size):
                 batch_values = values[index: index + batch_size]
@@ -185,41 +297,308 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
                     VALUES {batch_values_query};
                 """
                 cur.execute(query, sum(batch_values, ()))
+
+        if self.bloom is not None:
+            self.bloom.add(hsh for hsh, _ in hashes)
+            self._bloom_dirty = True
         # METODO ANTIGUO
         """ with self.cursor() as cur:
             for index in range(0, len(hashes), batch_size):
                 cur.executemany(self.INSERT_FINGERPRINT, values[index: index + batch_size]) """
 
-    def return_matches(self, hashes: List[Tuple[str, int]]) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
+    def return_matches(self, hashes: List[Tuple[str, int]], matches: MatchAccumulator = None,
+                       song_filter: List[int] = None, subset: str = None) -> Tuple[MatchAccumulator, Dict[int, int]]:
         """
         Searches the database for pairs of (hash, offset) values.
+
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param matches: accumulator to add the matches to, a new one is created if not given.
+        :param song_filter: if given, only fingerprints of these song ids are considered.
+        :param subset: if given, only fingerprints of the songs in this registered subset are considered.
+        :return: a MatchAccumulator holding the (sid, offset_difference) pairs found and a
+        dictionary with the amount of hashes matched (not considering
+        duplicated hashes) in each song.
+            - song id: Song identifier
+            - offset_difference: (database_offset - sampled_offset)
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        mapper = {}
-        for hsh, offset in hashes:
-            if hsh.upper() not in mapper:
-                mapper[hsh.upper()] = [offset]
-            else:
-                mapper[hsh.upper()].append(offset)
-        
-        # in order to count each hash only once per db offset we use the dic below
-        dedup_hashes = {}
-        results = []
+        matches = MatchAccumulator() if matches is None else matches
+        self.return_matches_batch([(QueryHashes(hashes), matches)], song_filter, subset)
+
+        return matches, matches.dedup_hashes
+
+    def return_matches_batch(self, queries: List[Tuple[QueryHashes, MatchAccumulator]],
+                             song_filter: List[int] = None, subset: str = None) -> int:
+        """
+        Searches the database for the hashes of several queries at once: the distinct hashes of all of them
+        are looked up with a single query and each row is added to the accumulator of every query holding
+        its hash.
+
+        :param queries: list of (query hashes, accumulator to add their matches to) tuples.
+        :param song_filter: if given, only fingerprints of these song ids are considered.
+        :param subset: if given, only fingerprints of the songs in this registered subset are considered.
+        :return: the amount of distinct hashes looked up.
+        """
+        keys = [query_hashes.keys for query_hashes, _ in queries if len(query_hashes)]
+        if not keys:
+            return 0
+        values = self._bloom_prefilter([key.decode() for key in np.unique(np.concatenate(keys)).tolist()])
+        if not values:
+            return 0
+
+        metrics = get_metrics()
+        bitmap = self._subset_bitmap(subset, song_filter)
+        with self.read_cursor(buffered=False) as cur, metrics.span("db_query", hashes=len(values)) as span:
+            self._select_matches(cur, values, song_filter, subset)
+            metrics.count("db_queries")
+            metrics.count("db_hashes", len(values))
+
+            total_rows = 0
+            for rows in self._fetch_batches(cur):
+                self._count_rows(rows)
+                total_rows += len(rows)
+                db_hashes, db_sids, db_offsets = self._filter_subset(rows_to_columns(rows), bitmap)
+                for query_hashes, matches in queries:
+                    # we now evaluate all offset for each hash matched
+                    sids, offsets, found = query_hashes.join(db_hashes, db_sids, db_offsets)
+
+                    # in order to count each hash only once per db offset we count the rows per song
+                    matches.count_hashes(db_sids if len(queries) == 1 else db_sids[found])
+                    matches.add(sids, offsets)
+            span.set(rows=total_rows)
+
+        return len(values)
+
+    async def return_matches_async(self, hashes: List[Tuple[str, int]], matches: MatchAccumulator = None,
+                                   song_filter: List[int] = None, subset: str = None, timeout: float = None) \
+            -> Tuple[MatchAccumulator, Dict[int, int]]:
+        """
+        Async counterpart of `return_matches`, the query runs on the I/O executor.
+
+        :param timeout: seconds after which the lookup is cancelled with asyncio.TimeoutError, None to wait.
+        """
+        return await asyncio.wait_for(self.run_io(self.return_matches, hashes, matches, song_filter, subset),
+                                      timeout)
+
+    async def run_io(self, func, *args, **kwargs):
+        """
+        Runs a blocking function, such as a query, on the I/O executor without blocking the event loop.
+        If the call is cancelled before a thread picks it up it never runs, once running it completes in
+        the background.
+
+        :param func: function to run.
+        :return: its result.
+        """
+        if self.io_executor is None:
+            self.io_executor = ThreadPoolExecutor(max_workers=ASYNC_IO_WORKERS, thread_name_prefix="dejavu-io")
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, partial(func, *args, **kwargs))
+
+    def use_bloom_filter(self, path: str) -> None:
+        """
+        Enables the Bloom filter of the stored hashes: the query hashes it rules out are not sent to the
+        database. The filter is loaded from the given file, or built from the database and saved there if
+        the file does not exist yet. Hashes inserted afterwards are added to it, and a newer file saved by
+        another process (see `save_bloom_filter`) is loaded every `BLOOM_FILTER_RELOAD` seconds.
+
+        :param path: file the filter is stored in.
+        """
+        self.bloom_path = path
+        if os.path.exists(path):
+            self._load_bloom_filter()
+        else:
+            self.bloom = self.build_bloom_filter()
+            self.save_bloom_filter()
+
+    def build_bloom_filter(self, error_rate: float = BLOOM_FILTER_ERROR_RATE,
+                           growth: float = BLOOM_FILTER_GROWTH) -> BloomFilter:
+        """
+        Builds a Bloom filter with every hash stored in the database. Since hashes can't be removed from a
+        Bloom filter, deleted songs only leave false positives behind until it is built again.
+
+        :param error_rate: fraction of absent hashes let through.
+        :param growth: the filter is sized for this multiple of the hashes currently stored, and for at least
+         `BLOOM_FILTER_MIN_CAPACITY` hashes.
+        :return: the filter.
+        """
+        bloom = BloomFilter(self._bloom_capacity(growth), error_rate)
+        with self.read_cursor(buffered=False) as cur:
+            cur.execute(self.SELECT_ALL_HASHES)
+            for rows in self._fetch_batches(cur):
+                bloom.add(row[0] for row in rows)
+        return bloom
+
+    def save_bloom_filter(self, merge: bool = True) -> None:
+        """
+        Saves the Bloom filter in use to its file, so other processes load it. The hashes other processes
+        saved meanwhile are added to it first, so processes fingerprinting at the same time don't lose each
+        other's hashes. The filter is built again from the database instead when it holds more hashes than it
+        was sized for, or when the one saved is sized differently (it was built again by another process).
+
+        :param merge: False replaces the filter saved, e.g. by one built again without the deleted songs.
+        """
+        if self.bloom is None or not self.bloom_path:
+            return
+
+        if self.bloom.count > self.bloom.capacity:
+            self.bloom = self.build_bloom_filter()
+            merge = False
+
+        mtime = self.bloom.save(self.bloom_path, merge)
+        if mtime is None:
+            # every hash saved by any process is in the database, so nothing is lost by building it again.
+            self.bloom = self.build_bloom_filter()
+            mtime = self.bloom.save(self.bloom_path)
+        self._bloom_mtime = mtime
+        self._bloom_dirty = False
+
+    def _load_bloom_filter(self) -> None:
+        mtime = os.path.getmtime(self.bloom_path)
+        bloom = BloomFilter.load(self.bloom_path)
+        # hashes this process added and didn't save yet must not be lost.
+        if self.bloom is not None and self._bloom_dirty and not bloom.merge(self.bloom):
+            bloom = self.build_bloom_filter()
+        self.bloom = bloom
+        self._bloom_mtime = mtime
+
+    def _bloom_capacity(self, growth: float) -> int:
+        return max(int(self.get_num_fingerprints() * growth), BLOOM_FILTER_MIN_CAPACITY)
+
+    def _bloom_prefilter(self, values: List[str]) -> List[str]:
+        """
+        :param values: distinct query hashes, in hexadecimal format.
+        :return: the hashes that may be stored in the database, all of them if there is no Bloom filter.
+        """
+        if self.bloom is None:
+            return values
+
+        if time() - self._bloom_checked > BLOOM_FILTER_RELOAD:
+            self._bloom_checked = time()
+            try:
+                if os.path.getmtime(self.bloom_path) != self._bloom_mtime:
+                    self._load_bloom_filter()
+            except OSError:
+                pass
+
+        mask = self.bloom.contains(values)
+        values_kept = [value for value, keep in zip(values, mask.tolist()) if keep]
+        get_metrics().count("bloom_filtered_hashes", len(values) - len(values_kept))
+        return values_kept
+
+    def _select_matches(self, cur, values: List[str], song_filter: List[int] = None, subset: str = None) -> None:
+        """
+        Executes the query returning the (hash, song_id, offset) rows of the given hashes.
+
+        :param cur: cursor to execute the query on.
+        :param values: distinct hashes, in hexadecimal format.
+        :param song_filter: if given, only fingerprints of these song ids are returned.
+        :param subset: if given and subsets are filtered by the database, only fingerprints of the songs in
+         this subset are returned. Otherwise `_filter_subset` discards the other rows.
+        """
+        # Create our IN part of the query
+        hash_placeholders = ', '.join([self.IN_MATCH] * len(values))
+        if song_filter:
+            song_filter_placeholders = ', '.join(['%s'] * len(song_filter))
+            query = self.SELECT_MULTIPLE_FILTER_SONGS % (song_filter_placeholders, hash_placeholders)
+            cur.execute(query, list(song_filter) + values)
+        elif subset and self.subset_filter == 'server':
+            cur.execute(self.SELECT_MULTIPLE_SUBSET % hash_placeholders, [subset] + values)
+        else:
+            cur.execute(self.SELECT_MULTIPLE % hash_placeholders, values)
+
+    def _subset_bitmap(self, subset: str, song_filter: List[int] = None) -> np.ndarray:
+        """
+        :return: the bitmap rows must be checked against after the query, None when the query already
+         filters them (or there is no subset).
+        """
+        if not subset:
+            return None
+        # loaded even when the database filters the rows, so an unknown subset fails the same way in both modes.
+        bitmap = self.get_subset(subset)
+        return None if self.subset_filter == 'server' and not song_filter else bitmap
+
+    @staticmethod
+    def _filter_subset(columns: Tuple[np.ndarray, np.ndarray, np.ndarray], bitmap: np.ndarray = None) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Keeps the (hash, song_id, offset) rows whose song is in the bitmap.
+        """
+        if bitmap is None:
+            return columns
+        keep = in_bitmap(bitmap, columns[1])
+        return tuple(column[keep] for column in columns)
+
+    def register_subset(self, name: str, song_ids: List[int]) -> None:
+        """
+        Stores a named subset of the catalog (for instance the repertoire licensed by a client), replacing
+        any previous subset with the same name. Queries can then be restricted to it by name.
+
+        :param name: subset name.
+        :param song_ids: ids of the songs in the subset.
+        """
+        self._mark_write()
+        with self.cursor() as cur:
+            cur.execute(self.CREATE_SUBSETS_TABLE)
+            cur.execute(self.DELETE_SUBSET, (name,))
+            cur.executemany(self.INSERT_SUBSET_SONG, [(name, song_id) for song_id in song_ids])
+
+        self._subsets[name] = song_bitmap(song_ids)
+
+    def delete_subset(self, name: str) -> None:
+        """
+        Removes a named subset of the catalog.
+
+        :param name: subset name.
+        """
+        self._mark_write()
         with self.cursor() as cur:
-            # Create our IN part of the query
-            query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(mapper))
+            cur.execute(self.DELETE_SUBSET, (name,))
+
+        self._subsets.pop(name, None)
+
+    def get_subset(self, name: str) -> np.ndarray:
+        """
+        Returns the bitmap of a named subset, it is loaded from the database the first time.
+
+        :param name: subset name.
+        :return: boolean array indexed by song id.
+        """
+        if name not in self._subsets:
+            with self.read_cursor() as cur:
+                cur.execute(self.SELECT_SUBSET, (name,))
+                song_ids = [row[0] for row in cur]
 
-            cur.execute(query, list(mapper.keys()))
+            if not song_ids:
+                raise ValueError(f"Unknown or empty song subset: {name}")
+            self._subsets[name] = song_bitmap(song_ids)
 
-            for hsh, sid, offset in cur:
-                dedup_hashes[sid] = dedup_hashes.get(sid, 0) + 1
+        return self._subsets[name]
 
-                # we now evaluate all offset for each hash matched
-                for song_sampled_offset in mapper[hsh]:
-                    results.append((sid, offset - song_sampled_offset))
+    @staticmethod
+    def _fetch_batches(cur, batch_size: int = MATCH_FETCH_SIZE) -> Iterator[List[Tuple]]:
+        """
+        Reads the rows of an executed query in batches, which keeps memory bounded when the cursor
+        is an unbuffered one.
 
-        return results, dedup_hashes
+        :param cur: cursor with an executed query.
+        :param batch_size: number of rows read at once.
+        :return: an iterator over lists of rows.
+        """
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
 
+    @staticmethod
+    def _count_rows(rows: List[Tuple]) -> None:
+        """
+        Records a batch of rows read from the database in the metrics.
+        """
+        metrics = get_metrics()
+        metrics.count("db_batches")
+        metrics.count("db_rows", len(rows))
+        metrics.observe("db_batch_rows", len(rows))
 
     def return_matches_OLD(self, hashes: List[Tuple[str, int]],
                        batch_size: int = 1000) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
@@ -275,6 +654,7 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
         :param song_ids: song ids to be deleted from the database.
         :param batch_size: number of query's batches.
         """
+        self._mark_write()
         with self.cursor() as cur:
             for index in range(0, len(song_ids), batch_size):
                 # Create our IN part of the query
@@ -282,74 +662,79 @@ class CommonDatabase(BaseDatabase, metaclass=abc.ABCMeta):
 
                 cur.execute(query, song_ids[index: index + batch_size])
 
-    def return_matches_chunk(self, hashes_group, options) -> Tuple[List[Tuple[int, int]], Dict[int, int]]:
-        batch_size = 15000
+    def return_matches_chunk(self, hashes_group: Dict[int, Dict], options: Dict) -> Dict[int, Dict]:
         """
-        Searches the database for pairs of (hash, offset) values.
-        """
-        mapperFind = {}
-        for i, hashes in hashes_group.items():
-            mapper = {}
-            for hsh, offset in hashes['hashes']:
-                if hsh.upper() not in mapperFind:
-                    mapperFind[hsh.upper()] = [offset]
-                else:
-                    mapperFind[hsh.upper()].append(offset)
-                
-                if hsh.upper() not in mapper:
-                    mapper[hsh.upper()] = [offset]
-                else:
-                    mapper[hsh.upper()].append(offset)
-            hashes['mapper'] = mapper
-            hashes['hashList'] = list(mapper.keys())
-        
-        # for debug only: cut the number of hashes to be searched to 10
-        # mapperFind = dict(list(mapperFind.items())[:10])
-
-        values = list(mapperFind.keys())
-
-        ddbbResults = []
-        with self.cursor() as cur:
-            rangeSize = range(0, len(values), batch_size)
-            print('rangeSize: {}'.format(len(rangeSize)))
-
-            for index in rangeSize:
-                # PRINT DOTS EACH LOOP
-                print('.', end='', flush=True)
-
-                # Create our IN part of the query
-                song_filter = options.get('song_filter')
-                if song_filter and len(song_filter) > 0:
-                    song_filter_placeholders = ', '.join(['%s'] * len(song_filter))
-                    hash_placeholders = ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
-
-                    query = self.SELECT_MULTIPLE_FILTER_SONGS % (song_filter_placeholders, hash_placeholders)
-                    cur.execute(query, song_filter + values[index: index + batch_size])
-                else:
-                    query = self.SELECT_MULTIPLE % ', '.join([self.IN_MATCH] * len(values[index: index + batch_size]))
-                    cur.execute(query, values[index: index + batch_size])
+        Searches the database for pairs of (hash, offset) values of several chunks at once. Every distinct
+        hash is queried once, the rows returned are joined against the hashes of all chunks in a single pass
+        and the matches are counted per (chunk, song_id, offset_difference).
 
-                print(':', end='', flush=True)
-
-                for hsh, sid, offset in cur:
-                    ddbbResults.append((hsh, sid, offset))
+        :param hashes_group: dictionary of chunks, each one with its set of (hash, offset) tuples under 'hashes'.
+        :param options: query options, 'song_filter' restricts the search to a list of song ids and 'subset'
+         to a registered subset of the catalog.
+        :return: the same dictionary where each chunk gets a MatchAccumulator under 'matches' and the amount of
+         hashes matched in each song under 'dedup_hashes'.
+        """
+        batch_size = 15000
 
-        print('ddbbResults: {}'.format(len(ddbbResults)))
+        chunk_ids = list(hashes_group)
+        chunk_hashes = [list(hashes_group[i]['hashes']) for i in chunk_ids]
+        query_hashes = QueryHashes([hsh for hashes in chunk_hashes for hsh in hashes],
+                                   np.repeat(np.arange(len(chunk_ids)), [len(hashes) for hashes in chunk_hashes]))
 
-        for i, hashes in hashes_group.items():
-            print('processing {} of {}'.format(i, len(hashes_group)))
-            dedup_hashes = {}
-            results = []
-            hashSet = set(hashes['hashList'])
-            filtered_ddbbResults = [(hsh, sid, offset) for hsh, sid, offset in ddbbResults if hsh in hashSet]
-            print('filtered_ddbbResults: {}'.format(len(filtered_ddbbResults)))
-            for hsh, sid, offset in filtered_ddbbResults:
-                dedup_hashes[sid] = dedup_hashes.get(sid, 0) + 1
-                offsetSet = set([offset - song_sampled_offset for song_sampled_offset in hashes['mapper'][hsh]])
-                results.extend([(sid, offset) for offset in offsetSet])
+        # distinct hashes of all the chunks, they are queried once.
+        values = self._bloom_prefilter(query_hashes.values())
 
-            hashes['matches'] = results
-            hashes['dedup_hashes'] = dedup_hashes
+        song_filter = options.get('song_filter')
+        subset = options.get('subset')
+        bitmap = self._subset_bitmap(subset, song_filter)
 
+        metrics = get_metrics()
+        db_hashes, db_sids, db_offsets = [], [], []
+        with self.read_cursor(buffered=False) as cur:
+            for index in range(0, len(values), batch_size):
+                batch = values[index: index + batch_size]
+                with metrics.span("db_query", hashes=len(batch)) as span:
+                    self._select_matches(cur, batch, song_filter, subset)
+                    metrics.count("db_queries")
+                    metrics.count("db_hashes", len(batch))
+
+                    # keep the rows in columnar form instead of a list of tuples
+                    total_rows = 0
+                    for rows in self._fetch_batches(cur):
+                        self._count_rows(rows)
+                        total_rows += len(rows)
+                        columns = self._filter_subset(rows_to_columns(rows), bitmap)
+                        for column, column_values in zip((db_hashes, db_sids, db_offsets), columns):
+                            column.append(column_values)
+                    span.set(rows=total_rows)
+
+        db_hashes = np.concatenate(db_hashes) if db_hashes else np.empty(0, dtype=HASH_DTYPE)
+        db_sids = np.concatenate(db_sids) if db_sids else np.empty(0, dtype=np.int64)
+        db_offsets = np.concatenate(db_offsets) if db_offsets else np.empty(0, dtype=np.int64)
+
+        pair_rows, entries, _ = query_hashes.pairs(db_hashes)
+        groups = query_hashes.groups[entries]
+        histogram = grouped_histogram(groups, db_sids[pair_rows],
+                                      db_offsets[pair_rows] - query_hashes.offsets[entries])
+
+        # each row is counted once for every chunk its hash belongs to.
+        row_groups = np.unique(pair_rows * len(chunk_ids) + groups)
+        dedup_groups, dedup_sids, _, dedup_counts = grouped_histogram(row_groups % len(chunk_ids),
+                                                                      db_sids[row_groups // len(chunk_ids)],
+                                                                      np.zeros(row_groups.size, dtype=np.int64))
+
+        # both histograms are sorted by chunk, so every chunk is a slice of them.
+        bounds = np.searchsorted(histogram[0], np.arange(len(chunk_ids) + 1))
+        dedup_bounds = np.searchsorted(dedup_groups, np.arange(len(chunk_ids) + 1))
+        for group, i in enumerate(chunk_ids):
+            start, end = dedup_bounds[group], dedup_bounds[group + 1]
+            dedup_hashes = dict(zip(dedup_sids[start:end].tolist(), dedup_counts[start:end].tolist()))
+
+            start, end = bounds[group], bounds[group + 1]
+            matches = MatchAccumulator.from_histogram(histogram[1][start:end], histogram[2][start:end],
+                                                      histogram[3][start:end], dedup_hashes)
+
+            hashes_group[i]['matches'] = matches
+            hashes_group[i]['dedup_hashes'] = dedup_hashes
 
         return hashes_group
\ No newline at end of file
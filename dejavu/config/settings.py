@@ -20,6 +20,8 @@ INPUT_HASHES = 'input_total_hashes'
 INPUT_CONFIDENCE = 'input_confidence'
 
 TOTAL_TIME = 'total_time'
+# Huellas de la entrada realmente consultadas en la base de datos.
+QUERIED_HASHES = 'queried_hashes'
 AUDIO_DURATION = 'audio_duration'
 FINGERPRINT_TIME = 'fingerprint_time'
 QUERY_TIME = 'query_time'
@@ -30,8 +32,12 @@ OFFSET_SECS = 'offset_seconds'
 # INSTANCIAS DE CLASES DE BASE DE DATOS:
 DATABASES = {
     'mysql': ("dejavu.database_handler.mysql_database", "MySQLDatabase"),
+    # catálogo en la memoria del proceso, para pruebas de rendimiento sin servidor de base de datos.
+    'memory': ("dejavu.database_handler.memory_database", "MemoryDatabase"),
 }
 # 'postgres': ("dejavu.database_handler.postgres_database", "PostgreSQLDatabase")
+# Conexiones abiertas que se mantienen para reutilizar, por cada base de datos (primaria o réplica).
+DATABASE_POOL_SIZE = int(os.getenv('DJV_DATABASE_POOL_SIZE', 5))
 
 # TABLA SONGS
 SONGS_TABLENAME = "songs"
@@ -51,6 +57,12 @@ FINGERPRINTS_TABLENAME = "fingerprints"
 FIELD_HASH = 'hash'
 FIELD_OFFSET = 'offset'
 
+# TABLA SONG SUBSETS (subconjuntos del catálogo con nombre, p. ej. el repertorio licenciado de un cliente)
+SUBSETS_TABLENAME = "song_subsets"
+
+# CAMPOS DE SONG SUBSETS
+FIELD_SUBSET = 'subset_name'
+
 # CONFIGURACIÓN DE FINGERPRINTS:
 # Esto se utiliza como parámetro de conectividad para la función scipy.generate_binary_structure. Este parámetro
 # cambia la máscara de morfología al buscar los picos máximos en la matriz del espectrograma.
@@ -79,23 +91,23 @@ DEFAULT_FAN_VALUE = int(os.getenv('DJV_DEFAULT_FAN_VALUE', 15))  # 15 era el val
 # Amplitud mínima en el espectrograma para ser considerado un pico.
 # Esto puede aumentarse para reducir el número de huellas digitales, pero puede afectar negativamente
 # la precisión.
-DEFAULT_AMP_MIN = 10
+DEFAULT_AMP_MIN = int(os.getenv('DJV_DEFAULT_AMP_MIN', 10))
 
 # Número de celdas alrededor de un pico de amplitud en el espectrograma para
 # que Dejavu lo considere un pico espectral. Valores más altos significan menos
 # huellas digitales y emparejamiento más rápido, pero pueden afectar potencialmente la precisión.
-PEAK_NEIGHBORHOOD_SIZE = 10  # 20 era el valor original.
+PEAK_NEIGHBORHOOD_SIZE = int(os.getenv('DJV_PEAK_NEIGHBORHOOD_SIZE', 10))  # 20 era el valor original.
 
 # Umbrales de cuán cerca o lejos pueden estar las huellas digitales en el tiempo para
 # ser emparejadas como una huella digital. Si tu máximo es demasiado bajo, los valores más altos de
 # DEFAULT_FAN_VALUE pueden no funcionar como se esperaba.
-MIN_HASH_TIME_DELTA = 0
-MAX_HASH_TIME_DELTA = 200
+MIN_HASH_TIME_DELTA = int(os.getenv('DJV_MIN_HASH_TIME_DELTA', 0))
+MAX_HASH_TIME_DELTA = int(os.getenv('DJV_MAX_HASH_TIME_DELTA', 200))
 
 # Si es True, ordenará los picos temporalmente para la digitalización de huellas;
 # no ordenar reducirá la cantidad de huellas digitales, pero potencialmente
 # afectará el rendimiento.
-PEAK_SORT = True
+PEAK_SORT = bool(int(os.getenv('DJV_PEAK_SORT', 1)))
 
 # Número de bits para tomar del frente del hash SHA1 en el
 # cálculo de la huella digital. Cuantos más tomes, más almacenamiento en memoria,
@@ -107,5 +119,147 @@ TOPN = int(os.getenv('DJV_TOPN', 2))
 
 # Configuración de procesamiento por chunks
 CHUNK_SIZE = int(os.getenv('DJV_CHUNK_SIZE', 10))
+# Segundos que cada chunk comparte con el siguiente, debe ser menor que CHUNK_SIZE.
 CHUNK_OVERLAP = int(os.getenv('DJV_CHUNK_OVERLAP', 0))
-CHUNK_WORKERS = int(os.getenv('DJV_CHUNK_WORKERS', 10))
\ No newline at end of file
+CHUNK_WORKERS = int(os.getenv('DJV_CHUNK_WORKERS', 10))
+# Modo de generación de huellas por chunks:
+# 'chunk' genera las huellas de cada chunk por separado.
+# 'file' genera las huellas del fichero completo una sola vez y las reparte entre los chunks según su offset,
+# así el solapamiento no repite trabajo y los pares de picos que cruzan el límite de un chunk se conservan.
+CHUNK_FINGERPRINT_MODE = os.getenv('DJV_CHUNK_FINGERPRINT_MODE', 'chunk')
+# Ejecutor usado para generar las huellas de los chunks:
+# 'process' usa un pool persistente de procesos que leen el PCM de memoria compartida (escala con los cores),
+# 'thread' usa hilos (limitado por el GIL) e 'inline' procesa los chunks uno a uno en el hilo actual.
+CHUNK_EXECUTOR = os.getenv('DJV_CHUNK_EXECUTOR', 'thread')
+
+# Configuración de réplicas de lectura
+# Segundos tras la última escritura de esta instancia durante los cuales las lecturas siguen yendo a la
+# base de datos primaria, para no consultar réplicas que aún no han recibido las canciones recién insertadas.
+REPLICA_STALENESS = float(os.getenv('DJV_REPLICA_STALENESS', 5))
+# Si una canción no se encuentra en la réplica se vuelve a buscar en la primaria.
+REPLICA_FALLBACK_TO_PRIMARY = bool(int(os.getenv('DJV_REPLICA_FALLBACK_TO_PRIMARY', 1)))
+
+# Lectura de resultados de la base de datos
+# Número de filas que se leen de cada vez del cursor sin buffer al buscar coincidencias.
+MATCH_FETCH_SIZE = int(os.getenv('DJV_MATCH_FETCH_SIZE', 10000))
+# Número de pares (canción, diferencia de offset) pendientes a partir del cual se compactan en el histograma.
+MATCH_COMPACT_SIZE = int(os.getenv('DJV_MATCH_COMPACT_SIZE', 1000000))
+
+# Búsqueda progresiva
+# Si es True las huellas de la entrada se consultan por lotes, ordenadas por intensidad (la amplitud del más
+# débil de sus dos picos) y dejando para el final las más repetidas del catálogo (PROGRESSIVE_FREQUENT_HASHES),
+# y la búsqueda se detiene en cuanto la canción líder supera a la segunda por el margen indicado.
+PROGRESSIVE_MATCHING = bool(int(os.getenv('DJV_PROGRESSIVE_MATCHING', 0)))
+# Número de huellas consultadas en cada lote.
+PROGRESSIVE_BATCH_SIZE = int(os.getenv('DJV_PROGRESSIVE_BATCH_SIZE', 500))
+# Diferencia mínima de coincidencias alineadas entre la canción líder y la segunda para detenerse.
+PROGRESSIVE_MARGIN = int(os.getenv('DJV_PROGRESSIVE_MARGIN', 20))
+# Número mínimo de coincidencias alineadas de la canción líder para detenerse.
+PROGRESSIVE_MIN_COUNT = int(os.getenv('DJV_PROGRESSIVE_MIN_COUNT', 30))
+# Número de huellas más repetidas del catálogo (y sus apariciones) que se cargan para consultarlas al final,
+# 0 ordena los lotes solo por intensidad. Se cargan con una consulta agregada sobre toda la tabla la primera vez.
+PROGRESSIVE_FREQUENT_HASHES = int(os.getenv('DJV_PROGRESSIVE_FREQUENT_HASHES', 100000))
+
+# Búsqueda en dos etapas
+# Si es True primero se consulta una muestra de las huellas de la entrada para elegir las canciones candidatas
+# y después se consultan todas las huellas restringiendo la búsqueda a esas canciones.
+TWO_STAGE_MATCHING = bool(int(os.getenv('DJV_TWO_STAGE_MATCHING', 0)))
+# Fracción de las huellas de la entrada consultadas en la primera etapa.
+TWO_STAGE_SAMPLE_RATE = float(os.getenv('DJV_TWO_STAGE_SAMPLE_RATE', 0.1))
+# Número de canciones candidatas que pasan a la segunda etapa.
+TWO_STAGE_CANDIDATES = int(os.getenv('DJV_TWO_STAGE_CANDIDATES', 10))
+
+# Reconocimiento de streams
+# Segundos de audio (huellas ya generadas) que se consultan en cada búsqueda.
+STREAM_WINDOW = float(os.getenv('DJV_STREAM_WINDOW', 10))
+# Segundos de audio nuevo que deben llegar entre dos búsquedas consecutivas.
+STREAM_HOP = float(os.getenv('DJV_STREAM_HOP', 2))
+# Número mínimo de coincidencias alineadas para emitir un evento de detección.
+STREAM_MIN_MATCHES = int(os.getenv('DJV_STREAM_MIN_MATCHES', 10))
+
+# Línea de tiempo de detecciones
+# Diferencia máxima (en segundos) entre el inicio alineado de la canción en dos chunks para considerarlos
+# la misma reproducción.
+TIMELINE_OFFSET_TOLERANCE = float(os.getenv('DJV_TIMELINE_OFFSET_TOLERANCE', 1))
+# Hueco máximo (en segundos) sin detecciones de una canción antes de cerrar su segmento.
+TIMELINE_MAX_GAP = float(os.getenv('DJV_TIMELINE_MAX_GAP', 10))
+
+# Reconocimiento de archivos largos
+# Segundos de audio que se decodifican, reconocen y alinean de cada vez (se redondea a un número entero de chunks).
+ARCHIVE_WINDOW = float(os.getenv('DJV_ARCHIVE_WINDOW', 600))
+# Cada cuántas ventanas se guarda el punto de control para poder reanudar el reconocimiento.
+ARCHIVE_CHECKPOINT_INTERVAL = int(os.getenv('DJV_ARCHIVE_CHECKPOINT_INTERVAL', 1))
+
+# Subconjuntos del catálogo
+# 'server' filtra las huellas por subconjunto en la base de datos (JOIN con la tabla de subconjuntos),
+# 'memory' consulta sin filtrar y descarta las filas con un bitmap de song_id en memoria.
+SUBSET_FILTER = os.getenv('DJV_SUBSET_FILTER', 'server')
+
+# Servicio de reconocimiento (dejavu.py --serve)
+# Número máximo de reconocimientos simultáneos, las peticiones que lleguen por encima esperan su turno.
+SERVER_WORKERS = int(os.getenv('DJV_SERVER_WORKERS', 4))
+# Tamaño máximo (en MB) del cuerpo de una petición.
+SERVER_MAX_BODY = int(os.getenv('DJV_SERVER_MAX_BODY', 200))
+# Directorio bajo el cual deben estar los ficheros que se piden por su ruta ({"path": ...}), vacío desactiva
+# las peticiones por ruta, de modo que el servicio solo decodifica el audio que se le envía.
+SERVER_PATH_ROOT = os.getenv('DJV_SERVER_PATH_ROOT', '')
+
+# Agrupación de búsquedas concurrentes
+# Si es True las búsquedas de huellas de reconocimientos simultáneos (p. ej. en el servicio) se agrupan en
+# una sola consulta sin huellas repetidas, cuyas filas se reparten después entre los reconocimientos.
+LOOKUP_COALESCE = bool(int(os.getenv('DJV_LOOKUP_COALESCE', 0)))
+# Milisegundos que se espera a otras búsquedas antes de lanzar la consulta.
+LOOKUP_COALESCE_WINDOW = float(os.getenv('DJV_LOOKUP_COALESCE_WINDOW', 3))
+# Número de huellas a partir del cual la consulta se lanza sin esperar a que termine la ventana.
+LOOKUP_COALESCE_MAX_HASHES = int(os.getenv('DJV_LOOKUP_COALESCE_MAX_HASHES', 20000))
+
+# Caché de resultados de reconocimiento
+# Número máximo de resultados guardados en memoria (LRU), 0 desactiva la caché.
+RESULT_CACHE_SIZE = int(os.getenv('DJV_RESULT_CACHE_SIZE', 0))
+# Segundos durante los cuales un resultado guardado sigue siendo válido.
+RESULT_CACHE_TTL = float(os.getenv('DJV_RESULT_CACHE_TTL', 3600))
+# Directorio opcional donde también se guardan los resultados, compartido entre procesos y reinicios.
+RESULT_CACHE_DIR = os.getenv('DJV_RESULT_CACHE_DIR', '')
+# Tamaño máximo en megabytes de los resultados guardados en el directorio,
+# los usados hace más tiempo se borran antes.
+RESULT_CACHE_DIR_SIZE = float(os.getenv('DJV_RESULT_CACHE_DIR_SIZE', 256))
+
+# Reconocimiento de directorios (dejavu.py --recognize-dir)
+# Número máximo de ficheros, ya con sus huellas generadas, cuyas búsquedas se agrupan en una sola consulta.
+RECOGNIZE_DIR_BATCH_FILES = int(os.getenv('DJV_RECOGNIZE_DIR_BATCH_FILES', 8))
+
+# API asíncrona (recognize_async, return_matches_async)
+# Ejecutor de las etapas de CPU (decodificación y huellas): 'thread' o 'process'.
+ASYNC_CPU_EXECUTOR = os.getenv('DJV_ASYNC_CPU_EXECUTOR', 'thread')
+# Número de hilos o procesos del ejecutor de CPU.
+ASYNC_CPU_WORKERS = int(os.getenv('DJV_ASYNC_CPU_WORKERS', os.cpu_count() or 1))
+# Número de hilos dedicados a la entrada/salida con la base de datos, conviene que DJV_DATABASE_POOL_SIZE
+# sea del mismo orden para que cada hilo reutilice su conexión.
+ASYNC_IO_WORKERS = int(os.getenv('DJV_ASYNC_IO_WORKERS', 32))
+
+# Filtro de Bloom de huellas almacenadas
+# Fichero donde se guarda el filtro de Bloom de las huellas de la base de datos, vacío lo desactiva. Con el
+# filtro las huellas de la consulta que seguro que no están almacenadas se descartan antes de enviarla.
+BLOOM_FILTER_PATH = os.getenv('DJV_BLOOM_FILTER_PATH', '')
+# Fracción de huellas ausentes que el filtro deja pasar igualmente (falsos positivos).
+BLOOM_FILTER_ERROR_RATE = float(os.getenv('DJV_BLOOM_FILTER_ERROR_RATE', 0.01))
+# El filtro se dimensiona para este múltiplo de las huellas almacenadas, dejando sitio a las que se añadan.
+BLOOM_FILTER_GROWTH = float(os.getenv('DJV_BLOOM_FILTER_GROWTH', 2))
+# Capacidad mínima del filtro, para que uno creado sobre una base de datos vacía o pequeña no se llene enseguida.
+# Cuando las huellas añadidas superan la capacidad, el filtro se reconstruye desde la base de datos al guardarlo.
+BLOOM_FILTER_MIN_CAPACITY = int(os.getenv('DJV_BLOOM_FILTER_MIN_CAPACITY', 1000000))
+# Cada cuántos segundos se comprueba si otro proceso ha guardado un filtro más reciente para recargarlo.
+BLOOM_FILTER_RELOAD = float(os.getenv('DJV_BLOOM_FILTER_RELOAD', 60))
+
+# Métricas y trazas
+# Si es True se registran contadores, histogramas de cada etapa y trazas de cada reconocimiento, exportables
+# en JSON o en el formato de texto de Prometheus (GET /metrics en el servicio).
+METRICS = bool(int(os.getenv('DJV_METRICS', 0)))
+# Número de trazas de reconocimientos recientes que se guardan.
+METRICS_TRACES = int(os.getenv('DJV_METRICS_TRACES', 100))
+
+# Modo de perfilado (dejavu.py --profile)
+# Milisegundos entre dos muestras de las pilas de llamadas de todos los hilos.
+PROFILE_INTERVAL = float(os.getenv('DJV_PROFILE_INTERVAL', 5))
+# Si es True también se mide la memoria de cada etapa con tracemalloc, lo que ralentiza la ejecución.
+PROFILE_MEMORY = bool(int(os.getenv('DJV_PROFILE_MEMORY', 1)))
@@ -0,0 +1,170 @@
+import heapq
+from collections import defaultdict
+from datetime import datetime
+from itertools import count
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.config.settings import (BLOOM_FILTER_ERROR_RATE,
+                                    BLOOM_FILTER_GROWTH, FIELD_AUDIO_DURATION,
+                                    FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
+                                    FIELD_SONG_ID, FIELD_SONGNAME,
+                                    FIELD_TOTAL_HASHES)
+from dejavu.logic.bloom import BloomFilter
+from dejavu.logic.matches import in_bitmap, song_bitmap
+
+
+class MemoryCursor:
+    """
+    Stand-in for a database cursor, it holds the rows `_select_matches` left for `_fetch_batches` to read.
+    """
+    def __init__(self):
+        self.rows = []
+        # index of the first row not fetched yet, so fetching a batch doesn't copy the rows left.
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.rows = []
+        self.position = 0
+
+    def fetchmany(self, size: int) -> List[Tuple]:
+        rows = self.rows[self.position: self.position + size]
+        self.position += len(rows)
+        return rows
+
+
+class MemoryDatabase(CommonDatabase):
+    """
+    Catalog kept in the memory of the process, for benchmarks and tests that should not depend on a
+    running database server. Matching goes through the same code as the other databases, only the rows
+    come from a dictionary of hash => (song_id, offset) instead of a query. Nothing is persisted.
+    """
+    type = "memory"
+
+    def __init__(self, replicas: List[Dict] = None, **options):
+        """
+        Connection options are accepted, so any configuration works, and ignored.
+        """
+        super().__init__()
+        self._songs: Dict[int, Dict[str, any]] = {}
+        self._fingerprints: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self._ids = count(1)
+
+    def cursor(self, **options) -> MemoryCursor:
+        return MemoryCursor()
+
+    def empty(self) -> None:
+        self._songs.clear()
+        self._fingerprints.clear()
+        self._subsets.clear()
+
+    def delete_unfingerprinted_songs(self) -> None:
+        self.delete_songs_by_id([song_id for song_id, song in self._songs.items() if not song[FIELD_FINGERPRINTED]])
+
+    def get_num_songs(self) -> int:
+        return sum(1 for song in self._songs.values() if song[FIELD_FINGERPRINTED])
+
+    def get_num_fingerprints(self) -> int:
+        return sum(len(rows) for rows in self._fingerprints.values())
+
+    def set_song_fingerprinted(self, song_id):
+        self._songs[song_id][FIELD_FINGERPRINTED] = 1
+
+    def get_songs(self) -> List[Dict[str, str]]:
+        return [self._song_info(song) for song in self._songs.values() if song[FIELD_FINGERPRINTED]]
+
+    def get_songs_by_hashes(self, file_hashes: List[str], batch_size: int = 1000) -> Dict[str, Dict[str, str]]:
+        file_hashes = {file_hash.upper() for file_hash in file_hashes}
+        return {song[FIELD_FILE_SHA1]: self._song_info(song) for song in self._songs.values()
+                if song[FIELD_FINGERPRINTED] and song[FIELD_FILE_SHA1] in file_hashes}
+
+    def get_hash_frequencies(self, limit: int) -> Dict[str, int]:
+        counts = ((hsh, len(rows)) for hsh, rows in self._fingerprints.items() if len(rows) > 1)
+        return dict(heapq.nlargest(limit, counts, key=lambda count: count[1]))
+
+    def get_song_by_id(self, song_id: int) -> Dict[str, str]:
+        song = self._songs.get(song_id)
+        if song is None:
+            return None
+        return {name: song[name] for name in (FIELD_SONGNAME, FIELD_FILE_SHA1, FIELD_TOTAL_HASHES,
+                                              FIELD_AUDIO_DURATION)}
+
+    def insert(self, fingerprint: str, song_id: int, offset: int):
+        self.insert_hashes(song_id, [(fingerprint, offset)])
+
+    def insert_song(self, song_name: str, file_hash: str, total_hashes: int, audio_duration: int) -> int:
+        song_id = next(self._ids)
+        self._songs[song_id] = {
+            FIELD_SONG_ID: song_id,
+            FIELD_SONGNAME: song_name,
+            FIELD_FINGERPRINTED: 0,
+            FIELD_FILE_SHA1: file_hash.upper(),
+            FIELD_TOTAL_HASHES: total_hashes,
+            FIELD_AUDIO_DURATION: audio_duration,
+            "date_created": datetime.now()
+        }
+        return song_id
+
+    def query(self, fingerprint: str = None) -> List[Tuple]:
+        if fingerprint:
+            return list(self._fingerprints.get(fingerprint.upper(), []))
+        return [row for rows in self._fingerprints.values() for row in rows]
+
+    def insert_hashes(self, song_id: int, hashes: List[Tuple[str, int]], batch_size: int = 1000) -> None:
+        hashes = list(hashes)
+        for hsh, offset in hashes:
+            self._fingerprints[hsh.upper()].append((song_id, int(offset)))
+
+        if self.bloom is not None:
+            self.bloom.add(hsh for hsh, _ in hashes)
+            self._bloom_dirty = True
+
+    def delete_songs_by_id(self, song_ids: List[int], batch_size: int = 1000) -> None:
+        song_ids = set(song_ids)
+        for song_id in song_ids:
+            self._songs.pop(song_id, None)
+
+        for hsh in list(self._fingerprints):
+            rows = [row for row in self._fingerprints[hsh] if row[0] not in song_ids]
+            if rows:
+                self._fingerprints[hsh] = rows
+            else:
+                del self._fingerprints[hsh]
+
+    def build_bloom_filter(self, error_rate: float = BLOOM_FILTER_ERROR_RATE,
+                           growth: float = BLOOM_FILTER_GROWTH) -> BloomFilter:
+        bloom = BloomFilter(self._bloom_capacity(growth), error_rate)
+        bloom.add(self._fingerprints)
+        return bloom
+
+    def register_subset(self, name: str, song_ids: List[int]) -> None:
+        self._subsets[name] = song_bitmap(song_ids)
+
+    def delete_subset(self, name: str) -> None:
+        self._subsets.pop(name, None)
+
+    def get_subset(self, name: str) -> np.ndarray:
+        if name not in self._subsets or not self._subsets[name].any():
+            raise ValueError(f"Unknown or empty song subset: {name}")
+        return self._subsets[name]
+
+    def _select_matches(self, cur: MemoryCursor, values: List[str], song_filter: List[int] = None,
+                        subset: str = None) -> None:
+        rows = [(hsh, song_id, offset) for hsh in values for song_id, offset in self._fingerprints.get(hsh, ())]
+        if song_filter:
+            song_filter = set(song_filter)
+            rows = [row for row in rows if row[1] in song_filter]
+        elif subset and self.subset_filter == 'server' and rows:
+            keep = in_bitmap(self.get_subset(subset), np.array([row[1] for row in rows], dtype=np.int64))
+            rows = [row for row, inside in zip(rows, keep.tolist()) if inside]
+        cur.rows = rows
+        cur.position = 0
+
+    @staticmethod
+    def _song_info(song: Dict[str, any]) -> Dict[str, any]:
+        return {name: value for name, value in song.items() if name != FIELD_FINGERPRINTED}
@@ -1,14 +1,19 @@
 import queue
+from time import time
+from typing import Dict, List
 
+import numpy as np
 import pymysql
-from pymysql.err import DatabaseError
+from pymysql.constants import ER
+from pymysql.err import DatabaseError, ProgrammingError
 
 from dejavu.base_classes.common_database import CommonDatabase
-from dejavu.config.settings import (FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
+from dejavu.config.settings import (DATABASE_POOL_SIZE, FIELD_FILE_SHA1, FIELD_FINGERPRINTED,
                                     FIELD_HASH, FIELD_OFFSET, FIELD_SONG_ID,
                                     FIELD_SONGNAME, FIELD_TOTAL_HASHES,
-                                    FIELD_AUDIO_DURATION,
-                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME)
+                                    FIELD_AUDIO_DURATION, FIELD_SUBSET,
+                                    FINGERPRINTS_TABLENAME, SONGS_TABLENAME,
+                                    SUBSETS_TABLENAME)
 
 
 class MySQLDatabase(CommonDatabase):
@@ -27,6 +32,7 @@ class MySQLDatabase(CommonDatabase):
         ,   `date_modified` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
         ,   CONSTRAINT `pk_{SONGS_TABLENAME}_{FIELD_SONG_ID}` PRIMARY KEY (`{FIELD_SONG_ID}`)
         ,   CONSTRAINT `uq_{SONGS_TABLENAME}_{FIELD_SONG_ID}` UNIQUE KEY (`{FIELD_SONG_ID}`)
+        ,   INDEX `ix_{SONGS_TABLENAME}_{FIELD_FILE_SHA1}` (`{FIELD_FILE_SHA1}`)
         ) ENGINE=INNODB;
     """
 
@@ -45,6 +51,18 @@ class MySQLDatabase(CommonDatabase):
     ) ENGINE=INNODB;
     """
 
+    CREATE_SUBSETS_TABLE = f"""
+        CREATE TABLE IF NOT EXISTS `{SUBSETS_TABLENAME}` (
+            `{FIELD_SUBSET}` VARCHAR(100) NOT NULL
+        ,   `{FIELD_SONG_ID}` MEDIUMINT UNSIGNED NOT NULL
+        ,   `date_created` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ,   CONSTRAINT `pk_{SUBSETS_TABLENAME}_{FIELD_SUBSET}_{FIELD_SONG_ID}`
+                PRIMARY KEY (`{FIELD_SUBSET}`, `{FIELD_SONG_ID}`)
+        ,   CONSTRAINT `fk_{SUBSETS_TABLENAME}_{FIELD_SONG_ID}` FOREIGN KEY (`{FIELD_SONG_ID}`)
+                REFERENCES `{SONGS_TABLENAME}`(`{FIELD_SONG_ID}`) ON DELETE CASCADE
+    ) ENGINE=INNODB;
+    """
+
     # INSERTS (IGNORES DUPLICATES)
     INSERT_FINGERPRINT = f"""
         INSERT IGNORE INTO `{FINGERPRINTS_TABLENAME}` (
@@ -78,6 +96,18 @@ class MySQLDatabase(CommonDatabase):
         WHERE `{FIELD_SONG_ID}` IN (%s) AND `{FIELD_HASH}` IN (%s);
     """
 
+    # the subset name is the first parameter, the hashes go in the IN part.
+    SELECT_MULTIPLE_SUBSET = f"""
+        SELECT HEX(f.`{FIELD_HASH}`), f.`{FIELD_SONG_ID}`, f.`{FIELD_OFFSET}`
+        FROM `{FINGERPRINTS_TABLENAME}` f
+        INNER JOIN `{SUBSETS_TABLENAME}` s ON s.`{FIELD_SONG_ID}` = f.`{FIELD_SONG_ID}`
+        WHERE s.`{FIELD_SUBSET}` = %%s AND f.`{FIELD_HASH}` IN (%s);
+    """
+
+    SELECT_SUBSET = f"""
+        SELECT `{FIELD_SONG_ID}` FROM `{SUBSETS_TABLENAME}` WHERE `{FIELD_SUBSET}` = %s;
+    """
+
     SELECT_ALL = f"SELECT `{FIELD_SONG_ID}`, `{FIELD_OFFSET}` FROM `{FINGERPRINTS_TABLENAME}`;"
 
     SELECT_SONG = f"""
@@ -88,6 +118,17 @@ class MySQLDatabase(CommonDatabase):
 
     SELECT_NUM_FINGERPRINTS = f"SELECT COUNT(*) AS n FROM `{FINGERPRINTS_TABLENAME}`;"
 
+    SELECT_ALL_HASHES = f"SELECT HEX(`{FIELD_HASH}`) FROM `{FINGERPRINTS_TABLENAME}`;"
+
+    SELECT_HASH_FREQUENCIES = f"""
+        SELECT HEX(`{FIELD_HASH}`), COUNT(*) AS `n`
+        FROM `{FINGERPRINTS_TABLENAME}`
+        GROUP BY `{FIELD_HASH}`
+        HAVING `n` > 1
+        ORDER BY `n` DESC
+        LIMIT %s;
+    """
+
     SELECT_UNIQUE_SONG_IDS = f"""
         SELECT COUNT(`{FIELD_SONG_ID}`) AS n
         FROM `{SONGS_TABLENAME}`
@@ -106,9 +147,25 @@ class MySQLDatabase(CommonDatabase):
         WHERE `{FIELD_FINGERPRINTED}` = 1;
     """
 
+    SELECT_SONGS_BY_SHA1 = f"""
+        SELECT
+            `{FIELD_SONG_ID}`
+        ,   `{FIELD_SONGNAME}`
+        ,   HEX(`{FIELD_FILE_SHA1}`) AS `{FIELD_FILE_SHA1}`
+        ,   `{FIELD_TOTAL_HASHES}`
+        ,   `{FIELD_AUDIO_DURATION}`
+        FROM `{SONGS_TABLENAME}`
+        WHERE `{FIELD_FILE_SHA1}` IN (%s) AND `{FIELD_FINGERPRINTED}` = 1;
+    """
+
+    INSERT_SUBSET_SONG = f"""
+        INSERT IGNORE INTO `{SUBSETS_TABLENAME}` (`{FIELD_SUBSET}`, `{FIELD_SONG_ID}`) VALUES (%s, %s);
+    """
+
     # DROPS
     DROP_FINGERPRINTS = f"DROP TABLE IF EXISTS `{FINGERPRINTS_TABLENAME}`;"
     DROP_SONGS = f"DROP TABLE IF EXISTS `{SONGS_TABLENAME}`;"
+    DROP_SUBSETS = f"DROP TABLE IF EXISTS `{SUBSETS_TABLENAME}`;"
 
     # UPDATE
     UPDATE_SONG_FINGERPRINTED = f"""
@@ -124,13 +181,24 @@ class MySQLDatabase(CommonDatabase):
         DELETE FROM `{SONGS_TABLENAME}` WHERE `{FIELD_SONG_ID}` IN (%s);
     """
 
+    DELETE_SUBSET = f"""
+        DELETE FROM `{SUBSETS_TABLENAME}` WHERE `{FIELD_SUBSET}` = %s;
+    """
+
     # IN
     IN_MATCH = f"UNHEX(%s)"
 
-    def __init__(self, **options):
+    def __init__(self, replicas: List[Dict] = None, **options):
+        """
+        :param replicas: connection options of each read replica, any option not given is taken from
+         the primary ones.
+        :param options: connection options of the primary database.
+        """
         super().__init__()
         self.cursor = cursor_factory(**options)
         self._options = options
+        self._replicas = replicas or []
+        self.set_replicas([cursor_factory(**{**options, **replica}) for replica in self._replicas])
 
     def after_fork(self) -> None:
         Cursor.clear_cache()
@@ -146,16 +214,28 @@ class MySQLDatabase(CommonDatabase):
         :param audio_duration: duration of the audio file in milliseconds.
         :return: the inserted id.
         """
+        self._mark_write()
         with self.cursor() as cur:
             cur.execute(self.INSERT_SONG, (song_name, file_hash, total_hashes, audio_duration))
             return cur.lastrowid
 
+    def get_subset(self, name: str) -> np.ndarray:
+        try:
+            return super().get_subset(name)
+        except ProgrammingError as e:
+            # the subsets table is created by the first subset registered.
+            if e.args[0] != ER.NO_SUCH_TABLE:
+                raise
+            raise ValueError(f"Unknown or empty song subset: {name}")
+
     def __getstate__(self):
-        return self._options,
+        return self._options, self._replicas
 
     def __setstate__(self, state):
-        self._options, = state
+        self._options, self._replicas = state
+        CommonDatabase.__init__(self)
         self.cursor = cursor_factory(**self._options)
+        self.set_replicas([cursor_factory(**{**self._options, **replica}) for replica in self._replicas])
 
 
 def cursor_factory(**factory_options):
@@ -173,25 +253,41 @@ class Cursor(object):
         cur.execute(query)
         ...
     """
-    def __init__(self, dictionary=False, **options):
+    # connections are reused among every cursor of the process, with a pool for each database (primary
+    # or replica) so the connection options of a cached connection always match the requested ones.
+    _cache: Dict[tuple, queue.Queue] = {}
+    # seconds a connection may stay idle in the pool before it is checked (and reconnected) on reuse.
+    _idle_check = 60
+
+    def __init__(self, dictionary=False, buffered=True, **options):
         super().__init__()
 
-        self._cache = queue.Queue(maxsize=5)
+        key = tuple(sorted((name, repr(value)) for name, value in options.items()))
+        self._pool = self._cache.setdefault(key, queue.Queue(maxsize=DATABASE_POOL_SIZE))
 
         try:
-            conn = self._cache.get_nowait()
+            conn, released = self._pool.get_nowait()
+            if time() - released > self._idle_check:
+                conn.ping(reconnect=True)
         except queue.Empty:
             conn = pymysql.connect(**options)
 
         self.conn = conn
         self.dictionary = dictionary
+        # unbuffered cursors stream the rows from the server instead of loading the whole result set.
+        self.buffered = buffered
 
     @classmethod
     def clear_cache(cls):
-        cls._cache = queue.Queue(maxsize=5)
+        # forked processes must not share the sockets of the parent connections.
+        cls._cache = {}
 
     def __enter__(self):
-        self.cursor = self.conn.cursor(pymysql.cursors.DictCursor) if self.dictionary else self.conn.cursor()
+        if self.buffered:
+            cursor_class = pymysql.cursors.DictCursor if self.dictionary else pymysql.cursors.Cursor
+        else:
+            cursor_class = pymysql.cursors.SSDictCursor if self.dictionary else pymysql.cursors.SSCursor
+        self.cursor = self.conn.cursor(cursor_class)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
@@ -202,6 +298,6 @@ class Cursor(object):
         self.conn.commit()
 
         try:
-            self._cache.put_nowait(self.conn)
+            self._pool.put_nowait((self.conn, time()))
         except queue.Full:
             self.conn.close()
@@ -0,0 +1,139 @@
+from typing import Tuple
+
+import numpy as np
+
+from dejavu.config.settings import TOPN
+from dejavu.logic.matches import pack_keys, unpack_keys
+
+
+def _run_starts(*columns: np.ndarray) -> np.ndarray:
+    """
+    Given columns sorted together, flags the first row of every run of equal values.
+
+    :param columns: arrays of the same length.
+    :return: boolean mask with the first row of each run.
+    """
+    first = np.ones(columns[0].size, dtype=bool)
+    if columns[0].size:
+        first[1:] = False
+        for column in columns:
+            first[1:] |= column[1:] != column[:-1]
+    return first
+
+
+def offset_histogram(song_ids: np.ndarray, offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts how many times each (song_id, offset_difference) pair occurs.
+
+    :param song_ids: song identifier of each match.
+    :param offsets: offset difference of each match.
+    :return: a tuple of arrays with the distinct song ids, offset differences and their counts.
+    """
+    keys, counts = np.unique(pack_keys(np.asarray(song_ids), np.asarray(offsets)), return_counts=True)
+    return (*unpack_keys(keys), counts)
+
+
+def best_offsets(song_ids: np.ndarray, offsets: np.ndarray, counts: np.ndarray = None) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Keeps, for every song, the offset difference with the highest count. Ties are resolved in favour
+    of the lowest offset difference.
+
+    :param song_ids: song identifier of each match, or of each histogram bin if counts are given.
+    :param offsets: offset difference of each match or bin.
+    :param counts: occurrences of each bin, when not given every (song_id, offset) pair counts as one match.
+    :return: a tuple of arrays with the song ids (ascending), their best offset difference and its count.
+    """
+    if counts is None:
+        song_ids, offsets, counts = offset_histogram(song_ids, offsets)
+
+    song_ids, offsets, counts = np.asarray(song_ids), np.asarray(offsets), np.asarray(counts)
+    if song_ids.size == 0:
+        return song_ids, offsets, counts
+
+    # sort by song, then count descending and finally offset, the first row of each song is its best one.
+    order = np.lexsort((offsets, -counts, song_ids))
+    song_ids, offsets, counts = song_ids[order], offsets[order], counts[order]
+    first = _run_starts(song_ids)
+
+    return song_ids[first], offsets[first], counts[first]
+
+
+def top_matches(song_ids: np.ndarray, offsets: np.ndarray, counts: np.ndarray = None, topn: int = TOPN) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the songs whose best aligned offset gathered the most matches, ties are resolved in favour
+    of the lowest song id.
+
+    :param song_ids: song identifier of each match, or of each histogram bin if counts are given.
+    :param offsets: offset difference of each match or bin.
+    :param counts: occurrences of each bin, when not given every (song_id, offset) pair counts as one match.
+    :param topn: number of songs returned, none if it is not positive.
+    :return: a tuple of arrays with the song ids, their best offset difference and its count, sorted by
+     count descending.
+    """
+    song_ids, offsets, counts = best_offsets(song_ids, offsets, counts)
+    if topn <= 0:
+        return song_ids[:0], offsets[:0], counts[:0]
+
+    if topn < song_ids.size:
+        # every song tied with the topn-th count is a candidate so ties keep their order.
+        threshold = counts[np.argpartition(-counts, topn - 1)[:topn]].min()
+        candidates = np.flatnonzero(counts >= threshold)
+    else:
+        candidates = np.arange(song_ids.size)
+
+    order = candidates[np.lexsort((song_ids[candidates], -counts[candidates]))][:topn]
+
+    return song_ids[order], offsets[order], counts[order]
+
+
+def grouped_histogram(groups: np.ndarray, song_ids: np.ndarray, offsets: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts how many times each (group, song_id, offset_difference) triple occurs, for instance to align
+    every chunk of a file at once.
+
+    :param groups: group of each match.
+    :param song_ids: song identifier of each match.
+    :param offsets: offset difference of each match.
+    :return: a tuple of arrays with the distinct groups, song ids, offset differences and their counts,
+     sorted in that order.
+    """
+    order = np.lexsort((offsets, song_ids, groups))
+    groups, song_ids, offsets = groups[order], song_ids[order], offsets[order]
+    starts = np.flatnonzero(_run_starts(groups, song_ids, offsets))
+    counts = np.diff(np.append(starts, groups.size))
+
+    return groups[starts], song_ids[starts], offsets[starts], counts
+
+
+def grouped_top_matches(groups: np.ndarray, song_ids: np.ndarray, offsets: np.ndarray, counts: np.ndarray,
+                        topn: int = TOPN) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Same as `top_matches` but for several groups at once, the result of each group is the one `top_matches`
+    would give for its bins alone.
+
+    :param groups: group of each histogram bin.
+    :param song_ids: song identifier of each bin.
+    :param offsets: offset difference of each bin.
+    :param counts: occurrences of each bin.
+    :param topn: number of songs returned per group.
+    :return: a tuple of arrays with the groups (ascending), song ids, best offset differences and their counts,
+     within a group sorted by count descending.
+    """
+    # best offset of each song within each group.
+    order = np.lexsort((offsets, -counts, song_ids, groups))
+    groups, song_ids, offsets, counts = groups[order], song_ids[order], offsets[order], counts[order]
+    first = _run_starts(groups, song_ids)
+    groups, song_ids, offsets, counts = groups[first], song_ids[first], offsets[first], counts[first]
+
+    # rank the songs of each group and keep the topn ones.
+    order = np.lexsort((song_ids, -counts, groups))
+    groups, song_ids, offsets, counts = groups[order], song_ids[order], offsets[order], counts[order]
+    starts = np.flatnonzero(_run_starts(groups))
+    sizes = np.diff(np.append(starts, groups.size))
+    ranks = np.arange(groups.size) - np.repeat(starts, sizes)
+    keep = ranks < topn
+
+    return groups[keep], song_ids[keep], offsets[keep], counts[keep]
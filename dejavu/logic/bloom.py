@@ -0,0 +1,167 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+from dejavu.config.settings import BLOOM_FILTER_ERROR_RATE
+
+# hashes are processed in blocks of this size, so the (hashes, probes) index matrix stays small.
+_BLOCK_SIZE = 100000
+
+
+class BloomFilter:
+    """
+    Bloom filter over the fingerprint hashes stored in the database, used to drop the query hashes that
+    are certainly not stored before they are sent to it. It has no false negatives, so the matches found
+    are the same, and a `error_rate` fraction of the absent hashes still go through.
+
+    Hashes are already uniformly distributed, so the bit positions are derived from the hash bits
+    themselves (double hashing over its two halves) instead of hashing them again.
+    """
+    def __init__(self, capacity: int, error_rate: float = BLOOM_FILTER_ERROR_RATE):
+        """
+        :param capacity: number of hashes the filter is sized for, it may hold more at a higher error rate.
+        :param error_rate: fraction of absent hashes reported as present once `capacity` hashes are added.
+        """
+        capacity = max(int(capacity), 1)
+        self.capacity = capacity
+        self.size = max(int(-capacity * np.log(error_rate) / np.log(2) ** 2), 64)
+        self.probes = max(int(round(self.size / capacity * np.log(2))), 1)
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+        # hashes checked and hashes that passed the filter.
+        self.checked = 0
+        self.passed = 0
+
+    def add(self, hashes: Iterable[str]) -> None:
+        """
+        Adds hashes to the filter.
+
+        :param hashes: hashes in hexadecimal format.
+        """
+        hashes = list(hashes)
+        for index in range(0, len(hashes), _BLOCK_SIZE):
+            positions = self._positions(hashes[index: index + _BLOCK_SIZE]).ravel()
+            np.bitwise_or.at(self.bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+        self.count += len(hashes)
+
+    def contains(self, hashes: List[str]) -> np.ndarray:
+        """
+        :param hashes: hashes in hexadecimal format.
+        :return: boolean mask of the hashes that may be stored, False ones are certainly not.
+        """
+        mask = np.empty(len(hashes), dtype=bool)
+        for index in range(0, len(hashes), _BLOCK_SIZE):
+            positions = self._positions(hashes[index: index + _BLOCK_SIZE])
+            mask[index: index + _BLOCK_SIZE] = ((self.bits[positions >> 3] >> (positions & 7)) & 1).all(axis=1)
+
+        self.checked += len(hashes)
+        self.passed += int(mask.sum())
+        return mask
+
+    def merge(self, other: "BloomFilter") -> bool:
+        """
+        Adds the hashes of another filter to this one.
+
+        :param other: filter of the same size and number of probes.
+        :return: False, leaving this filter as it was, if the other one is sized differently.
+        """
+        if (other.size, other.probes) != (self.size, self.probes):
+            return False
+        self.bits |= other.bits
+        self.count = self._estimate_count()
+        return True
+
+    def _estimate_count(self) -> int:
+        # hashes added to the filters merged can overlap, so their number is estimated from the bits set.
+        bits_set = int(np.unpackbits(self.bits)[:self.size].sum())
+        if bits_set >= self.size:
+            return self.count
+        return int(round(-self.size / self.probes * np.log(1 - bits_set / self.size)))
+
+    def _positions(self, hashes: List[str]) -> np.ndarray:
+        if not hashes:
+            return np.empty((0, self.probes), dtype=np.uint64)
+
+        width = max(len(hsh) for hsh in hashes)
+        width += width % 2
+        data = np.frombuffer(bytes.fromhex(''.join(hsh.zfill(width) for hsh in hashes)), dtype=np.uint8)
+        data = data.reshape(len(hashes), width // 2)
+
+        # each half of the hash (up to 64 bits) gives one of the two base values of the double hashing.
+        half = max(data.shape[1] // 2, 1)
+        first = self._word(data[:, :half][:, -8:])
+        second = self._word(data[:, half:][:, -8:]) | np.uint64(1)
+
+        probes = np.arange(self.probes, dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            return (first[:, None] + probes[None, :] * second[:, None]) % np.uint64(self.size)
+
+    @staticmethod
+    def _word(columns: np.ndarray) -> np.ndarray:
+        word = np.zeros(columns.shape[0], dtype=np.uint64)
+        for column in range(columns.shape[1]):
+            word = (word << np.uint64(8)) | columns[:, column].astype(np.uint64)
+        return word
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: hashes added, size in bytes, hashes checked and the fraction of them that passed the filter.
+        """
+        return {
+            "hashes": self.count,
+            "bytes": self.bits.nbytes,
+            "checked": self.checked,
+            "pass_ratio": self.passed / self.checked if self.checked else 0
+        }
+
+    def save(self, path: str, merge: bool = False) -> float:
+        """
+        Saves the filter, replacing the previous file atomically so a running process never loads it half
+        written. Processes saving the same file take turns through a lock file next to it.
+
+        :param path: file to save the filter to.
+        :param merge: if True, the hashes of the filter already saved are added to this one first, so the
+         hashes other processes added and saved are not lost.
+        :return: the modification time of the file saved, None without saving if `merge` is True and the
+         filter saved is sized differently.
+        """
+        with _locked(path):
+            if merge and os.path.exists(path) and not self.merge(BloomFilter.load(path)):
+                return None
+
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, np.array([self.size, self.probes, self.count, self.capacity], dtype=np.int64))
+                np.save(f, self.bits)
+            os.replace(tmp, path)
+            return os.path.getmtime(path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """
+        :param path: file saved by `save`.
+        :return: the filter.
+        """
+        bloom = cls.__new__(cls)
+        with open(path, "rb") as f:
+            header = [int(value) for value in np.load(f)]
+            bloom.bits = np.load(f)
+        bloom.size, bloom.probes, bloom.count = header[:3]
+        # files saved before the capacity was stored are taken as full.
+        bloom.capacity = header[3] if len(header) > 3 else bloom.count
+        bloom.checked = 0
+        bloom.passed = 0
+        return bloom
+
+
+@contextmanager
+def _locked(path: str):
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
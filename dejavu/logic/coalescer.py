@@ -0,0 +1,157 @@
+import threading
+from collections import deque
+from time import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import (LOOKUP_COALESCE_MAX_HASHES,
+                                    LOOKUP_COALESCE_WINDOW)
+from dejavu.logic.matches import MatchAccumulator, QueryHashes
+
+
+class _Batch:
+    """
+    Lookups waiting to be sent to the database together.
+    """
+    def __init__(self):
+        self.queries: List[Tuple[QueryHashes, MatchAccumulator]] = []
+        self.hashes = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.started = None
+        self.looked_up = 0
+        self.error = None
+
+
+class LookupCoalescer:
+    """
+    Merges the `return_matches` lookups of concurrent recognitions. The first lookup opens a batch and waits
+    `window` milliseconds (or until the batch holds `max_hashes` hashes) for others with the same filters,
+    then the distinct hashes of the whole batch are looked up with a single query and the rows are
+    demultiplexed to the accumulator of each lookup, so hot hashes shared by several requests are read
+    once and the database sees fewer, larger queries.
+
+    It has the same `return_matches` as the databases, so it can be used in their place.
+    """
+    def __init__(self, db, window: float = LOOKUP_COALESCE_WINDOW, max_hashes: int = LOOKUP_COALESCE_MAX_HASHES,
+                 history: int = 1000):
+        """
+        :param db: database the batches are looked up on.
+        :param window: milliseconds a batch waits for more lookups.
+        :param max_hashes: amount of hashes that closes a batch before its window is over.
+        :param history: number of recent lookups kept for the latency statistics.
+        """
+        self.db = db
+        self.window = window / 1000
+        self.max_hashes = max_hashes
+
+        self._lock = threading.Lock()
+        self._open: Dict[tuple, _Batch] = {}
+        self._local = threading.local()
+
+        self._requests = 0
+        self._batches = 0
+        self._request_hashes = 0
+        self._batch_hashes = 0
+        # (wait, total) seconds of the recent lookups.
+        self._latencies = deque(maxlen=history)
+
+    def return_matches(self, hashes: List[Tuple[str, int]], matches: MatchAccumulator = None,
+                       song_filter: List[int] = None, subset: str = None) -> Tuple[MatchAccumulator, Dict[int, int]]:
+        """
+        Searches the database for pairs of (hash, offset) values, together with the concurrent lookups.
+        Arguments and result are the ones of the database `return_matches`.
+        """
+        t = time()
+        query_hashes = QueryHashes(hashes)
+        matches = MatchAccumulator() if matches is None else matches
+        if len(query_hashes) == 0:
+            return matches, matches.dedup_hashes
+
+        # only lookups with the same filters can share a query.
+        key = (tuple(sorted(song_filter)) if song_filter else None, subset)
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self._open[key] = batch
+            batch.queries.append((query_hashes, matches))
+            batch.hashes += len(query_hashes)
+            if batch.hashes >= self.max_hashes:
+                del self._open[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            self._run(batch, song_filter, subset)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+
+        wait, total = batch.started - t, time() - t
+        self._local.last = {"wait": wait, "total": total, "batch_requests": len(batch.queries),
+                            "batch_hashes": batch.looked_up}
+        with self._lock:
+            self._requests += 1
+            self._request_hashes += len(query_hashes)
+            self._latencies.append((wait, total))
+
+        return matches, matches.dedup_hashes
+
+    def _run(self, batch: _Batch, song_filter: List[int], subset: str) -> None:
+        batch.started = time()
+        try:
+            batch.looked_up = self.db.return_matches_batch(batch.queries, song_filter, subset)
+            with self._lock:
+                self._batches += 1
+                self._batch_hashes += batch.looked_up
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def reset_request(self) -> None:
+        """
+        Forgets the last lookup of the calling thread, to be called when the thread starts a new request so
+        `last_request` doesn't report a lookup made for a previous one.
+        """
+        self._local.last = None
+
+    def last_request(self) -> Dict[str, float]:
+        """
+        :return: the statistics of the last lookup made by the calling thread: seconds waiting for the batch
+         to be sent, total seconds, and requests and distinct hashes of its batch. None if there was none
+         since the last `reset_request`.
+        """
+        return getattr(self._local, "last", None)
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: lookups and batches made so far, the average size of the batches, the ratio of hashes
+         saved by deduplication and the percentiles of the recent lookup latencies, in seconds.
+        """
+        with self._lock:
+            latencies = np.array(self._latencies).reshape(-1, 2)
+            stats = {
+                "requests": self._requests,
+                "batches": self._batches,
+                "requests_per_batch": self._requests / self._batches if self._batches else 0,
+                "hashes_per_batch": self._batch_hashes / self._batches if self._batches else 0,
+                "dedup_ratio": self._request_hashes / self._batch_hashes if self._batch_hashes else 0
+            }
+
+        for name, column in (("wait", 0), ("latency", 1)):
+            values = latencies[:, column]
+            stats[name] = {
+                "p50": float(np.percentile(values, 50)) if values.size else 0,
+                "p95": float(np.percentile(values, 95)) if values.size else 0,
+                "max": float(values.max()) if values.size else 0
+            }
+        return stats
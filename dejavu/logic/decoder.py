@@ -1,5 +1,6 @@
 import fnmatch
 import os
+import wave
 from hashlib import sha1
 from typing import List, Tuple
 
@@ -7,6 +8,7 @@ import numpy as np
 from pydub import AudioSegment
 from pydub.utils import audioop
 
+from dejavu.logic.metrics import get_metrics
 from dejavu.third_party import wavio
 
 
@@ -65,36 +67,68 @@ def read(file_name: str, limit: int = None) -> Tuple[List[List[int]], int, str]:
     :param limit: number of seconds to limit.
     :return: tuple list of (channels, sample_rate, content_file_hash).
     """
-    # pydub does not support 24-bit wav files, use wavio when this occurs
-    try:
-        audiofile = AudioSegment.from_file(file_name)
-        song_duration = len(audiofile)
+    with get_metrics().span("decode"):
+        # pydub does not support 24-bit wav files, use wavio when this occurs
+        try:
+            audiofile = AudioSegment.from_file(file_name)
+            song_duration = len(audiofile)
+
+            if limit:
+                audiofile = audiofile[:limit * 1000]
+
+            data = np.frombuffer(audiofile.raw_data, np.int16)
+
+            channels = []
+            for chn in range(audiofile.channels):
+                channels.append(data[chn::audiofile.channels])
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+            audiofile.frame_rate
+        except audioop.error:
+            _, _, audiofile = wavio.readwav(file_name)
 
-        data = np.fromstring(audiofile.raw_data, np.int16)
+            if limit:
+                audiofile = audiofile[:limit * 1000]
 
-        channels = []
-        for chn in range(audiofile.channels):
-            channels.append(data[chn::audiofile.channels])
+            audiofile = audiofile.T
+            audiofile = audiofile.astype(np.int16)
 
-        audiofile.frame_rate
-    except audioop.error:
-        _, _, audiofile = wavio.readwav(file_name)
+            song_duration = len(audiofile[0]) / audiofile[1][0]
+            channels = []
+            for chn in audiofile:
+                channels.append(chn)
 
-        if limit:
-            audiofile = audiofile[:limit * 1000]
+        return channels, audiofile.frame_rate, unique_hash(file_name), song_duration
 
-        audiofile = audiofile.T
-        audiofile = audiofile.astype(np.int16)
 
-        song_duration = len(audiofile[0]) / audiofile[1][0]
-        channels = []
-        for chn in audiofile:
-            channels.append(chn)
+def read_window(file_name: str, start: float, duration: float) -> Tuple[List[np.ndarray], int]:
+    """
+    Reads a window of a file, without loading the rest of it, so long files can be processed piece by piece.
+    16 bits wav files are read directly and any other format is cut by ffmpeg while decoding.
 
-    return channels, audiofile.frame_rate, unique_hash(file_name), song_duration
+    :param file_name: file to be read.
+    :param start: second of the file where the window starts.
+    :param duration: seconds of the window.
+    :return: tuple of (channels, sample_rate), channels are shorter than the window at the end of the file
+     and empty after it.
+    """
+    try:
+        with wave.open(file_name, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise wave.Error("not a 16 bits wav file")
+
+            frame_rate, nchannels = wav.getframerate(), wav.getnchannels()
+            first = int(start * frame_rate)
+            if first < wav.getnframes():
+                wav.setpos(first)
+                data = np.frombuffer(wav.readframes(int(duration * frame_rate)), np.int16)
+            else:
+                data = np.empty(0, np.int16)
+    except (wave.Error, EOFError):
+        audiofile = AudioSegment.from_file(file_name, start_second=start, duration=duration)
+        frame_rate, nchannels = audiofile.frame_rate, audiofile.channels
+        data = np.frombuffer(audiofile.raw_data, np.int16)
+
+    return [data[chn::nchannels] for chn in range(nchannels)], frame_rate
 
 
 def get_audio_name_from_path(file_path: str) -> str:
@@ -0,0 +1,161 @@
+import atexit
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from multiprocessing import resource_tracker, shared_memory, synchronize
+from time import time
+from typing import List, Set, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import CHUNK_WORKERS, DEFAULT_FS
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.matches import HASH_DTYPE
+
+# persistent pool of worker processes, shared by every recognition made in this process.
+_process_pool = None
+_process_pool_workers = 0
+# seconds a starting worker waits for the rest of the pool before giving up on it.
+_STARTUP_TIMEOUT = 60
+
+
+def _init_worker(barrier: synchronize.Barrier) -> None:
+    # fingerprints a second of noise so the spectrogram, peak finding and hashing code paths (and whatever
+    # numpy and scipy load lazily for them) are ready before the first chunk arrives.
+    fingerprint(np.random.RandomState(0).randint(-2 ** 15, 2 ** 15, DEFAULT_FS, dtype=np.int16), Fs=DEFAULT_FS)
+    # no worker takes a task until every worker has started, so the pool can't keep reusing the first ones.
+    try:
+        barrier.wait(_STARTUP_TIMEOUT)
+    except threading.BrokenBarrierError:
+        pass
+
+
+def _started() -> int:
+    return os.getpid()
+
+
+def get_process_pool(workers: int = CHUNK_WORKERS) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Returns the persistent process pool, creating it the first time. Every worker is started and warmed up
+    (see `_init_worker`) right away so the first file does not pay for it.
+
+    :param workers: number of worker processes.
+    :return: a ProcessPoolExecutor.
+    """
+    global _process_pool, _process_pool_workers
+
+    if _process_pool is None or _process_pool_workers != workers:
+        shutdown_process_pool()
+        # workers must share our resource tracker, otherwise each one would take the shared memory blocks
+        # it attaches to as its own and try to release them when it exits.
+        resource_tracker.ensure_running()
+        _process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                              initargs=(multiprocessing.Barrier(workers),))
+        _process_pool_workers = workers
+        # one task per worker: none of them finishes before all the workers are up and warm.
+        for future in [_process_pool.submit(_started) for _ in range(workers)]:
+            future.result()
+
+    return _process_pool
+
+
+def shutdown_process_pool() -> None:
+    """
+    Stops the persistent process pool, if any.
+    """
+    global _process_pool, _process_pool_workers
+
+    if _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+        _process_pool_workers = 0
+
+
+atexit.register(shutdown_process_pool)
+
+
+class SharedChannels:
+    """
+    Copies the decoded channels into a shared memory block, so worker processes read the PCM they need
+    instead of receiving it pickled.
+    """
+    def __init__(self, channels: List[np.ndarray]):
+        samples = min(len(channel) for channel in channels)
+        self.shape = (len(channels), samples)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(len(channels) * samples * 2, 1))
+        self.name = self._shm.name
+
+        array = np.ndarray(self.shape, dtype=np.int16, buffer=self._shm.buf)
+        for i, channel in enumerate(channels):
+            array[i] = channel[:samples]
+        del array
+
+    def __enter__(self) -> "SharedChannels":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._shm.close()
+        self._shm.unlink()
+
+
+def hashes_to_columns(hashes: Set[Tuple[str, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Packs a set of (hash, offset) tuples into two arrays, which are much cheaper to send between processes.
+
+    :param hashes: set of (hash, offset) tuples.
+    :return: a tuple of arrays with the hashes and the offsets.
+    """
+    if not hashes:
+        return np.empty(0, dtype=HASH_DTYPE), np.empty(0, dtype=np.int32)
+
+    values, offsets = zip(*hashes)
+    return np.array(values, dtype=HASH_DTYPE), np.array(offsets, dtype=np.int32)
+
+
+def columns_to_hashes(values: np.ndarray, offsets: np.ndarray) -> Set[Tuple[str, int]]:
+    """
+    Inverse of `hashes_to_columns`.
+
+    :param values: array of hashes.
+    :param offsets: array of offsets.
+    :return: set of (hash, offset) tuples.
+    """
+    return set(zip(np.char.decode(values).tolist(), offsets.tolist()))
+
+
+def fingerprint_shared_chunk(shm_name: str, shape: Tuple[int, int], start: int, stop: int, frame_rate: int) \
+        -> Tuple[Tuple[np.ndarray, np.ndarray], List[float], float]:
+    """
+    Fingerprints the samples [start, stop) of every channel held in a `SharedChannels` block. Meant to run
+    on a worker process.
+
+    :param shm_name: name of the shared memory block.
+    :param shape: (channels, samples) of the block.
+    :param start: first sample of the chunk.
+    :param stop: sample after the last one of the chunk.
+    :param frame_rate: sampling rate.
+    :return: a tuple with the hashes as returned by `hashes_to_columns`, the fingerprint time of each channel
+     and the total processing time.
+    """
+    t = time()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        channels = np.ndarray(shape, dtype=np.int16, buffer=shm.buf)
+        # the chunk is copied so no view of the block outlives it.
+        chunk = [np.array(channels[i, start:stop]) for i in range(shape[0])]
+        del channels
+    finally:
+        shm.close()
+
+    fingerprint_times = []
+    hashes = set()  # to remove possible duplicated fingerprints we built a set.
+    for channel in chunk:
+        t_channel = time()
+        hashes |= set(fingerprint(channel, Fs=frame_rate))
+        fingerprint_times.append(time() - t_channel)
+
+    return hashes_to_columns(hashes), fingerprint_times, time() - t
@@ -16,6 +16,7 @@ from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
                                     FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
                                     MIN_HASH_TIME_DELTA,
                                     PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT)
+from dejavu.logic.metrics import get_metrics
 
 
 def fingerprint(channel_samples: List[int],
@@ -23,7 +24,8 @@ def fingerprint(channel_samples: List[int],
                 wsize: int = DEFAULT_WINDOW_SIZE,
                 wratio: float = DEFAULT_OVERLAP_RATIO,
                 fan_value: int = DEFAULT_FAN_VALUE,
-                amp_min: int = DEFAULT_AMP_MIN) -> List[Tuple[str, int]]:
+                amp_min: int = DEFAULT_AMP_MIN,
+                with_strength: bool = False) -> List[Tuple[str, int]]:
     """
     FFT the channel, log transform output, find local maxima, then return locally sensitive hashes.
 
@@ -33,8 +35,38 @@ def fingerprint(channel_samples: List[int],
     :param wratio: ratio by which each sequential window overlaps the last and the next window.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param with_strength: if True each hash also carries its strength, see `generate_hashes`.
     :return: a list of hashes with their corresponding offsets.
     """
+    metrics = get_metrics()
+    with metrics.span("spectrogram"):
+        arr2D = spectrogram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
+
+    with metrics.span("peaks") as span:
+        local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min, with_amplitude=with_strength)
+        span.set(peaks=len(local_maxima))
+
+    # return hashes
+    with metrics.span("hashing") as span:
+        hashes = generate_hashes(local_maxima, fan_value=fan_value, with_strength=with_strength)
+        span.set(hashes=len(hashes))
+    metrics.count("hashes_generated", len(hashes))
+    return hashes
+
+
+def spectrogram(channel_samples: List[int],
+                Fs: int = DEFAULT_FS,
+                wsize: int = DEFAULT_WINDOW_SIZE,
+                wratio: float = DEFAULT_OVERLAP_RATIO) -> np.array:
+    """
+    FFT the channel and log transform the output.
+
+    :param channel_samples: channel samples to transform.
+    :param Fs: audio sampling rate.
+    :param wsize: FFT windows size.
+    :param wratio: ratio by which each sequential window overlaps the last and the next window.
+    :return: matrix representing the spectrogram, frequencies by time.
+    """
     # FFT the signal and extract frequency components
     arr2D = mlab.specgram(
         channel_samples,
@@ -44,15 +76,10 @@ def fingerprint(channel_samples: List[int],
         noverlap=int(wsize * wratio))[0]
 
     # Apply log transform since specgram function returns linear array. 0s are excluded to avoid np warning.
-    arr2D = 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
+    return 10 * np.log10(arr2D, out=np.zeros_like(arr2D), where=(arr2D != 0))
 
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
 
-    # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
-
-
-def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN)\
+def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP_MIN, with_amplitude: bool = False)\
         -> List[Tuple[List[int], List[int]]]:
     """
     Extract maximum peaks from the spectogram matrix (arr2D).
@@ -60,6 +87,7 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
     :param arr2D: matrix representing the spectogram.
     :param plot: for plotting the results.
     :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+    :param with_amplitude: if True the amplitude of each peak is appended after its time.
     :return: a list composed by a list of frequencies and times.
     """
     # Original code from the repo is using a morphology mask that does not consider diagonal elements
@@ -104,6 +132,7 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
 
     freqs_filter = freqs[filter_idxs]
     times_filter = times[filter_idxs]
+    amps_filter = amps[filter_idxs]
 
     if plot:
         # scatter of the peaks
@@ -116,10 +145,14 @@ def get_2D_peaks(arr2D: np.array, plot: bool = False, amp_min: int = DEFAULT_AMP
         plt.gca().invert_yaxis()
         plt.show()
 
+    if with_amplitude:
+        return list(zip(freqs_filter, times_filter, amps_filter))
+
     return list(zip(freqs_filter, times_filter))
 
 
-def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE) -> List[Tuple[str, int]]:
+def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_VALUE,
+                    with_strength: bool = False) -> List[Tuple[str, int]]:
     """
     Hash list structure:
        sha1_hash[0:FINGERPRINT_REDUCTION]    time_offset
@@ -127,12 +160,16 @@ def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_V
 
     :param peaks: list of peak frequencies and times.
     :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+    :param with_strength: if True peaks must carry their amplitude (see `get_2D_peaks`) and each hash gets
+     a third element, the amplitude of the weaker of its two peaks.
     :return: a list of hashes with their corresponding offsets.
     """
     # frequencies are in the first position of the tuples
     idx_freq = 0
     # times are in the second position of the tuples
     idx_time = 1
+    # amplitudes, when present, are in the third position of the tuples
+    idx_amp = 2
 
     if PEAK_SORT:
         peaks.sort(key=itemgetter(1))
@@ -151,6 +188,10 @@ def generate_hashes(peaks: List[Tuple[int, int]], fan_value: int = DEFAULT_FAN_V
                 if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
                     h = hashlib.sha1(f"{str(freq1)}|{str(freq2)}|{str(t_delta)}".encode('utf-8'))
 
-                    hashes.append((h.hexdigest()[0:FINGERPRINT_REDUCTION], t1))
+                    if with_strength:
+                        strength = min(peaks[i][idx_amp], peaks[i + j][idx_amp])
+                        hashes.append((h.hexdigest()[0:FINGERPRINT_REDUCTION], t1, strength))
+                    else:
+                        hashes.append((h.hexdigest()[0:FINGERPRINT_REDUCTION], t1))
 
     return hashes
@@ -0,0 +1,244 @@
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from dejavu.config.settings import FINGERPRINT_REDUCTION, MATCH_COMPACT_SIZE
+
+# numpy dtype used to hold hexadecimal hashes in columnar form.
+HASH_DTYPE = f"S{FINGERPRINT_REDUCTION}"
+
+# offset differences can be negative, they are shifted by this amount before being packed next to the song id.
+OFFSET_BIAS = 1 << 31
+
+
+def pack_keys(song_ids: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    Packs song ids and offset differences into a single int64 key which sorts as (song_id, offset).
+
+    :param song_ids: array of song identifiers.
+    :param offsets: array of offset differences.
+    :return: array of packed keys.
+    """
+    return (song_ids.astype(np.int64) << 32) + (offsets.astype(np.int64) + OFFSET_BIAS)
+
+
+def unpack_keys(keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Inverse of `pack_keys`.
+
+    :param keys: array of packed keys.
+    :return: a tuple with the song ids and the offset differences.
+    """
+    return keys >> 32, (keys & 0xFFFFFFFF) - OFFSET_BIAS
+
+
+def sample_hashes(hashes: Iterable[Tuple[str, int]], rate: float) -> List[Tuple[str, int]]:
+    """
+    Picks a deterministic subset of the hashes. Hashes are already uniformly distributed, so their last
+    hexadecimal digits decide whether they are kept, which means the same audio always gives the same sample.
+
+    :param hashes: A sequence of tuples in the format (hash, offset).
+    :param rate: fraction of the hashes to keep, between 0 and 1.
+    :return: the sampled (hash, offset) tuples.
+    """
+    threshold = int(rate * 0x10000)
+    return [(hsh, offset) for hsh, offset in hashes if int(hsh[-4:], 16) < threshold]
+
+
+def rows_to_columns(rows: List[Tuple[str, int, int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Turns the (hash, song_id, offset) rows returned by the database into arrays.
+
+    :param rows: rows returned by the database.
+    :return: a tuple of arrays with the hashes, the song ids and the offsets.
+    """
+    if not rows:
+        return np.empty(0, dtype=HASH_DTYPE), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    hashes, song_ids, offsets = zip(*rows)
+    return (np.array(hashes, dtype=HASH_DTYPE), np.array(song_ids, dtype=np.int64),
+            np.array(offsets, dtype=np.int64))
+
+
+def song_bitmap(song_ids: Iterable[int]) -> np.ndarray:
+    """
+    Builds a bitmap over song ids, so membership of many rows is checked at once with `in_bitmap`.
+
+    :param song_ids: song ids in the set.
+    :return: boolean array indexed by song id.
+    """
+    song_ids = np.fromiter(song_ids, dtype=np.int64)
+    bitmap = np.zeros(song_ids.max() + 1 if song_ids.size else 0, dtype=bool)
+    bitmap[song_ids] = True
+    return bitmap
+
+
+def in_bitmap(bitmap: np.ndarray, song_ids: np.ndarray) -> np.ndarray:
+    """
+    :param bitmap: bitmap built by `song_bitmap`.
+    :param song_ids: array of song ids.
+    :return: boolean mask of the song ids in the bitmap.
+    """
+    inside = song_ids < bitmap.size
+    inside[inside] = bitmap[song_ids[inside]]
+    return inside
+
+
+class QueryHashes:
+    """
+    Columnar view of the hashes generated from the input audio. Hashes are kept sorted, so the rows returned
+    by the database can be joined against them with `searchsorted` instead of a dictionary lookup per row.
+    """
+    def __init__(self, hashes: Iterable[Tuple[str, int]], groups: Iterable[int] = None):
+        """
+        :param hashes: A sequence of tuples in the format (hash, offset)
+            - hash: Part of a sha1 hash, in hexadecimal format
+            - offset: Offset this hash was created from/at.
+        :param groups: optional group (for instance the chunk) each hash belongs to.
+        """
+        hashes = list(hashes)
+        query_hashes = np.array([hsh.upper() for hsh, _ in hashes], dtype=HASH_DTYPE)
+        query_offsets = np.array([offset for _, offset in hashes], dtype=np.int64)
+
+        order = np.argsort(query_hashes, kind="stable")
+        self.offsets = query_offsets[order]
+        self.groups = None if groups is None else np.asarray(groups, dtype=np.int64)[order]
+        # distinct hashes, where their offsets start within self.offsets and how many there are.
+        self.keys, self.starts, self.counts = np.unique(query_hashes[order], return_index=True, return_counts=True)
+
+    def __len__(self) -> int:
+        return self.keys.size
+
+    def values(self) -> List[str]:
+        """
+        :return: the distinct hashes, as expected by the queries.
+        """
+        return [key.decode() for key in self.keys.tolist()]
+
+    def pairs(self, db_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Pairs every database row with every query entry sharing its hash.
+
+        :param db_hashes: hash of each database row.
+        :return: a tuple of arrays with the database row and the query entry (an index of self.offsets and
+         self.groups) of each pair, and a boolean mask of the database rows whose hash belongs to this query.
+        """
+        if self.keys.size == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, np.zeros(len(db_hashes), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(self.keys, db_hashes), self.keys.size - 1)
+        found = self.keys[positions] == db_hashes
+        repeats = np.where(found, self.counts[positions], 0)
+
+        # index of every entry within self.offsets: the start of its hash plus its rank within the hash.
+        ends = np.cumsum(repeats)
+        ranks = np.arange(ends[-1] if ends.size else 0) - np.repeat(ends - repeats, repeats)
+        entries = np.repeat(self.starts[positions], repeats) + ranks
+
+        return np.repeat(np.arange(len(db_hashes)), repeats), entries, found
+
+    def join(self, db_hashes: np.ndarray, db_song_ids: np.ndarray, db_offsets: np.ndarray) \
+            -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Pairs every database row with every sampled offset of its hash.
+
+        :param db_hashes: hash of each database row.
+        :param db_song_ids: song id of each database row.
+        :param db_offsets: offset of each database row.
+        :return: a tuple of arrays with the song id and the offset difference (database_offset - sampled_offset)
+         of each pair, and a boolean mask of the database rows whose hash belongs to this query.
+        """
+        rows, entries, found = self.pairs(db_hashes)
+        return db_song_ids[rows], db_offsets[rows] - self.offsets[entries], found
+
+
+class MatchAccumulator:
+    """
+    Collects the (song_id, offset_difference) pairs found in the database batch by batch and keeps them
+    as a histogram of counts, so memory depends on the number of distinct pairs and not on the number
+    of rows returned by the query.
+    """
+    def __init__(self, compact_size: int = MATCH_COMPACT_SIZE):
+        self.compact_size = compact_size
+        # amount of hashes matched (not considering duplicated hashes) in each song.
+        self.dedup_hashes: Dict[int, int] = {}
+        self.total = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._pending = []
+        self._pending_size = 0
+
+    def __len__(self) -> int:
+        return self.total
+
+    @classmethod
+    def from_histogram(cls, song_ids: np.ndarray, offsets: np.ndarray, counts: np.ndarray,
+                       dedup_hashes: Dict[int, int]) -> "MatchAccumulator":
+        """
+        Builds an accumulator out of matches that were already counted.
+
+        :param song_ids: song id of each (song_id, offset_difference) pair, sorted along with offsets.
+        :param offsets: offset difference of each pair.
+        :param counts: times each pair was matched.
+        :param dedup_hashes: amount of hashes matched in each song.
+        :return: a MatchAccumulator.
+        """
+        matches = cls()
+        matches._keys = pack_keys(song_ids, offsets)
+        matches._counts = np.asarray(counts, dtype=np.int64)
+        matches.total = int(matches._counts.sum())
+        matches.dedup_hashes = dedup_hashes
+        return matches
+
+    def add(self, song_ids: Iterable[int], offsets: Iterable[int]) -> None:
+        """
+        Adds a batch of matches.
+
+        :param song_ids: song identifier of each match.
+        :param offsets: offset difference (database_offset - sampled_offset) of each match.
+        """
+        song_ids = np.asarray(song_ids, dtype=np.int64)
+        if song_ids.size == 0:
+            return
+
+        self._pending.append(pack_keys(song_ids, np.asarray(offsets, dtype=np.int64)))
+        self._pending_size += song_ids.size
+        self.total += song_ids.size
+
+        if self._pending_size >= self.compact_size:
+            self._compact()
+
+    def count_hashes(self, song_ids: Iterable[int]) -> None:
+        """
+        Counts the database rows matched for each song.
+
+        :param song_ids: song identifier of each row returned by the database.
+        """
+        ids, inverse = np.unique(np.asarray(song_ids, dtype=np.int64), return_inverse=True)
+        counts = np.bincount(inverse.ravel(), minlength=ids.size)
+        for sid, count in zip(ids.tolist(), counts.tolist()):
+            self.dedup_hashes[sid] = self.dedup_hashes.get(sid, 0) + count
+
+    def _compact(self) -> None:
+        if not self._pending:
+            return
+
+        keys = np.concatenate([self._keys, *self._pending])
+        counts = np.concatenate([self._counts, np.ones(self._pending_size, dtype=np.int64)])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._counts = np.bincount(inverse.ravel(), weights=counts, minlength=self._keys.size).astype(np.int64)
+
+        self._pending = []
+        self._pending_size = 0
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns how many times each (song_id, offset_difference) pair was matched.
+
+        :return: a tuple of arrays with the song ids, the offset differences and the counts, sorted by
+         song id and offset difference.
+        """
+        self._compact()
+        song_ids, offsets = unpack_keys(self._keys)
+        return song_ids, offsets, self._counts
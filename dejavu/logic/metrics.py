@@ -0,0 +1,242 @@
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from time import time
+from typing import Dict, List, Tuple
+
+from dejavu.config.settings import METRICS_TRACES
+
+# upper bounds of the histogram buckets of durations (names ending in _seconds) and of sizes (rows, hashes...).
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# children kept by a span, so long running recognitions (streams, archives) don't grow their trace forever.
+MAX_SPAN_CHILDREN = 1000
+
+# span the code running in the current context (thread or asyncio task) is inside of.
+_current_span: ContextVar = ContextVar("dejavu_span", default=None)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        return False
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullMetrics:
+    """
+    Metrics registry that records nothing, used while metrics are disabled so instrumented code only pays
+    for a method call.
+    """
+    enabled = False
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Adds to a counter.
+
+        :param name: counter name.
+        :param value: amount added.
+        """
+        pass
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Records a value in a histogram.
+
+        :param name: histogram name, durations are named with a _seconds suffix.
+        :param value: value observed.
+        """
+        pass
+
+    def span(self, name: str, trace: bool = False, **attributes):
+        """
+        Times a block of code, `with metrics.span("peaks"): ...`. Its duration is recorded in the
+        `<name>_seconds` histogram and, inside another span, it becomes a child of it in the trace.
+
+        :param name: span name.
+        :param trace: if True and there is no enclosing span, the span starts a new trace, such as a recognition.
+        :param attributes: attributes of the span, more can be added with `set` on the object returned.
+        :return: a context manager.
+        """
+        return _NULL_SPAN
+
+    def traces(self) -> List[Dict[str, any]]:
+        """
+        :return: the most recent traces, oldest first.
+        """
+        return []
+
+    def to_json(self) -> Dict[str, any]:
+        """
+        :return: counters, histograms and recent traces.
+        """
+        return {"counters": {}, "histograms": {}, "traces": []}
+
+    def prometheus(self) -> str:
+        """
+        :return: counters and histograms in the Prometheus text exposition format.
+        """
+        return ""
+
+
+class Span:
+    """
+    Timed block of code within a trace.
+    """
+    def __init__(self, registry: "MetricsRegistry", name: str, trace: bool, attributes: Dict[str, any]):
+        self.registry = registry
+        self.name = name
+        self.trace = trace
+        self.attributes = attributes
+        self.children: List[Span] = []
+        self.dropped_children = 0
+        self.parent = None
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self._token = _current_span.set(self)
+        self.start = time()
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.duration = time() - self.start
+        _current_span.reset(self._token)
+        if extype is not None:
+            self.attributes["error"] = extype.__name__
+
+        self.registry.observe(f"{self.name}_seconds", self.duration)
+        if self.parent is not None:
+            if len(self.parent.children) < MAX_SPAN_CHILDREN:
+                self.parent.children.append(self)
+            else:
+                self.parent.dropped_children += 1
+        elif self.trace:
+            self.registry.add_trace(self.to_dict())
+        return False
+
+    def set(self, **attributes) -> None:
+        """
+        Adds attributes to the span, such as the amount of rows it read.
+        """
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> Dict[str, any]:
+        return {
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "children": [child.to_dict() for child in self.children],
+            "dropped_children": self.dropped_children
+        }
+
+
+class MetricsRegistry(NullMetrics):
+    """
+    Counters, histograms and traces of the process. Spans time the stages of fingerprinting and recognition
+    (decode, spectrogram, peaks, hashing, database queries, alignment) and each recognition keeps its tree of
+    spans as a trace. Everything is exported as JSON or in the Prometheus text format.
+
+    Stages running on another process (process executors, directory recognition workers) are not recorded,
+    and stages running on another thread are recorded in the histograms but not in the trace of the
+    recognition.
+    """
+    enabled = True
+
+    def __init__(self, prefix: str = "dejavu", traces: int = METRICS_TRACES):
+        """
+        :param prefix: prefix of the exported metric names.
+        :param traces: number of recent traces kept.
+        """
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        # name => (bucket upper bounds, count of each bucket, sum, count)
+        self._histograms: Dict[str, Tuple[Tuple[float, ...], List[int], float, int]] = {}
+        self._traces = deque(maxlen=traces)
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                bounds = DURATION_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS
+                histogram = (bounds, [0] * (len(bounds) + 1), 0.0, 0)
+            bounds, buckets, total, count = histogram
+            buckets[bisect_left(bounds, value)] += 1
+            self._histograms[name] = (bounds, buckets, total + value, count + 1)
+
+    def span(self, name: str, trace: bool = False, **attributes) -> Span:
+        return Span(self, name, trace, attributes)
+
+    def add_trace(self, trace: Dict[str, any]) -> None:
+        with self._lock:
+            self._traces.append(trace)
+
+    def traces(self) -> List[Dict[str, any]]:
+        with self._lock:
+            return list(self._traces)
+
+    def to_json(self) -> Dict[str, any]:
+        with self._lock:
+            histograms = {
+                name: {
+                    "count": count,
+                    "sum": total,
+                    "buckets": {str(bound): sum(buckets[:index + 1]) for index, bound in enumerate(bounds)}
+                }
+                for name, (bounds, buckets, total, count) in self._histograms.items()
+            }
+            return {"counters": dict(self._counters), "histograms": histograms, "traces": list(self._traces)}
+
+    def prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, value in sorted(self._counters.items()):
+                metric = f"{self.prefix}_{name}_total"
+                lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+            for name, (bounds, buckets, total, count) in sorted(self._histograms.items()):
+                metric = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, bucket in zip(bounds, buckets):
+                    cumulative += bucket
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines += [f'{metric}_bucket{{le="+Inf"}} {count}', f"{metric}_sum {total}", f"{metric}_count {count}"]
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = NullMetrics()
+
+
+def get_metrics() -> NullMetrics:
+    """
+    :return: the metrics registry of the process, one that records nothing unless metrics were enabled.
+    """
+    return _metrics
+
+
+def set_metrics(registry: NullMetrics) -> None:
+    """
+    Sets the metrics registry of the process, e.g. `set_metrics(MetricsRegistry())` to enable metrics.
+
+    :param registry: the registry, NullMetrics() disables them again.
+    """
+    global _metrics
+    _metrics = registry
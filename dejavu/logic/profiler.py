@@ -0,0 +1,334 @@
+import cProfile
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from time import time
+from typing import Callable, Dict, Tuple
+
+from dejavu.config.settings import PROFILE_INTERVAL, PROFILE_MEMORY
+from dejavu.logic.metrics import NullMetrics, get_metrics, set_metrics
+
+# profiler running in this process, see `active_profiler`.
+_active = None
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the call stack of every other thread of the process at a fixed interval and counts the
+    distinct stacks, which is what flame graphs are drawn from.
+    """
+    def __init__(self, root: str, interval: float):
+        """
+        :param root: first frame of every stack, the process it was sampled in.
+        :param interval: seconds between samples.
+        """
+        super().__init__(name="dejavu-profiler", daemon=True)
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([self.root, names.get(ident, str(ident))] + stack[::-1])] += 1
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self.join()
+
+
+class _ProfiledSpan:
+    def __init__(self, recorder: "StageRecorder", name: str, span):
+        self.recorder = recorder
+        self.name = name
+        self.span = span
+
+    def __enter__(self):
+        self.span.__enter__()
+        self.recorder.enter(self)
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        self.recorder.exit(self)
+        return self.span.__exit__(extype, exvalue, traceback)
+
+    def set(self, **attributes) -> None:
+        self.span.set(**attributes)
+
+
+class StageRecorder(NullMetrics):
+    """
+    Takes the place of the metrics registry while profiling, so every span of the instrumented stages
+    (decode, spectrogram, peaks, hashing, db_query, align...) also records its calls, seconds and, with
+    `memory`, the peak of memory allocated by Python above the start of the stage (tracemalloc), the
+    memory blocks it left allocated and the peak RSS of the process when it ended. Memory is only
+    measured on the thread that started profiling, since tracemalloc peaks are shared by every thread.
+    Everything else is passed on to the registry it replaces.
+    """
+    def __init__(self, metrics: NullMetrics, memory: bool):
+        self.inner = metrics
+        self.enabled = metrics.enabled
+        self.memory = memory
+        self.thread = threading.get_ident()
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        # spans open on the profiling thread, with the peak seen so far inside each one.
+        self._stack = []
+
+    def count(self, name: str, value: float = 1) -> None:
+        self.inner.count(name, value)
+
+    def observe(self, name: str, value: float) -> None:
+        self.inner.observe(name, value)
+
+    def span(self, name: str, trace: bool = False, **attributes) -> _ProfiledSpan:
+        return _ProfiledSpan(self, name, self.inner.span(name, trace, **attributes))
+
+    def traces(self):
+        return self.inner.traces()
+
+    def to_json(self):
+        return self.inner.to_json()
+
+    def prometheus(self):
+        return self.inner.prometheus()
+
+    def enter(self, span: _ProfiledSpan) -> None:
+        span.start = time()
+        span.measured = self.memory and threading.get_ident() == self.thread
+        if span.measured:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            # the peak is reset for this span, the enclosing ones keep the peak they saw before it.
+            tracemalloc.reset_peak()
+            span.start_memory = current
+            span.start_blocks = sys.getallocatedblocks()
+            self._stack.append([span, current])
+
+    def exit(self, span: _ProfiledSpan) -> None:
+        stage = {"calls": 1, "seconds": time() - span.start}
+        if span.measured:
+            _, peak = tracemalloc.get_traced_memory()
+            _, seen = self._stack.pop()
+            peak = max(peak, seen)
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], peak)
+            stage["peak_bytes"] = peak - span.start_memory
+            stage["net_blocks"] = sys.getallocatedblocks() - span.start_blocks
+            stage["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        with self._lock:
+            merge_stages(self.stages, {span.name: stage})
+
+
+def merge_stages(stages: Dict[str, Dict[str, float]], other: Dict[str, Dict[str, float]]) -> None:
+    """
+    Adds the stage records of `other` to `stages`: calls, seconds and blocks are added up, peaks are the
+    largest ones.
+    """
+    for name, stage in other.items():
+        merged = stages.setdefault(name, {})
+        for key, value in stage.items():
+            if key in ("peak_bytes", "max_rss_kb"):
+                merged[key] = max(merged.get(key, value), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+
+class _Capture:
+    """
+    Profiling of one process: sampled stacks, cProfile of the thread that started it and stage records.
+    """
+    def __init__(self, root: str, interval: float, memory: bool):
+        self.sampler = StackSampler(root, interval)
+        self.profile = cProfile.Profile()
+        self.memory = memory
+        self.recorder = None
+        self._started_tracemalloc = False
+
+    def start(self) -> None:
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+        metrics = get_metrics()
+        # a forked worker inherits the recorder of its parent, which records nothing for it.
+        if isinstance(metrics, StageRecorder):
+            metrics = metrics.inner
+        self.recorder = StageRecorder(metrics, self.memory)
+        set_metrics(self.recorder)
+
+        self.sampler.start()
+        # a forked worker may also inherit the profiling hook of its parent.
+        sys.setprofile(None)
+        self.profile.enable()
+
+    def stop(self) -> Dict[str, any]:
+        self.profile.disable()
+        self.sampler.stop()
+        set_metrics(self.recorder.inner)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        self.profile.create_stats()
+        return {"stacks": self.sampler.stacks, "pstats": self.profile.stats, "stages": self.recorder.stages}
+
+
+class ProfiledCall:
+    """
+    Runs a function on a pool worker under its own profiling, returning its result together with the
+    profiling data, so the profiler of the parent process can merge it with `Profiler.unwrap`.
+    """
+    def __init__(self, func: Callable, interval: float, memory: bool):
+        self.func = func
+        self.interval = interval
+        self.memory = memory
+
+    def __call__(self, *args):
+        capture = _Capture(f"worker-{os.getpid()}", self.interval, self.memory)
+        capture.start()
+        try:
+            result = self.func(*args)
+        finally:
+            data = capture.stop()
+        return result, data
+
+
+class _Stats:
+    # what pstats.Stats expects from a profile, built from the stats of a profile of another process.
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Profiler:
+    """
+    Profiles whatever runs inside it, `with Profiler("profile_dir"): djv.recognize(...)`, in this process and
+    in the pool workers that run their functions through `worker`. When it ends it writes to the output
+    directory:
+
+        - stacks.collapsed: the sampled stacks of every thread, in the collapsed format of flamegraph.pl
+          and speedscope, rooted at the process (main or worker-<pid>) and thread they were sampled in.
+        - profile.pstats: cProfile statistics of the main thread and the workers, for pstats or snakeviz.
+        - stages.json: calls, seconds and memory of each instrumented stage, see `StageRecorder`.
+
+    Profiling slows everything down, tracemalloc the most, it can be turned off with `memory=False`.
+    """
+    def __init__(self, output: str, interval: float = PROFILE_INTERVAL, memory: bool = PROFILE_MEMORY):
+        """
+        :param output: directory the results are written to, it is created if needed.
+        :param interval: milliseconds between stack samples.
+        :param memory: whether to measure the memory of each stage.
+        """
+        self.output = output
+        self.interval = interval / 1000
+        self.memory = memory
+        self._capture = None
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        global _active
+        os.makedirs(self.output, exist_ok=True)
+        self._capture = _Capture("main", self.interval, self.memory)
+        self._capture.start()
+        _active = self
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        global _active
+        _active = None
+        data = self._capture.stop()
+        self._write(data, self._workers)
+        return False
+
+    def worker(self, func: Callable) -> ProfiledCall:
+        """
+        :param func: function to run on pool workers.
+        :return: the function profiled, it must be mapped on the pool instead of `func` and its results
+         passed to `unwrap`.
+        """
+        return ProfiledCall(func, self.interval, self.memory)
+
+    def unwrap(self, result: Tuple[any, Dict[str, any]]) -> any:
+        """
+        :param result: result of a function wrapped by `worker`.
+        :return: the result of the function itself, its profiling data is kept for the output.
+        """
+        result, data = result
+        with self._lock:
+            self._workers.append(data)
+        return result
+
+    def _write(self, data: Dict[str, any], workers: list) -> None:
+        stacks = Counter(data["stacks"])
+        stats = pstats.Stats(_Stats(data["pstats"]))
+        stages = {name: dict(stage) for name, stage in data["stages"].items()}
+        workers_stages = {}
+        for worker in workers:
+            stacks.update(worker["stacks"])
+            stats.add(_Stats(worker["pstats"]))
+            merge_stages(workers_stages, worker["stages"])
+
+        with open(os.path.join(self.output, "stacks.collapsed"), "w") as f:
+            for stack, samples in stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+        stats.dump_stats(os.path.join(self.output, "profile.pstats"))
+        with open(os.path.join(self.output, "stages.json"), "w") as f:
+            json.dump({"main": stages, "workers": workers_stages}, f, indent=2)
+
+
+def active_profiler() -> Profiler:
+    """
+    :return: the profiler running in this process, None if there is none.
+    """
+    return _active
+
+
+def profiled_map(pool, func: Callable, iterable, profiler: Profiler = None):
+    """
+    `pool.imap_unordered(func, iterable)`, profiling `func` on the workers when a profiler is running.
+
+    :param pool: multiprocessing pool.
+    :param func: function to map.
+    :param iterable: arguments of each call.
+    :param profiler: profiler to report to, the active one if not given.
+    :return: an iterator over the results, with the `next(timeout)` of the pool iterators.
+    """
+    profiler = profiler or active_profiler()
+    if profiler is None:
+        return pool.imap_unordered(func, iterable)
+    return _ProfiledIterator(pool.imap_unordered(profiler.worker(func), iterable), profiler)
+
+
+class _ProfiledIterator:
+    def __init__(self, iterator, profiler: Profiler):
+        self.iterator = iterator
+        self.profiler = profiler
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.profiler.unwrap(next(self.iterator))
+
+    def next(self, timeout: float = None):
+        return self.profiler.unwrap(self.iterator.next(timeout))
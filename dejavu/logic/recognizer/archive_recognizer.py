@@ -0,0 +1,129 @@
+import json
+import os
+from time import time
+from typing import Any, Dict
+
+import dejavu.logic.decoder as decoder
+from dejavu.config.settings import (ARCHIVE_CHECKPOINT_INTERVAL,
+                                    ARCHIVE_WINDOW, AUDIO_DURATION,
+                                    CHUNK_OVERLAP, CHUNK_SIZE, RESULTS,
+                                    TOTAL_TIME)
+from dejavu.logic.recognizer.file_recognizer import FileRecognizerChunks
+from dejavu.logic.timeline import TimelineBuilder
+
+
+class ArchiveRecognizer(FileRecognizerChunks):
+    """
+    Recognizes recordings of several hours with bounded memory: the file is decoded, fingerprinted, matched
+    and aligned in windows of `ARCHIVE_WINDOW` seconds, chunk detections are merged into the timeline as
+    each window completes and only the timeline is kept. A checkpoint with the position and the partial
+    timeline is saved every `ARCHIVE_CHECKPOINT_INTERVAL` windows, so a killed job resumes where it left off.
+    """
+    def __init__(self, dejavu):
+        super().__init__(dejavu)
+        self.window = ARCHIVE_WINDOW
+        self.checkpoint_interval = ARCHIVE_CHECKPOINT_INTERVAL
+
+    def recognize_file(self, filename: str, options: Dict[str, Any], checkpoint: str = None) -> Dict[str, any]:
+        t = time()
+
+        # windows hold a whole number of chunk steps so chunks are the same as if the file was read at once,
+        # each window is read with the overlap of its last chunk.
+        step = self.chunk_step(CHUNK_SIZE, CHUNK_OVERLAP)
+        window = max(int(self.window // step), 1) * step
+        identity = {
+            "file": os.path.abspath(filename),
+            "size": os.path.getsize(filename),
+            "window": window,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_overlap": CHUNK_OVERLAP
+        }
+
+        builder = TimelineBuilder()
+        segments = []
+        position = 0
+        state = self.load_checkpoint(checkpoint, identity)
+        if state:
+            if state["done"]:
+                return state["result"]
+            position, segments = state["position"], state["segments"]
+            builder.restore(state["timeline"])
+            print('resuming {} from second {}'.format(filename, position))
+
+        windows = 0
+        audio_duration = position
+        while True:
+            channels, frame_rate = decoder.read_window(filename, position, window + CHUNK_OVERLAP)
+            samples = len(channels[0]) if channels else 0
+            if samples == 0:
+                break
+
+            detections = self.recognize_chunks(channels, frame_rate, options, offset=position,
+                                               until=int(window * frame_rate))
+            for detection in sorted(detections, key=lambda detection: detection["chunk_start"]):
+                segments.extend(builder.add(detection["chunk_start"], detection["chunk_end"], detection))
+
+            last = samples < int((window + CHUNK_OVERLAP) * frame_rate)
+            audio_duration = position + samples / frame_rate
+            position += window
+            # segments that can not be extended by the next window are closed now.
+            segments.extend(builder.add(position, position))
+
+            windows += 1
+            if last:
+                break
+            if checkpoint and windows % self.checkpoint_interval == 0:
+                self.save_checkpoint(checkpoint, {**identity, "done": False, "position": position,
+                                                  "segments": segments, "timeline": builder.state()})
+
+        segments.extend(builder.flush())
+        for segment in segments:
+            segment["detection_time"] = self.num_a_tiempo(segment["start"])
+            segment["end_time"] = self.num_a_tiempo(segment["end"])
+
+        result = {
+            TOTAL_TIME: time() - t,
+            AUDIO_DURATION: audio_duration,
+            RESULTS: sorted(segments, key=lambda segment: segment["start"])
+        }
+        if checkpoint:
+            self.save_checkpoint(checkpoint, {**identity, "done": True, "result": result})
+
+        return result
+
+    @staticmethod
+    def load_checkpoint(checkpoint: str, identity: Dict[str, any]) -> Dict[str, any]:
+        """
+        Loads a checkpoint, if it exists and was saved for the same file and settings.
+
+        :param checkpoint: path of the checkpoint file.
+        :param identity: file and settings the checkpoint must match.
+        :return: the checkpoint or None.
+        """
+        if not checkpoint or not os.path.exists(checkpoint):
+            return None
+
+        with open(checkpoint) as f:
+            state = json.load(f)
+
+        if any(state.get(key) != value for key, value in identity.items()):
+            print('checkpoint {} belongs to another file or settings, starting over'.format(checkpoint))
+            return None
+
+        return state
+
+    @staticmethod
+    def save_checkpoint(checkpoint: str, state: Dict[str, any]) -> None:
+        """
+        Saves a checkpoint, replacing the previous one atomically so a crash never leaves it half written.
+
+        :param checkpoint: path of the checkpoint file.
+        :param state: checkpoint contents.
+        """
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, checkpoint)
+
+    def recognize(self, filename: str, options: Dict[str, Any] = {}, checkpoint: str = None) -> Dict[str, any]:
+        return self.recognize_file(filename, options, checkpoint)
@@ -0,0 +1,204 @@
+import json
+import multiprocessing
+import sys
+from time import time
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+import dejavu.logic.decoder as decoder
+from dejavu.base_classes.base_recognizer import BaseRecognizer
+from dejavu.config.settings import (ALIGN_TIME, AUDIO_DURATION,
+                                    FINGERPRINT_TIME, QUERIED_HASHES,
+                                    QUERY_TIME, RECOGNIZE_DIR_BATCH_FILES,
+                                    RESULTS, TOTAL_TIME)
+from dejavu.logic.executor import columns_to_hashes, hashes_to_columns
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.matches import MatchAccumulator, QueryHashes
+from dejavu.logic.profiler import profiled_map
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+from dejavu.logic.serialization import json_default
+
+
+def fingerprint_file(arguments: Tuple[str, int, bool]) -> Dict[str, any]:
+    """
+    Decodes and fingerprints a file, meant to run on a worker process.
+
+    :param arguments: tuple with the file name, the number of seconds to read (None for all of it) and whether
+     the strength of each hash is needed (for progressive matching).
+    :return: a dictionary with the file name, its SHA1, its hashes as returned by `hashes_to_columns` (and their
+     strengths, in the same order, if asked for), its duration and the decoding and fingerprinting times, or
+     with the file name and the error that prevented reading it.
+    """
+    file_name, limit, with_strength = arguments
+    try:
+        t = time()
+        channels, frame_rate, file_hash, audio_duration = decoder.read(file_name, limit)
+        decode_time = time() - t
+
+        t = time()
+        strengths = {}  # (hash, offset) => strength, keeping the strongest one among channels.
+        for channel in channels:
+            for hsh, offset, *strength in fingerprint(channel, Fs=frame_rate, with_strength=with_strength):
+                strength = strength[0] if strength else 0
+                if strength > strengths.get((hsh, offset), float("-inf")):
+                    strengths[(hsh, offset)] = strength
+
+        record = {
+            "file": file_name,
+            "file_hash": file_hash,
+            "hashes": hashes_to_columns(list(strengths)),
+            AUDIO_DURATION: audio_duration,
+            "decode_time": decode_time,
+            FINGERPRINT_TIME: time() - t
+        }
+        if with_strength:
+            record["strengths"] = np.array(list(strengths.values()), dtype=np.float64)
+        return record
+    except Exception as e:
+        return {"file": file_name, "error": f"{type(e).__name__}: {e}"}
+
+
+class DirectoryRecognizer(BaseRecognizer):
+    """
+    Recognizes every file of a directory in a single run. Files are decoded and fingerprinted by a pool of
+    worker processes while this process, which holds the only database connections, matches them as they
+    come: the hashes of up to `RECOGNIZE_DIR_BATCH_FILES` fingerprinted files are looked up with a single
+    query. Each result is written as a JSON line as soon as it is known.
+    """
+    def __init__(self, dejavu):
+        super().__init__(dejavu)
+        self.batch_files = RECOGNIZE_DIR_BATCH_FILES
+        # answers files already recognized, or in the catalog, the same way as `FileRecognizer`.
+        self.files = FileRecognizer(dejavu)
+
+    def recognize(self, path: str, extensions: List[str], output: str = None,
+                  nprocesses: int = None) -> Dict[str, any]:
+        """
+        :param path: directory to recognize.
+        :param extensions: file extensions to look for.
+        :param output: file the JSON lines are written to, the standard output if not given.
+        :param nprocesses: amount of worker processes, as many as cores if not given.
+        :return: the totals of the run: files recognized, files with a match, failed files, seconds of audio,
+         elapsed seconds and throughput.
+        """
+        t = time()
+        file_names = [file_name for file_name, _ in decoder.find_files(path, extensions)]
+        summary = {"files": 0, "matched": 0, "failed": 0, "audio_seconds": 0.0}
+
+        out = sys.stdout if output is None else open(output, 'w')
+        pool = multiprocessing.Pool(nprocesses)
+        try:
+            iterator = profiled_map(pool, fingerprint_file, [(file_name, self.dejavu.limit, self.dejavu.progressive)
+                                                             for file_name in file_names])
+            for batch in self._batches(iterator):
+                for record in self._match(batch):
+                    out.write(json.dumps(record, default=json_default) + '\n')
+                    out.flush()
+
+                    summary["files"] += 1
+                    if "error" in record:
+                        summary["failed"] += 1
+                        continue
+                    summary["matched"] += 1 if record[RESULTS] else 0
+                    summary["audio_seconds"] += record[AUDIO_DURATION] / 1000
+        finally:
+            pool.close()
+            pool.join()
+            if out is not sys.stdout:
+                out.close()
+
+        elapsed = time() - t
+        summary["elapsed"] = elapsed
+        summary["files_per_second"] = summary["files"] / elapsed if elapsed else 0
+        # seconds of audio recognized per second of run.
+        summary["realtime_factor"] = summary["audio_seconds"] / elapsed if elapsed else 0
+        return summary
+
+    def _batches(self, iterator) -> Iterator[List[Dict[str, any]]]:
+        # waits for the first file of a batch and then takes the ones already fingerprinted, without waiting.
+        batch = []
+        while True:
+            try:
+                batch.append(iterator.next(timeout=0 if batch else None))
+            except multiprocessing.TimeoutError:
+                yield batch
+                batch = []
+                continue
+            except StopIteration:
+                if batch:
+                    yield batch
+                return
+
+            if len(batch) >= self.batch_files:
+                yield batch
+                batch = []
+
+    def _match(self, batch: List[Dict[str, any]]) -> List[Dict[str, any]]:
+        # results are the ones `FileRecognizer` would give: the result cache and the catalog are checked first,
+        # and the files left are looked up with the matching mode configured.
+        cache = self.dejavu.result_cache
+        pending = []
+        for record in (record for record in batch if "error" not in record):
+            values, offsets = record.pop("hashes")
+            file_hashes = columns_to_hashes(values, offsets)
+            strengths = record.pop("strengths", None)
+            if strengths is not None:
+                file_hashes = dict(zip(zip(np.char.decode(values).tolist(), offsets.tolist()), strengths.tolist()))
+
+            key, cached = self.files.cached_hash(record.pop("file_hash"))
+            if cached is not None:
+                self._set_results(record, cached[RESULTS], 0, 0, cached[QUERIED_HASHES])
+                continue
+            if cache is not None and not self.dejavu.progressive:
+                # the same audio gives the same hashes, whatever file it comes from.
+                results = cache.get(cache.hashes_key(file_hashes, self.dejavu.recognition_options()))
+                if results is not None:
+                    self._set_results(record, results, 0, 0, len(file_hashes))
+                    self._cache(record, file_hashes, key)
+                    continue
+            pending.append((record, file_hashes, key))
+        if not pending:
+            return batch
+
+        t = time()
+        if self.dejavu.progressive:
+            found = [self.dejavu.find_matches_progressive(file_hashes) for _, file_hashes, _ in pending]
+            found = [(matches, dedup_hashes, queried) for matches, dedup_hashes, _, queried in found]
+        elif self.dejavu.two_stage:
+            found = [(*self.dejavu.find_matches(file_hashes)[:2], len(file_hashes)) for _, file_hashes, _ in pending]
+        else:
+            queries = [(QueryHashes(file_hashes), MatchAccumulator()) for _, file_hashes, _ in pending]
+            self.dejavu.db.return_matches_batch(queries, subset=self.dejavu.subset)
+            found = [(matches, matches.dedup_hashes, len(file_hashes))
+                     for (_, matches), (_, file_hashes, _) in zip(queries, pending)]
+        # the lookup is shared by the whole batch.
+        query_time = time() - t
+
+        for (record, file_hashes, key), (matches, dedup_hashes, queried_hashes) in zip(pending, found):
+            t = time()
+            results = self.dejavu.align_matches(matches, dedup_hashes, queried_hashes)
+            self._set_results(record, results, query_time, time() - t, queried_hashes)
+            self._cache(record, file_hashes, key)
+
+        return batch
+
+    def _cache(self, record: Dict[str, any], file_hashes: Iterable[Tuple[str, int]], key: str) -> None:
+        # stores the results under the keys `FileRecognizer` looks them up with.
+        cache = self.dejavu.result_cache
+        if cache is None:
+            return
+        if not self.dejavu.progressive:
+            cache.put(cache.hashes_key(file_hashes, self.dejavu.recognition_options()), record[RESULTS])
+        cache.put(key, FileRecognizer._results(record[TOTAL_TIME], record[AUDIO_DURATION], record[RESULTS],
+                                               record[FINGERPRINT_TIME], record[QUERY_TIME], record[ALIGN_TIME],
+                                               record[QUERIED_HASHES]))
+
+    @staticmethod
+    def _set_results(record: Dict[str, any], results: List[Dict[str, any]], query_time: float, align_time: float,
+                     queried_hashes: int) -> None:
+        record[RESULTS] = results
+        record[ALIGN_TIME] = align_time
+        record[QUERY_TIME] = query_time
+        record[QUERIED_HASHES] = queried_hashes
+        record[TOTAL_TIME] = record["decode_time"] + record[FINGERPRINT_TIME] + query_time + align_time
@@ -1,8 +1,6 @@
 from time import time
-from typing import Dict, Any
-import os
+from typing import Any, Dict, List, Tuple
 
-from pydub import AudioSegment
 import concurrent.futures
 import numpy as np
 import datetime
@@ -11,8 +9,13 @@ import dejavu.logic.decoder as decoder
 import numpy
 from dejavu.base_classes.base_recognizer import BaseRecognizer
 from dejavu.config.settings import (ALIGN_TIME, FINGERPRINT_TIME, QUERY_TIME,
-                                    RESULTS, TOTAL_TIME, AUDIO_DURATION,
-                                    CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_WORKERS)
+                                    QUERIED_HASHES, RESULTS, TOTAL_TIME, AUDIO_DURATION,
+                                    CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_WORKERS, CHUNK_FINGERPRINT_MODE,
+                                    CHUNK_EXECUTOR, DEFAULT_WINDOW_SIZE, DEFAULT_OVERLAP_RATIO)
+from dejavu.logic.executor import (SharedChannels, columns_to_hashes, fingerprint_shared_chunk,
+                                   get_process_pool)
+from dejavu.logic.metrics import get_metrics
+from dejavu.logic.timeline import build_timeline
 
 
 class FileRecognizer(BaseRecognizer):
@@ -20,12 +23,111 @@ class FileRecognizer(BaseRecognizer):
         super().__init__(dejavu)
 
     def recognize_file(self, filename: str) -> Dict[str, any]:
+        key, results = self._cached_file(filename)
+        if results is not None:
+            return results
+
         channels, self.Fs, _, audio_duration = decoder.read(filename, self.dejavu.limit)
+        results = self.recognize_channels(channels, self.Fs, audio_duration)
+
+        if key is not None:
+            self.dejavu.result_cache.put(key, results)
+        return results
+
+    async def recognize_file_async(self, filename: str) -> Dict[str, any]:
+        # the file is hashed on the I/O executor and decoded on the CPU one, the event loop never blocks.
+        key, results = await self.dejavu.db.run_io(self._cached_file, filename)
+        if results is not None:
+            return results
+
+        channels, self.Fs, _, audio_duration = await self.dejavu.run_cpu(decoder.read, filename, self.dejavu.limit)
+        results = await self.recognize_channels_async(channels, self.Fs, audio_duration)
+
+        if key is not None:
+            self.dejavu.result_cache.put(key, results)
+        return results
+
+    def _cached_file(self, filename: str) -> Tuple[str, Dict[str, any]]:
+        """
+        Looks the file up in the result cache and, when it is not there, in the catalog.
+
+        :param filename: file to recognize.
+        :return: the cache key of the file and its cached results, None if they are not cached (both are None
+         when there is no cache).
+        """
+        if self.dejavu.result_cache is None:
+            return None, None
+
+        t = time()
+        return self.cached_hash(decoder.unique_hash(filename), t)
+
+    def cached_hash(self, file_hash: str, t: float = None) -> Tuple[str, Dict[str, any]]:
+        """
+        Same as `_cached_file` for a file whose SHA1 is already known.
+
+        :param file_hash: SHA1 of the file.
+        :param t: time the recognition started, now if not given.
+        :return: the cache key of the file and its cached results, None if they are not cached (both are None
+         when there is no cache).
+        """
+        cache = self.dejavu.result_cache
+        if cache is None:
+            return None, None
+
+        t = time() if t is None else t
+        key = cache.file_key(file_hash, self.dejavu.recognition_options())
+        results = cache.get(key)
+        if results is not None:
+            return key, self._cached_results(t, results[AUDIO_DURATION], results[RESULTS], results[QUERIED_HASHES])
+
+        # a file of the catalog is its own song, there is nothing to decode nor query.
+        catalog = self.dejavu.catalog_match(file_hash)
+        if catalog:
+            matches, audio_duration = catalog
+            cache.count("catalog_hits")
+            results = self._cached_results(t, audio_duration, matches)
+            cache.put(key, results)
+            return key, results
+        return key, None
+
+    @staticmethod
+    def _cached_results(t: float, audio_duration: float, matches: List[Dict[str, any]],
+                        queried_hashes: int = 0) -> Dict[str, any]:
+        # no fingerprinting, querying nor aligning was needed.
+        return FileRecognizer._results(time() - t, audio_duration, matches, 0, 0, 0, queried_hashes)
+
+    def recognize_channels(self, channels: List[np.ndarray], frame_rate: int, audio_duration: float) \
+            -> Dict[str, any]:
+        """
+        Recognizes audio already decoded.
+
+        :param channels: samples of each channel.
+        :param frame_rate: sampling rate.
+        :param audio_duration: duration of the audio in seconds.
+        :return: the recognition results.
+        """
+        self.Fs = frame_rate
 
         t = time()
         matches, fingerprint_time, query_time, align_time = self._recognize(*channels)
-        t = time() - t
+        return self._results(time() - t, audio_duration, matches, fingerprint_time, query_time, align_time,
+                             self.queried_hashes)
+
+    async def recognize_channels_async(self, channels: List[np.ndarray], frame_rate: int, audio_duration: float) \
+            -> Dict[str, any]:
+        """
+        Async counterpart of `recognize_channels`.
+        """
+        self.Fs = frame_rate
 
+        t = time()
+        matches, fingerprint_time, query_time, align_time = await self._recognize_async(*channels)
+        return self._results(time() - t, audio_duration, matches, fingerprint_time, query_time, align_time,
+                             self.queried_hashes)
+
+    @staticmethod
+    def _results(t: float, audio_duration: float, matches: List[Dict[str, any]], fingerprint_time: float,
+                 query_time: float, align_time: float, queried_hashes: int) -> Dict[str, any]:
         if matches:
             for match in matches:
                 match = {k: v.item() if isinstance(v, numpy.int64) else v for k, v in match.items()}
@@ -36,6 +138,7 @@ class FileRecognizer(BaseRecognizer):
             FINGERPRINT_TIME: fingerprint_time,
             QUERY_TIME: query_time,
             ALIGN_TIME: align_time,
+            QUERIED_HASHES: queried_hashes,
             RESULTS: matches
         }
 
@@ -44,84 +147,198 @@ class FileRecognizer(BaseRecognizer):
     def recognize(self, filename: str) -> Dict[str, any]:
         return self.recognize_file(filename)
 
+    async def recognize_async(self, filename: str) -> Dict[str, any]:
+        return await self.recognize_file_async(filename)
+
 class FileRecognizerChunks(BaseRecognizer):
-    def __init__(self, dejavu):
+    def __init__(self, dejavu, executor: str = CHUNK_EXECUTOR, workers: int = CHUNK_WORKERS):
         super().__init__(dejavu)
+        # ejecutor y número de workers con los que se generan las huellas de los chunks
+        self.executor = executor
+        self.workers = workers
+
+    @staticmethod
+    def chunk_step(chunk_length, overlap_length):
+        # Segundos entre el inicio de dos chunks consecutivos, el solapamiento debe ser menor que el chunk.
+        if chunk_length <= 0 or not 0 <= overlap_length < chunk_length:
+            raise ValueError(f"The chunk overlap (DJV_CHUNK_OVERLAP={overlap_length}) must be at least 0 and "
+                             f"smaller than the chunk size (DJV_CHUNK_SIZE={chunk_length})")
+        return chunk_length - overlap_length
+
+    def make_chunks(self, channels, frame_rate, chunk_length, overlap_length, until=None):
+        # Cada chunk es una lista de vistas sobre los canales ya decodificados, sin copiar las muestras.
+        # Si se indica until solo se crean los chunks que empiezan antes de esa muestra.
+        chunk_samples = int(chunk_length * frame_rate)
+        step_samples = max(int(self.chunk_step(chunk_length, overlap_length) * frame_rate), 1)
+        last_start = len(channels[0]) if until is None else min(until, len(channels[0]))
 
-    def make_chunks(self, audio, chunk_length, overlap_length):
         chunks = []
-        i = 0
-        while i < len(audio):
-            chunks.append(audio[i:i+chunk_length])
-            i += chunk_length - overlap_length
+        for start in range(0, last_start, step_samples):
+            chunks.append((start, [channel[start:start + chunk_samples] for channel in channels]))
         return chunks
-    
-    def process_chunk(self, i, chunk):
-        t = time()
 
-        chunkNameExport = "/tmp/chunk-{}.mp3".format(i)
-        chunk.export(chunkNameExport, format="mp3", bitrate="128k", codec="libmp3lame")
-        channels, frame_rate, _, _ = decoder.read(chunkNameExport, self.dejavu.limit)
+    def process_chunk(self, i, start, chunk, frame_rate):
+        t = time()
 
         fingerprint_times = []
         hashes = set()  # to remove possible duplicated fingerprints we built a set.
-        for channel in channels:
+        for channel in chunk:
             fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=frame_rate)
             fingerprint_times.append(fingerprint_time)
             hashes |= set(fingerprints)
-        os.remove(chunkNameExport)
         chunk_processing_time = time() - t
-        
+
         return {
             'chunk': i,
-            'offset_chunk': i * CHUNK_SIZE,
+            'offset_chunk': start / frame_rate,
             'chunk_processing_time': chunk_processing_time,
             'hashes': hashes,
             'fingerprint_times': fingerprint_times
         }
-    
-    def recognize_file(self, filename: str, options) -> Dict[str, any]:        
-        # Leemos el fichero y creamos los chunks
-        t = time()
 
-        audio = AudioSegment.from_file(filename)
-        chunks = self.make_chunks(audio, int(CHUNK_SIZE * 1000), int(CHUNK_OVERLAP * 1000))
-        print('chunks: {}'.format(len(chunks)))
+    def fingerprint_chunks(self, chunks, channels, frame_rate):
+        # Generamos las huellas de cada chunk con el ejecutor configurado (CHUNK_EXECUTOR por defecto)
+        if self.executor == 'process':
+            return self.fingerprint_chunks_process(chunks, channels, frame_rate)
 
-        chunk_make_time = time() - t
-        print('chunk make time: {}'.format(chunk_make_time))
+        if self.executor == 'inline':
+            return {i: self.process_chunk(i, start, chunk, frame_rate) for i, (start, chunk) in enumerate(chunks)}
 
-        # Procesamos los chunks
-        t = time()
         results = dict()
-        with concurrent.futures.ThreadPoolExecutor(max_workers=CHUNK_WORKERS) as executor:
-            future_to_chunk = { executor.submit(self.process_chunk, i, chunk): i for i, chunk in enumerate(chunks) }
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            future_to_chunk = {
+                executor.submit(self.process_chunk, i, start, chunk, frame_rate): i
+                for i, (start, chunk) in enumerate(chunks)
+            }
             for future in concurrent.futures.as_completed(future_to_chunk):
                 i = future_to_chunk[future]
                 try:
                     data = future.result()
                 except Exception as exc:
                     print('chunk {} generated an exception: {}'.format(i, exc))
+                    get_metrics().count("chunk_errors")
                 else:
                     # Store the result in the dictionary using chunk index as the key
                     if data:
                         results[i] = data
+        return results
+
+    def fingerprint_chunks_process(self, chunks, channels, frame_rate):
+        # Los procesos del pool leen su trozo de PCM de memoria compartida y devuelven las huellas como arrays
+        chunk_samples = int(CHUNK_SIZE * frame_rate)
+        executor = get_process_pool(self.workers)
+
+        results = dict()
+        with SharedChannels(channels) as shared:
+            future_to_chunk = {
+                executor.submit(fingerprint_shared_chunk, shared.name, shared.shape,
+                                start, start + chunk_samples, frame_rate): (i, start)
+                for i, (start, _) in enumerate(chunks)
+            }
+            for future in concurrent.futures.as_completed(future_to_chunk):
+                i, start = future_to_chunk[future]
+                try:
+                    (values, offsets), fingerprint_times, chunk_processing_time = future.result()
+                except Exception as exc:
+                    print('chunk {} generated an exception: {}'.format(i, exc))
+                    get_metrics().count("chunk_errors")
+                else:
+                    results[i] = {
+                        'chunk': i,
+                        'offset_chunk': start / frame_rate,
+                        'chunk_processing_time': chunk_processing_time,
+                        'hashes': columns_to_hashes(values, offsets),
+                        'fingerprint_times': fingerprint_times
+                    }
+        return results
 
-        chunk_process_time = time() - t
-        print('chunk process time: {}'.format(chunk_process_time))
+    def window_hashes(self, chunks, channels, frame_rate):
+        # Generamos las huellas del fichero completo una sola vez y las repartimos entre los chunks
+        # según el frame de su ancla, rebasando el offset al primer frame completo de cada chunk.
+        hop = DEFAULT_WINDOW_SIZE - int(DEFAULT_WINDOW_SIZE * DEFAULT_OVERLAP_RATIO)
+        chunk_frames = int(CHUNK_SIZE * frame_rate) / hop
+
+        t = time()
+        fingerprint_times = []
+        hashes = set()  # to remove possible duplicated fingerprints we built a set.
+        for channel in channels:
+            fingerprints, fingerprint_time = self.dejavu.generate_fingerprints(channel, Fs=frame_rate)
+            fingerprint_times.append(fingerprint_time)
+            hashes |= set(fingerprints)
+
+        hashes = sorted(hashes, key=lambda h: h[1])
+        offsets = np.array([offset for _, offset in hashes], dtype=np.int64)
+        chunk_processing_time = time() - t
+
+        results = dict()
+        for i, (start, _) in enumerate(chunks):
+            first_frame = int(np.ceil(start / hop))
+            lo, hi = np.searchsorted(offsets, [first_frame, start / hop + chunk_frames], side='left')
+            results[i] = {
+                'chunk': i,
+                'offset_chunk': first_frame * hop / frame_rate,
+                'chunk_processing_time': chunk_processing_time,
+                'hashes': {(hsh, offset - first_frame) for hsh, offset in hashes[lo:hi]},
+                # el tiempo de generar las huellas se comparte entre todos los chunks, lo contamos en el primero
+                'fingerprint_times': fingerprint_times if i == 0 else []
+            }
+        return results
+
+    def recognize_file(self, filename: str, options) -> Dict[str, any]:
+        # Decodificamos el fichero una sola vez, los chunks se crean sobre el PCM
+        cache = self.dejavu.result_cache
+        if cache is not None:
+            key = cache.file_key(decoder.unique_hash(filename),
+                                 {**self.dejavu.recognition_options(), **options, "mode": "chunks",
+                                  "chunk": (CHUNK_SIZE, CHUNK_OVERLAP, CHUNK_FINGERPRINT_MODE)})
+            results = cache.get(key)
+            if results is not None:
+                return results
+
+        channels, frame_rate, _, _ = decoder.read(filename)
+
+        results = self.recognize_channels(channels, frame_rate, options)
+        if cache is not None:
+            cache.put(key, results)
+        return results
+
+    def recognize_channels(self, channels, frame_rate, options) -> Dict[str, any]:
+        # Reconocemos un audio ya decodificado (p. ej. PCM recibido por el servicio) y unimos sus chunks.
+        final_results = self.recognize_chunks(channels, frame_rate, options)
+        get_metrics().count("chunk_detections", len(final_results))
+
+        ordered_results = self.process_json(final_results, 0)
+        return ordered_results
+
+    def recognize_chunks(self, channels, frame_rate, options, offset=0, until=None) -> List[Dict[str, any]]:
+        # Reconocemos los chunks de un audio ya decodificado y devolvemos la mejor detección de cada uno.
+        # offset es el segundo del fichero en el que empiezan los canales, until la muestra a partir de la
+        # cual ya no empiezan chunks (las muestras posteriores solo completan el último).
+        # Las métricas (si están activadas) registran la duración de cada etapa en lugar de imprimirla
+        metrics = get_metrics()
+        audio_duration = len(channels[0]) / frame_rate
+        with metrics.span("chunk_make"):
+            chunks = self.make_chunks(channels, frame_rate, CHUNK_SIZE, CHUNK_OVERLAP, until)
+        metrics.count("chunks", len(chunks))
+
+        # Procesamos los chunks
+        with metrics.span("chunk_fingerprint", chunks=len(chunks)):
+            if CHUNK_FINGERPRINT_MODE == 'file':
+                results = self.window_hashes(chunks, channels, frame_rate)
+            else:
+                results = self.fingerprint_chunks(chunks, channels, frame_rate)
 
         ## matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
 
         resultsMatches, query_time = self.dejavu.find_matches_chunk(results, options)
-        print('query time: {}'.format(query_time))
 
-        print('resultsMatches: {}'.format(len(resultsMatches)))
+        t = time()
+        aligned_chunks = self.dejavu.align_matches_chunks(resultsMatches)
+        align_time = time() - t
 
         final_results = []
         for i, chunk in resultsMatches.items():
-            t = time()
-            align_results = self.dejavu.align_matches(chunk['matches'], chunk['dedup_hashes'], len(chunk['hashes']))
-            align_time = time() - t
+            align_results = aligned_chunks[i]
 
             """ data['ofsset_detection'] = data['offset_chunk'] + -data['results']['offset_seconds']
             data['detection_time'] = num_a_tiempo(data['ofsset_detection'])
@@ -134,22 +351,21 @@ class FileRecognizerChunks(BaseRecognizer):
 
                 final_results.append({
                     # "results": align_results, 
-                    "ofsset_detection": chunk['offset_chunk'] + -data['offset_seconds'],
-                    "detection_time": self.num_a_tiempo(chunk['offset_chunk'] + -data['offset_seconds']),
+                    "chunk_start": offset + chunk['offset_chunk'],
+                    "chunk_end": offset + min(chunk['offset_chunk'] + CHUNK_SIZE, audio_duration),
+                    "ofsset_detection": offset + chunk['offset_chunk'] + -data['offset_seconds'],
+                    "detection_time": self.num_a_tiempo(offset + chunk['offset_chunk'] + -data['offset_seconds']),
                     "song_id": data['song_id'],
                     "song_name": data['song_name'],
+                    "count": data['count'],
+                    AUDIO_DURATION: data[AUDIO_DURATION],
                     "avg_counts_hashes_matched": data['avg_counts_hashes_matched'],
                     "fingerprint_times": np.sum(chunk['fingerprint_times']), 
                     "query_time": query_time, 
                     "align_time": align_time
                 })
 
-        
-        print('final_results: {}'.format(len(final_results)))
-        print('final_results: {}'.format(final_results))
-
-        ordered_results = self.process_json(final_results, 0)
-        return ordered_results
+        return final_results
 
 
     def recognize(self, filename: str, options: Dict[str, Any] = {}) -> Dict[str, any]:
@@ -166,33 +382,10 @@ class FileRecognizerChunks(BaseRecognizer):
         return "{:02}:{:02}.{}".format(minutos, segundos, milisegundos)
     
     def process_json(self, json_data, threshold):
-        # Filtrar las detecciones con 'avg_counts_hashes_matched' mayor a threshold
-        filtered_detections = [detection for detection in json_data if detection["avg_counts_hashes_matched"] > threshold]
-        
-        # Agrupar las detecciones por 'song_id' y rango de tiempo 'ofsset_detection'
-        grouped_detections = {}
-        for detection in filtered_detections:
-            key = (detection["song_id"], int(detection["ofsset_detection"] / 5))
-            if key not in grouped_detections:
-                grouped_detections[key] = {"avg_counts_hashes_matched": [], "ofsset_detection": detection["ofsset_detection"]}
-            grouped_detections[key]["avg_counts_hashes_matched"].append(detection["avg_counts_hashes_matched"])
-        
-        # Calcular la media de 'avg_counts_hashes_matched' y quedarnos con el mínimo 'ofsset_detection' en cada grupo
-        final_results = []
-        for key, value in grouped_detections.items():
-            avg_counts_hashes_matched = sum(value["avg_counts_hashes_matched"]) / len(value["avg_counts_hashes_matched"])
-            final_results.append({
-                "song_id": key[0],
-                "ofsset_detection": value["ofsset_detection"],
-                "detection_time": self.num_a_tiempo(value["ofsset_detection"]),
-                "avg_counts_hashes_matched": avg_counts_hashes_matched
-            })
-        
-        # Ordenar los resultados por 'ofsset_detection'
-        final_results = sorted(final_results, key=lambda x: x["ofsset_detection"])
-        
-        # Crear un diccionario con el resultado final
-        result = {"results": final_results}
-        
-        # Convertir el diccionario a formato JSON y devolverlo
-        return result
\ No newline at end of file
+        # Unimos las detecciones de los chunks en segmentos de reproducción continua de cada canción
+        segments = build_timeline(json_data, threshold=threshold)
+        for segment in segments:
+            segment["detection_time"] = self.num_a_tiempo(segment["start"])
+            segment["end_time"] = self.num_a_tiempo(segment["end"])
+
+        return {"results": segments}
@@ -0,0 +1,273 @@
+import datetime
+import sys
+import wave
+from bisect import bisect_left
+from collections import deque
+from time import sleep, time
+from typing import BinaryIO, Callable, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from dejavu.base_classes.base_recognizer import BaseRecognizer
+from dejavu.config.settings import (DEFAULT_AMP_MIN, DEFAULT_FAN_VALUE,
+                                    DEFAULT_FS, DEFAULT_OVERLAP_RATIO,
+                                    DEFAULT_WINDOW_SIZE, MAX_HASH_TIME_DELTA,
+                                    OFFSET_SECS, PEAK_NEIGHBORHOOD_SIZE,
+                                    QUERY_TIME, RESULTS, STREAM_HOP,
+                                    STREAM_MIN_MATCHES, STREAM_WINDOW)
+from dejavu.logic.fingerprint import (generate_hashes, get_2D_peaks,
+                                      spectrogram)
+
+
+class StreamFingerprinter:
+    """
+    Fingerprints a channel as its samples arrive. Spectrogram frames are computed once, peaks are extracted
+    once their whole neighborhood is known and a hash is committed once every peak it can be paired with
+    is known, so the hashes committed for a stream are the ones `fingerprint` would give for all of it.
+    """
+    def __init__(self, Fs: int = DEFAULT_FS,
+                 wsize: int = DEFAULT_WINDOW_SIZE,
+                 wratio: float = DEFAULT_OVERLAP_RATIO,
+                 fan_value: int = DEFAULT_FAN_VALUE,
+                 amp_min: int = DEFAULT_AMP_MIN):
+        """
+        :param Fs: audio sampling rate.
+        :param wsize: FFT windows size.
+        :param wratio: ratio by which each sequential window overlaps the last and the next window.
+        :param fan_value: degree to which a fingerprint can be paired with its neighbors.
+        :param amp_min: minimum amplitude in spectrogram in order to be considered a peak.
+        """
+        self.Fs = Fs
+        self.wsize = wsize
+        self.wratio = wratio
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.hop = wsize - int(wsize * wratio)
+
+        # samples not yet turned into spectrogram frames, they start at the next frame.
+        self._samples = np.empty(0, dtype=np.int16)
+        # spectrogram frames kept to find the peaks of the next ones, starting at frame self._frames_start.
+        self._frames = None
+        self._frames_start = 0
+        self.frames = 0
+        # peaks are final for every frame before self._peaks_until.
+        self._peaks_until = 0
+        # final peaks (frequency, time) not yet used as anchor of a hash, sorted by time.
+        self._peaks: List[Tuple[int, int]] = []
+        # every hash anchored before this frame has been committed.
+        self.committed_until = 0
+
+    def push(self, samples: np.ndarray) -> List[Tuple[str, int]]:
+        """
+        Adds samples to the channel.
+
+        :param samples: new samples of the channel.
+        :return: the hashes committed thanks to them, as (hash, offset) tuples.
+        """
+        self._samples = np.concatenate((self._samples, samples))
+        # frames are computed at least two at a time, a single one makes specgram complain.
+        self._compute_frames(2)
+        self._find_peaks(self.frames - PEAK_NEIGHBORHOOD_SIZE)
+        return self._commit(max(self._hashes_cutoff(), self._peaks_until - MAX_HASH_TIME_DELTA))
+
+    def flush(self) -> List[Tuple[str, int]]:
+        """
+        Ends the channel, the last frames are processed as if they were the end of a file.
+
+        :return: the remaining hashes, as (hash, offset) tuples.
+        """
+        self._compute_frames(1)
+        self._find_peaks(self.frames)
+        return self._commit(self.frames)
+
+    def _compute_frames(self, min_frames: int) -> None:
+        nframes = (len(self._samples) - self.wsize) // self.hop + 1
+        if nframes < min_frames:
+            return
+
+        frames = spectrogram(self._samples[:(nframes - 1) * self.hop + self.wsize], Fs=self.Fs,
+                             wsize=self.wsize, wratio=self.wratio)
+        self._samples = self._samples[nframes * self.hop:]
+        self._frames = frames if self._frames is None else np.hstack((self._frames, frames))
+        self.frames += nframes
+
+    def _find_peaks(self, until: int) -> None:
+        if self._frames is None or until <= self._peaks_until:
+            return
+
+        # frames before self._peaks_until are only there as context, their peaks were already taken.
+        peaks = [(freq, self._frames_start + t) for freq, t in get_2D_peaks(self._frames, amp_min=self.amp_min)
+                 if self._peaks_until <= self._frames_start + t < until]
+        self._peaks.extend(sorted(peaks, key=lambda peak: peak[1]))
+        self._peaks_until = until
+
+        # keep as context the frames within the peak neighborhood of the next ones.
+        keep_from = max(until - PEAK_NEIGHBORHOOD_SIZE, self._frames_start)
+        self._frames = self._frames[:, keep_from - self._frames_start:]
+        self._frames_start = keep_from
+
+    def _hashes_cutoff(self) -> int:
+        # an anchor is complete once fan_value - 1 peaks follow it.
+        index = len(self._peaks) - self.fan_value + 1
+        return self._peaks[index][1] if index >= 0 and self._peaks else self.committed_until
+
+    def _commit(self, cutoff: int) -> List[Tuple[str, int]]:
+        if cutoff <= self.committed_until:
+            return []
+
+        anchors = bisect_left([t for _, t in self._peaks], cutoff)
+        hashes = [(hsh, int(offset)) for hsh, offset in generate_hashes(self._peaks[:anchors + self.fan_value - 1],
+                                                                        fan_value=self.fan_value)
+                  if offset < cutoff]
+        self._peaks = self._peaks[anchors:]
+        self.committed_until = cutoff
+        return hashes
+
+
+class StreamRecognizer(BaseRecognizer):
+    """
+    Recognizes a continuous stream of 16 bits PCM, as a WAV stream or raw samples, read from a pipe,
+    a growing file or the standard input (e.g. `ffmpeg -i <url> -f s16le -ac 1 -ar 44100 -`).
+    Every `STREAM_HOP` seconds the hashes of the last `STREAM_WINDOW` seconds are matched, hashes of the
+    overlapping part are kept from the previous queries instead of being generated again.
+    """
+    default_channels = 1
+    default_samplerate = DEFAULT_FS
+    # seconds of audio read from the stream at once.
+    default_read_seconds = 0.25
+
+    def __init__(self, dejavu):
+        super().__init__(dejavu)
+        self.window = STREAM_WINDOW
+        self.hop = STREAM_HOP
+        self.min_matches = STREAM_MIN_MATCHES
+
+    @staticmethod
+    def open_stream(stream: BinaryIO, channels: int, samplerate: int) -> Tuple[int, int]:
+        """
+        Reads the WAV header of the stream, if any, leaving it positioned at the first sample.
+
+        :param stream: buffered binary stream.
+        :param channels: number of channels of a raw stream.
+        :param samplerate: sampling rate of a raw stream.
+        :return: a tuple with the number of channels and the sampling rate of the stream.
+        """
+        if stream.peek(4)[:4] != b'RIFF':
+            return channels, samplerate
+
+        # only the header is used, a stream has no meaningful length so samples are read directly.
+        wav = wave.open(stream, 'rb')
+        if wav.getsampwidth() != 2:
+            raise ValueError(f"Only 16 bits PCM streams are supported, got {wav.getsampwidth() * 8} bits")
+        return wav.getnchannels(), wav.getframerate()
+
+    def listen(self, stream: BinaryIO, channels: int = default_channels, samplerate: int = default_samplerate,
+               follow: bool = False) -> Iterator[Dict[str, any]]:
+        """
+        Recognizes the stream as it is read.
+
+        :param stream: buffered binary stream.
+        :param channels: number of channels of a raw stream.
+        :param samplerate: sampling rate of a raw stream.
+        :param follow: if True the end of the stream is waited on, as in a file still being written.
+        :return: an iterator over the match events, each one the best match of a window with its
+         wall-clock timestamps.
+        """
+        channels, self.Fs = self.open_stream(stream, channels, samplerate)
+        fingerprinters = [StreamFingerprinter(Fs=self.Fs) for _ in range(channels)]
+        frame_seconds = fingerprinters[0].hop / self.Fs
+        window_frames = int(round(self.window / frame_seconds))
+        hop_frames = int(round(self.hop / frame_seconds))
+
+        # committed (offset, hash) of the last window, for each channel.
+        rings = [deque() for _ in range(channels)]
+        started_at = time()
+        last_query = 0
+
+        frame_bytes = 2 * channels
+        read_size = int(self.Fs * self.default_read_seconds) * frame_bytes
+        pending = b''
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                if follow:
+                    sleep(self.default_read_seconds)
+                    continue
+                break
+
+            data = pending + data
+            usable = len(data) - len(data) % frame_bytes
+            samples, pending = np.frombuffer(data[:usable], dtype=np.int16), data[usable:]
+            for channel, (fingerprinter, ring) in enumerate(zip(fingerprinters, rings)):
+                ring.extend((offset, hsh) for hsh, offset in fingerprinter.push(samples[channel::channels]))
+
+            end = min(fingerprinter.committed_until for fingerprinter in fingerprinters)
+            if end - last_query >= hop_frames:
+                last_query = end
+                event = self._query(rings, end, window_frames, frame_seconds, started_at)
+                if event:
+                    yield event
+
+        for fingerprinter, ring in zip(fingerprinters, rings):
+            ring.extend((offset, hsh) for hsh, offset in fingerprinter.flush())
+
+        end = min(fingerprinter.committed_until for fingerprinter in fingerprinters)
+        if end > last_query:
+            event = self._query(rings, end, window_frames, frame_seconds, started_at)
+            if event:
+                yield event
+
+    def _query(self, rings: List[deque], end: int, window_frames: int, frame_seconds: float,
+               started_at: float) -> Dict[str, any]:
+        start = max(end - window_frames, 0)
+        hashes = set()
+        for ring in rings:
+            while ring and ring[0][0] < start:
+                ring.popleft()
+            hashes |= {(hsh, offset - start) for offset, hsh in ring if offset < end}
+
+        if not hashes:
+            return None
+
+        matches, dedup_hashes, query_time = self.dejavu.find_matches(hashes)
+        results = self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
+        if not results or results[0]["count"] < self.min_matches:
+            return None
+
+        def wall_clock(seconds: float) -> str:
+            return datetime.datetime.fromtimestamp(started_at + seconds).isoformat(timespec='milliseconds')
+
+        match = results[0]
+        return {
+            "timestamp": wall_clock(end * frame_seconds),
+            "stream_offset": round(end * frame_seconds, 3),
+            "song_start": wall_clock(start * frame_seconds - match[OFFSET_SECS]),
+            QUERY_TIME: query_time,
+            RESULTS: results
+        }
+
+    def recognize(self, source: str = '-', channels: int = default_channels, samplerate: int = default_samplerate,
+                  follow: bool = False, on_match: Callable[[Dict[str, any]], None] = None) -> List[Dict[str, any]]:
+        """
+        Recognizes a stream until it ends.
+
+        :param source: path of the file or pipe to read, '-' for the standard input.
+        :param channels: number of channels of a raw stream.
+        :param samplerate: sampling rate of a raw stream.
+        :param follow: if True the end of the file is waited on, so the call only returns on errors.
+        :param on_match: optional callback called with each match event as soon as it happens.
+        :return: the list of match events, empty when `on_match` is given since the events are handed to it
+         instead of being kept, which would grow forever on a followed stream.
+        """
+        stream = sys.stdin.buffer if source == '-' else open(source, 'rb')
+        try:
+            events = []
+            for event in self.listen(stream, channels, samplerate, follow):
+                if on_match:
+                    on_match(event)
+                else:
+                    events.append(event)
+            return events
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
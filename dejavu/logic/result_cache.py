@@ -0,0 +1,258 @@
+import os
+import pickle
+import threading
+from collections import Counter, OrderedDict
+from hashlib import sha1
+from time import time
+from typing import Dict, Iterable, Tuple
+
+from dejavu.config.settings import (RESULT_CACHE_DIR, RESULT_CACHE_DIR_SIZE,
+                                    RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+# seconds between two sweeps of the directory, which also catch the files written by other processes.
+_SWEEP_INTERVAL = 60
+
+
+class ResultCache:
+    """
+    Cache of recognition results, so resubmitted audio (retries, the same ad aired on several stations)
+    skips the work already done. Results are keyed by the SHA1 of the file or by a digest of its hashes,
+    together with the options that change the result, and kept in memory with LRU eviction and an
+    optional directory shared among processes.
+
+    Results expire after `ttl` seconds and every result is dropped at once by `invalidate`, which must be
+    called whenever the catalog changes. Files in the directory are named after the generation of the catalog
+    they belong to, so older generations are deleted on `invalidate`, and the directory is swept every minute
+    or once it grows over `max_bytes`: expired files are deleted, and then the least recently used ones until
+    it fits.
+    """
+    def __init__(self, size: int = RESULT_CACHE_SIZE, ttl: float = RESULT_CACHE_TTL,
+                 directory: str = RESULT_CACHE_DIR, max_bytes: int = int(RESULT_CACHE_DIR_SIZE * 1024 * 1024)):
+        """
+        :param size: maximum number of results kept in memory.
+        :param ttl: seconds a result stays valid.
+        :param directory: optional directory where results are also stored.
+        :param max_bytes: maximum size of the results stored in the directory.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.directory = directory or None
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        # key => (generation, stored at, pickled result)
+        self._entries: OrderedDict = OrderedDict()
+        # results stored before the last change of the catalog belong to an older generation.
+        self._generation = 0
+        self._counters = Counter()
+        # bytes in the directory, as of the last sweep plus the files written since.
+        self._disk_bytes = 0
+        self._last_sweep = 0.0
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._sweep(self._current_generation())
+
+    @staticmethod
+    def file_key(file_hash: str, options: Dict[str, any]) -> str:
+        """
+        :param file_hash: SHA1 of the file.
+        :param options: options the result depends on.
+        :return: the key of the result of a file.
+        """
+        return sha1(f"file:{file_hash}:{sorted(options.items())}".encode()).hexdigest()
+
+    @staticmethod
+    def hashes_key(hashes: Iterable[Tuple[str, int]], options: Dict[str, any]) -> str:
+        """
+        :param hashes: (hash, offset) tuples generated from the audio.
+        :param options: options the result depends on.
+        :return: the key of the result of a set of hashes, the same whatever their order.
+        """
+        digest = sha1(f"hashes:{sorted(options.items())}".encode())
+        for hsh, offset in sorted(hashes):
+            digest.update(f"{hsh}:{offset};".encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> any:
+        """
+        :param key: key of the result.
+        :return: a copy of the result, None if it is not cached, has expired or belongs to an older
+         generation of the catalog.
+        """
+        generation = self._current_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._valid(entry, generation):
+                    self._entries.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return pickle.loads(entry[2])
+                del self._entries[key]
+                self._counters["expired"] += 1
+
+        entry = self._read(key, generation)
+        if entry is not None and self._valid(entry, generation):
+            with self._lock:
+                self._store(key, entry)
+                self._counters["disk_hits"] += 1
+            return pickle.loads(entry[2])
+
+        with self._lock:
+            self._counters["misses"] += 1
+        return None
+
+    def put(self, key: str, result: any) -> None:
+        """
+        Stores a result.
+
+        :param key: key of the result.
+        :param result: the result, it must be picklable.
+        """
+        generation = self._current_generation()
+        entry = (generation, time(), pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._store(key, entry)
+        if not self.directory:
+            return
+
+        data = pickle.dumps(entry)
+        self._write(self._path(key, generation), data)
+        with self._lock:
+            self._disk_bytes += len(data)
+            sweep = self._disk_bytes > self.max_bytes or time() - self._last_sweep > _SWEEP_INTERVAL
+        if sweep:
+            self._sweep(generation)
+
+    def invalidate(self) -> None:
+        """
+        Drops every result, in memory and on disk, since songs were added to or deleted from the catalog.
+        """
+        with self._lock:
+            self._generation = self._current_generation() + 1
+            self._entries.clear()
+            self._counters["invalidations"] += 1
+            if self.directory:
+                self._write(os.path.join(self.directory, "generation"), str(self._generation).encode())
+        if self.directory:
+            self._sweep(self._generation)
+
+    def count(self, name: str) -> None:
+        """
+        Counts an event in the statistics of the cache, such as a result answered straight from the catalog.
+
+        :param name: name of the event.
+        """
+        with self._lock:
+            self._counters[name] += 1
+
+    def stats(self) -> Dict[str, any]:
+        """
+        :return: hits (in memory, on disk and straight from the catalog), misses, expired entries,
+         evictions, invalidations, entries in memory and hit ratio.
+        """
+        with self._lock:
+            stats = {name: self._counters[name] for name in ("memory_hits", "disk_hits", "catalog_hits",
+                                                             "misses", "expired", "evictions",
+                                                             "disk_evictions", "invalidations")}
+            stats["entries"] = len(self._entries)
+
+        hits = stats["memory_hits"] + stats["disk_hits"] + stats["catalog_hits"]
+        stats["hit_ratio"] = hits / (hits + stats["misses"]) if hits + stats["misses"] else 0
+        return stats
+
+    def _valid(self, entry: Tuple[int, float, bytes], generation: int) -> bool:
+        return entry[0] == generation and time() - entry[1] <= self.ttl
+
+    def _store(self, key: str, entry: Tuple[int, float, bytes]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _current_generation(self) -> int:
+        # with a directory the generation is shared, so a catalog change made by another process also counts.
+        if not self.directory:
+            return self._generation
+        try:
+            with open(os.path.join(self.directory, "generation"), "rb") as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return self._generation
+
+    def _path(self, key: str, generation: int) -> str:
+        return os.path.join(self.directory, f"{generation}_{key}.pkl")
+
+    def _read(self, key: str, generation: int) -> Tuple[int, float, bytes]:
+        if not self.directory:
+            return None
+        path = self._path(key, generation)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        try:
+            if time() - entry[1] > self.ttl:
+                os.remove(path)
+            else:
+                # the modification time tells the sweep which files were used last.
+                os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def _sweep(self, generation: int) -> None:
+        """
+        Deletes the files of older generations and the expired ones, then the least recently used until the
+        directory fits in `max_bytes`.
+        """
+        now = time()
+        prefix = f"{generation}_"
+        files = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.endswith(".pkl"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if not entry.name.startswith(prefix) or now - stat.st_mtime > self.ttl:
+                        self._remove(entry.path)
+                    else:
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._counters["disk_evictions"] += evicted
+            self._disk_bytes = total
+            self._last_sweep = now
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        # another process may have deleted it already.
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        # written to a temporary file first so other processes never read it half written.
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def json_default(value):
+    """
+    `default` function for `json.dump`, numpy scalars and arrays found in the results are not JSON serializable.
+
+    :param value: object json does not know how to serialize.
+    :return: its JSON serializable equivalent.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, bytes):
+        return value.decode()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
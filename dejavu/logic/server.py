@@ -0,0 +1,263 @@
+import email
+import email.policy
+import json
+import os
+import tempfile
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import dejavu.logic.decoder as decoder
+from dejavu.config.settings import (ALIGN_TIME, CHUNK_EXECUTOR, DEFAULT_FS,
+                                    FINGERPRINT_TIME, QUERY_TIME,
+                                    SERVER_MAX_BODY, SERVER_PATH_ROOT,
+                                    SERVER_WORKERS)
+from dejavu.logic.coalescer import LookupCoalescer
+from dejavu.logic.executor import get_process_pool
+from dejavu.logic.metrics import get_metrics
+from dejavu.logic.recognizer.file_recognizer import (FileRecognizer,
+                                                     FileRecognizerChunks)
+from dejavu.logic.serialization import json_default
+
+
+class RequestError(Exception):
+    """
+    Error caused by the request, answered with the given HTTP status.
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class RecognitionServer(ThreadingHTTPServer):
+    """
+    HTTP service that keeps a Dejavu instance warm (catalog loaded, database connections pooled and
+    fingerprint workers started) and answers recognition requests with the JSON results of the file
+    recognizers, plus a breakdown of where the time of the request went.
+
+    POST /recognize?mode=file|chunks accepts:
+        - a JSON body with the `path` of a file under the `path_root` directory (and the chunk `options`),
+          only when a `path_root` is given.
+        - an audio file, as the raw body or as the `file` field of a multipart/form-data upload.
+        - raw 16 bits little-endian PCM with `format=pcm`, and its `channels` and `samplerate`.
+    GET /health answers once the service is ready and GET /stats gives the statistics of the lookup
+    coalescer, the result cache and the Bloom filter. GET /metrics exports the stage metrics in the
+    Prometheus text format, or as JSON with `format=json`, when metrics are enabled.
+    """
+    daemon_threads = True
+
+    def __init__(self, djv, address: Tuple[str, int], workers: int = SERVER_WORKERS,
+                 path_root: str = SERVER_PATH_ROOT):
+        """
+        :param djv: Dejavu instance shared by every request.
+        :param address: (host, port) to listen on.
+        :param workers: maximum number of recognitions running at once, and of decodings.
+        :param path_root: directory files requested by path must be in, None disables requests by path.
+        """
+        super().__init__(address, RecognitionHandler)
+        self.dejavu = djv
+        self.slots = threading.BoundedSemaphore(workers)
+        # decoding is limited apart, so requests are decoded while others are recognized.
+        self.decode_slots = threading.BoundedSemaphore(workers)
+        self.path_root = os.path.realpath(path_root) if path_root else None
+        self.warm_up()
+
+    def warm_up(self) -> None:
+        # leaves an open connection in the pool and starts the fingerprint workers before the first request.
+        self.dejavu.db.get_num_songs()
+        if CHUNK_EXECUTOR == 'process':
+            get_process_pool()
+
+    def recognize(self, mode: str, channels: List[np.ndarray], frame_rate: int, audio_duration: float,
+                  options: Dict[str, any]) -> Dict[str, any]:
+        """
+        Recognizes audio already decoded.
+
+        :param mode: 'file' for a single match of the whole audio, 'chunks' for the timeline of its chunks.
+        :param channels: samples of each channel.
+        :param frame_rate: sampling rate.
+        :param audio_duration: duration of the audio in milliseconds.
+        :param options: options of the chunk recognition.
+        :return: the recognition results.
+        """
+        with get_metrics().span("recognize", trace=True, recognizer=mode):
+            if mode == 'chunks':
+                return FileRecognizerChunks(self.dejavu).recognize_channels(channels, frame_rate, options)
+            return FileRecognizer(self.dejavu).recognize_channels(channels, frame_rate, audio_duration)
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    server: RecognitionServer
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        if path == '/health':
+            self._send(200, {"status": "ok"})
+        elif path == '/stats':
+            lookups, cache = self.server.dejavu.lookups, self.server.dejavu.result_cache
+            bloom = self.server.dejavu.db.bloom
+            self._send(200, {"lookups": lookups.stats() if isinstance(lookups, LookupCoalescer) else None,
+                             "result_cache": cache.stats() if cache is not None else None,
+                             "bloom_filter": bloom.stats() if bloom is not None else None})
+        elif path == '/metrics':
+            metrics = get_metrics()
+            if parse_qs(url.query).get('format', [''])[-1] == 'json':
+                self._send(200, metrics.to_json())
+            else:
+                self._send_text(200, metrics.prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        t = time()
+        # a request answered without a lookup (a result cache hit, for instance) must not report an older one.
+        lookups = self.server.dejavu.lookups
+        if isinstance(lookups, LookupCoalescer):
+            lookups.reset_request()
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path != '/recognize':
+                raise RequestError(404, f"Unknown path {url.path}")
+            mode = params.get('mode', 'file')
+            if mode not in ('file', 'chunks'):
+                raise RequestError(400, f"Unknown mode {mode}, expected 'file' or 'chunks'")
+
+            body = self._read_body()
+            latency = {"receive": time() - t}
+
+            # decoding has its own slots, so it overlaps with the recognition of other requests.
+            t_decode = time()
+            with self.server.decode_slots:
+                channels, frame_rate, audio_duration, options = self._decode(body, params, mode)
+            latency["decode"] = time() - t_decode
+
+            t_queue = time()
+            with self.server.slots:
+                latency["queue"] = time() - t_queue
+                t_recognize = time()
+                results = self.server.recognize(mode, channels, frame_rate, audio_duration, options)
+                latency["recognize"] = time() - t_recognize
+
+            for key in (FINGERPRINT_TIME, QUERY_TIME, ALIGN_TIME):
+                if key in results:
+                    latency[key.replace('_time', '')] = results[key]
+            if isinstance(lookups, LookupCoalescer) and lookups.last_request():
+                latency["lookup_wait"] = lookups.last_request()["wait"]
+            latency["total"] = time() - t
+            self._send(200, {**results, "latency": latency})
+
+        except RequestError as e:
+            self._send(e.status, {"error": str(e)})
+        except Exception as e:
+            self.log_error("%s", traceback.format_exc())
+            self._send(500, {"error": str(e)})
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        if length <= 0:
+            raise RequestError(400, "Empty request body")
+        if length > SERVER_MAX_BODY * 1024 * 1024:
+            raise RequestError(413, f"Request body larger than {SERVER_MAX_BODY} MB")
+        return self.rfile.read(length)
+
+    def _decode(self, body: bytes, params: Dict[str, str], mode: str) \
+            -> Tuple[List[np.ndarray], int, float, Dict[str, any]]:
+        content_type = self.headers.get_content_type()
+        limit = self.server.dejavu.limit if mode == 'file' else None
+
+        if content_type == 'application/json':
+            try:
+                request = json.loads(body)
+                path = request['path']
+            except (ValueError, KeyError, TypeError):
+                raise RequestError(400, "JSON requests must be an object with the 'path' of the file")
+            channels, frame_rate, _, audio_duration = decoder.read(self._local_path(path), limit)
+            return channels, frame_rate, audio_duration, request.get('options', {})
+
+        if params.get('format') == 'pcm':
+            try:
+                nchannels = int(params.get('channels', 1))
+                frame_rate = int(params.get('samplerate', DEFAULT_FS))
+            except ValueError:
+                raise RequestError(400, "channels and samplerate must be integers")
+            if nchannels < 1 or frame_rate < 1:
+                raise RequestError(400, "channels and samplerate must be positive")
+            samples = np.frombuffer(body[:len(body) - len(body) % (2 * nchannels)], dtype=np.int16)
+            channels = [samples[channel::nchannels] for channel in range(nchannels)]
+            audio_duration = len(channels[0]) * 1000 / frame_rate
+            if limit:
+                channels = [channel[:int(limit * frame_rate)] for channel in channels]
+            return channels, frame_rate, audio_duration, {}
+
+        filename = params.get('filename', '')
+        if content_type == 'multipart/form-data':
+            body, filename = self._upload(body)
+
+        # the upload is saved to a file so ffmpeg can guess its format as with any other file.
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            channels, frame_rate, _, audio_duration = decoder.read(path, limit)
+        finally:
+            os.remove(path)
+        return channels, frame_rate, audio_duration, {}
+
+    def _local_path(self, path: str) -> str:
+        # only files under the configured root are read, whatever links or '..' the path goes through.
+        root = self.server.path_root
+        if root is None:
+            raise RequestError(403, "Requests by path are disabled, send the audio instead")
+        path = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, path]) != root:
+            raise RequestError(403, "The path is outside of the directory files can be requested from")
+        if not os.path.isfile(path):
+            raise RequestError(404, "File not found")
+        return path
+
+    def _upload(self, body: bytes) -> Tuple[bytes, str]:
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        message = email.message_from_bytes(header + body, policy=email.policy.HTTP)
+        for part in message.iter_parts():
+            if part.get_filename() is not None or part.get_param('name', header='content-disposition') == 'file':
+                return part.get_payload(decode=True), part.get_filename() or ''
+        raise RequestError(400, "The upload has no 'file' field")
+
+    def _send(self, status: int, content: Dict[str, any]) -> None:
+        self._send_text(status, json.dumps(content, default=json_default), 'application/json')
+
+    def _send_text(self, status: int, content: str, content_type: str) -> None:
+        data = content.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(djv, host: str = '127.0.0.1', port: int = 8000, workers: int = SERVER_WORKERS,
+          path_root: str = SERVER_PATH_ROOT) -> None:
+    """
+    Runs the recognition service until it is interrupted.
+
+    :param djv: Dejavu instance shared by every request.
+    :param host: address to listen on.
+    :param port: port to listen on.
+    :param workers: maximum number of recognitions running at once.
+    :param path_root: directory files requested by path must be in, None disables requests by path.
+    """
+    server = RecognitionServer(djv, (host, port), workers, path_root)
+    print(f"Listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,172 @@
+from typing import Dict, List
+
+from dejavu.config.settings import (AUDIO_DURATION, RETURN_AUDIO_INFO,
+                                    SONG_ID, SONG_NAME, TIMELINE_MAX_GAP,
+                                    TIMELINE_OFFSET_TOLERANCE)
+
+
+class Segment:
+    """
+    Continuous play of a song, made of the chunks that detected it with a consistent aligned offset.
+    """
+    def __init__(self, song_id: int, song_name: str, song_duration: float = None):
+        """
+        :param song_id: song identifier.
+        :param song_name: song name.
+        :param song_duration: length of the song in milliseconds, as stored in the database, None if unknown.
+        """
+        self.song_id = song_id
+        self.song_name = song_name
+        self.song_duration = song_duration
+        self.first_chunk = None
+        self.last_chunk = None
+        self.chunks = 0
+        # sums weighted by the aligned matches of each chunk.
+        self._count = 0
+        self._offset_sum = 0.0
+        self._confidence_sum = 0.0
+
+    @property
+    def offset(self) -> float:
+        """
+        Position of the beginning of the song in the audio, it is negative when the audio starts mid-song.
+        """
+        return self._offset_sum / self._count
+
+    def add(self, chunk_start: float, chunk_end: float, song_start: float, confidence: float, count: int) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = chunk_start
+        self.last_chunk = chunk_end if self.last_chunk is None else max(self.last_chunk, chunk_end)
+        self.chunks += 1
+        weight = max(count, 1)
+        self._count += weight
+        self._offset_sum += song_start * weight
+        self._confidence_sum += confidence * weight
+
+    def as_dict(self) -> Dict[str, any]:
+        # within the chunks that detected it, the song cannot be heard before its beginning nor after its end.
+        start = min(max(self.first_chunk, self.offset), self.last_chunk)
+        end = self.last_chunk
+        if self.song_duration:
+            end = min(end, self.offset + self.song_duration / 1000)
+
+        return {
+            SONG_ID: self.song_id,
+            SONG_NAME: self.song_name,
+            "start": round(start, 3),
+            "end": round(max(end, start), 3),
+            "ofsset_detection": round(self.offset, 3),
+            "avg_counts_hashes_matched": round(self._confidence_sum / self._count, 2),
+            "chunks": self.chunks
+        }
+
+
+class TimelineBuilder:
+    """
+    Merges the best match of each chunk into segments of continuous play. Two chunks belong to the same
+    segment when they detect the same song with the same aligned offset (the song started at the same
+    moment of the audio) and are not separated by more than `max_gap` seconds, so a chunk with a different
+    or no detection in between does not split a segment, while the same song played twice gives two.
+
+    Chunks must be added in order of their start, segments are returned as soon as no later chunk can
+    extend them.
+    """
+    def __init__(self, offset_tolerance: float = TIMELINE_OFFSET_TOLERANCE, max_gap: float = TIMELINE_MAX_GAP,
+                 threshold: float = 0):
+        """
+        :param offset_tolerance: maximum difference, in seconds, between the aligned offsets of a segment.
+        :param max_gap: maximum time, in seconds, without detections of the song before its segment is closed.
+        :param threshold: detections whose 'avg_counts_hashes_matched' is not above it are ignored.
+        """
+        self.offset_tolerance = offset_tolerance
+        self.max_gap = max_gap
+        self.threshold = threshold
+        self._open: List[Segment] = []
+        self._position = float("-inf")
+
+    def add(self, chunk_start: float, chunk_end: float, detection: Dict[str, any] = None) -> List[Dict[str, any]]:
+        """
+        Adds the result of a chunk.
+
+        :param chunk_start: second of the audio where the chunk starts.
+        :param chunk_end: second of the audio where the chunk ends.
+        :param detection: best match of the chunk, with its 'song_id', 'ofsset_detection' (second of the audio
+         where the song starts), 'avg_counts_hashes_matched' and optionally 'song_name', 'count' and
+         'audio_duration' (milliseconds). None if nothing was detected.
+        :return: the segments closed by this chunk.
+        """
+        if chunk_start < self._position:
+            raise ValueError(f"Chunks must be added in order, got {chunk_start} after {self._position}")
+        self._position = chunk_start
+
+        closed = self._close(lambda segment: segment.last_chunk + self.max_gap < chunk_start)
+
+        if detection and detection["avg_counts_hashes_matched"] > self.threshold:
+            song_start = detection["ofsset_detection"]
+            segment = next((segment for segment in self._open if segment.song_id == detection[SONG_ID]
+                            and abs(segment.offset - song_start) <= self.offset_tolerance), None)
+            if segment is None:
+                # without RETURN_AUDIO_INFO the duration of the match is a placeholder, not the one of the song.
+                song_duration = detection.get(AUDIO_DURATION) if RETURN_AUDIO_INFO else None
+                segment = Segment(detection[SONG_ID], detection.get(SONG_NAME), song_duration)
+                self._open.append(segment)
+            segment.add(chunk_start, chunk_end, song_start, detection["avg_counts_hashes_matched"],
+                        detection.get("count", 1))
+
+        return closed
+
+    def state(self) -> Dict[str, any]:
+        """
+        :return: the open segments and the position of the builder, as a JSON serializable dictionary.
+        """
+        return {
+            "position": self._position,
+            "open": [dict(vars(segment)) for segment in self._open]
+        }
+
+    def restore(self, state: Dict[str, any]) -> None:
+        """
+        Restores the open segments and position saved by `state`.
+
+        :param state: dictionary returned by `state`.
+        """
+        self._position = state["position"]
+        self._open = []
+        for attributes in state["open"]:
+            segment = Segment.__new__(Segment)
+            vars(segment).update(attributes)
+            self._open.append(segment)
+
+    def flush(self) -> List[Dict[str, any]]:
+        """
+        Closes every open segment, once the audio is over.
+
+        :return: the segments still open.
+        """
+        return self._close(lambda segment: True)
+
+    def _close(self, condition) -> List[Dict[str, any]]:
+        closed = [segment for segment in self._open if condition(segment)]
+        self._open = [segment for segment in self._open if not condition(segment)]
+        return sorted((segment.as_dict() for segment in closed), key=lambda segment: segment["start"])
+
+
+def build_timeline(chunks: List[Dict[str, any]], offset_tolerance: float = TIMELINE_OFFSET_TOLERANCE,
+                   max_gap: float = TIMELINE_MAX_GAP, threshold: float = 0) -> List[Dict[str, any]]:
+    """
+    Builds the whole timeline of a list of chunk results in a single pass.
+
+    :param chunks: dictionaries with the 'chunk_start' and 'chunk_end' of each chunk and the keys of its
+     detection as described in `TimelineBuilder.add`, chunks without a detection may be left out.
+    :param offset_tolerance: maximum difference, in seconds, between the aligned offsets of a segment.
+    :param max_gap: maximum time, in seconds, without detections of the song before its segment is closed.
+    :param threshold: detections whose 'avg_counts_hashes_matched' is not above it are ignored.
+    :return: the segments, sorted by start.
+    """
+    builder = TimelineBuilder(offset_tolerance, max_gap, threshold)
+    segments = []
+    for chunk in sorted(chunks, key=lambda chunk: chunk["chunk_start"]):
+        segments.extend(builder.add(chunk["chunk_start"], chunk["chunk_end"], chunk))
+    segments.extend(builder.flush())
+
+    return sorted(segments, key=lambda segment: segment["start"])
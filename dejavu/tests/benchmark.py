@@ -0,0 +1,417 @@
+import os
+import platform
+import subprocess
+import tempfile
+import wave
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from shutil import rmtree
+from time import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import dejavu.logic.decoder as decoder
+from dejavu.config.settings import (CONNECTIVITY_MASK, DEFAULT_AMP_MIN,
+                                    DEFAULT_FAN_VALUE, DEFAULT_FS,
+                                    DEFAULT_OVERLAP_RATIO, DEFAULT_WINDOW_SIZE,
+                                    FINGERPRINT_REDUCTION, MAX_HASH_TIME_DELTA,
+                                    MIN_HASH_TIME_DELTA,
+                                    PEAK_NEIGHBORHOOD_SIZE, PEAK_SORT,
+                                    SONG_ID)
+from dejavu.logic.fingerprint import (generate_hashes, get_2D_peaks,
+                                      spectrogram)
+from dejavu.logic.recognizer.file_recognizer import FileRecognizerChunks
+
+# kinds of synthetic audio, 'mixed' adds the other three together.
+SIGNALS = ('tone', 'chirp', 'noise', 'mixed')
+
+# stages timed, in the order they run.
+STAGES = ('decode', 'specgram', 'peaks', 'hashes', 'insert', 'return_matches', 'align')
+
+# executors the chunks of a file can be fingerprinted with, see CHUNK_EXECUTOR.
+CHUNK_EXECUTORS = ('inline', 'thread', 'process')
+
+
+def synthesize(kind: str, seconds: float, fs: int = DEFAULT_FS, seed: int = 0) -> np.ndarray:
+    """
+    Generates deterministic synthetic audio, the same kind, length and seed always give the same samples.
+
+    :param kind: 'tone' (a sequence of fading notes with harmonics), 'chirp' (frequency sweeps), 'noise' (white
+     noise shaped by a random spectral envelope) or 'mixed' (all of them together).
+    :param seconds: length of the audio.
+    :param fs: sampling rate.
+    :param seed: seed of the random generator.
+    :return: 16 bits samples.
+    """
+    rng = np.random.RandomState(seed)
+    n = int(seconds * fs)
+    t = np.arange(n) / fs
+
+    if kind == 'tone':
+        signal = np.zeros(n)
+        start = 0
+        while start < n:
+            end = min(start + int(rng.uniform(0.2, 0.6) * fs), n)
+            base = rng.uniform(110, 1760)
+            # each note fades out after its attack, as a plucked or struck one.
+            envelope = np.exp(-np.arange(end - start) / fs * rng.uniform(3, 10))
+            for harmonic in range(1, 4):
+                signal[start:end] += np.sin(2 * np.pi * base * harmonic * t[start:end]) / harmonic * envelope
+            start = end
+    elif kind == 'chirp':
+        # the phase is the integral of the frequency, so consecutive sweeps join without clicks.
+        frequency = np.empty(n)
+        start = 0
+        while start < n:
+            end = min(start + int(rng.uniform(0.5, 1.5) * fs), n)
+            frequency[start:end] = np.linspace(rng.uniform(200, 5000), rng.uniform(200, 5000), end - start)
+            start = end
+        signal = np.sin(2 * np.pi * np.cumsum(frequency) / fs)
+    elif kind == 'noise':
+        spectrum = np.fft.rfft(rng.standard_normal(n))
+        envelope = np.interp(np.linspace(0, 1, spectrum.size), np.linspace(0, 1, 32), rng.uniform(0.1, 1, 32))
+        signal = np.fft.irfft(spectrum * envelope, n)
+    elif kind == 'mixed':
+        signal = sum(synthesize(part, seconds, fs, seed + offset).astype(np.float64)
+                     for offset, part in enumerate(('tone', 'chirp', 'noise')))
+    else:
+        raise ValueError(f"Unknown signal kind: {kind}, expected one of {', '.join(SIGNALS)}")
+
+    return (signal / (np.abs(signal).max() or 1) * 0.8 * np.iinfo(np.int16).max).astype(np.int16)
+
+
+def add_noise(samples: np.ndarray, snr: float, seed: int = 0) -> np.ndarray:
+    """
+    :param samples: 16 bits samples.
+    :param snr: signal to noise ratio of the result, in dB.
+    :param seed: seed of the random generator.
+    :return: the samples with white noise added.
+    """
+    signal = samples.astype(np.float64)
+    power = np.mean(signal ** 2) / 10 ** (snr / 10)
+    noisy = signal + np.random.RandomState(seed).standard_normal(signal.size) * np.sqrt(power)
+    return np.clip(noisy, np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+
+def write_wav(path: str, samples: np.ndarray, fs: int = DEFAULT_FS) -> None:
+    """
+    Writes mono 16 bits samples to a wav file.
+    """
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(fs)
+        wav.writeframes(samples.tobytes())
+
+
+class StageTimer:
+    """
+    Collects the seconds taken by every run of each stage.
+    """
+    def __init__(self):
+        self.times: Dict[str, List[float]] = defaultdict(list)
+
+    @contextmanager
+    def __call__(self, stage: str):
+        t = time()
+        yield
+        self.times[stage].append(time() - t)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        :return: for each stage the number of runs and their total, mean, median, 95th percentile and
+         maximum seconds.
+        """
+        summary = {}
+        for stage in STAGES:
+            times = np.array(self.times.get(stage, []))
+            if not times.size:
+                continue
+            summary[stage] = {
+                "runs": int(times.size),
+                "total": float(times.sum()),
+                "mean": float(times.mean()),
+                "p50": float(np.percentile(times, 50)),
+                "p95": float(np.percentile(times, 95)),
+                "max": float(times.max())
+            }
+        return summary
+
+
+class Benchmark:
+    """
+    Times each stage of fingerprinting and recognition in-process, on synthetic audio, so results only
+    depend on the engine and the database and not on external files, ffmpeg or process startup.
+
+    A catalog of `songs` synthetic songs is written to wav files, decoded, fingerprinted and inserted, then
+    a noisy excerpt of each song is decoded, fingerprinted, matched and aligned `repeat` times. With `files`
+    the catalog is made of those audio files instead, and the queries of excerpts of their first channel.
+    """
+    def __init__(self, djv, songs: int = 10, seconds: float = 30, query_seconds: float = 5, snr: float = 20,
+                 signals: Tuple[str, ...] = SIGNALS, seed: int = 0, repeat: int = 1, files: List[str] = None):
+        """
+        :param djv: Dejavu instance whose database is benchmarked.
+        :param songs: number of songs in the catalog.
+        :param seconds: length of each song.
+        :param query_seconds: length of each query excerpt.
+        :param snr: signal to noise ratio of the queries, in dB.
+        :param signals: kinds of audio the songs cycle through.
+        :param seed: seed all the audio is generated from.
+        :param repeat: number of times every query is recognized.
+        :param files: audio files the catalog is made of, instead of synthetic songs.
+        """
+        self.dejavu = djv
+        self.files = list(files) if files else None
+        self.songs = len(self.files) if self.files else songs
+        self.seconds = None if self.files else seconds
+        self.query_seconds = query_seconds if self.files else min(query_seconds, seconds)
+        self.snr = snr
+        self.signals = ('file',) if self.files else tuple(signals)
+        self.seed = seed
+        self.repeat = repeat
+        self.timer = StageTimer()
+        # seconds taken by each recognition, from decoding the query to aligning its matches.
+        self.latencies: List[float] = []
+        # ids of the songs inserted by the benchmark.
+        self.song_ids: List[int] = []
+
+    def run(self) -> Dict[str, any]:
+        """
+        :return: the parameters of the run, the environment, the timings of each stage, the throughput,
+         the latency and the accuracy of the recognitions and the size of the fingerprints.
+        """
+        folder = tempfile.mkdtemp(prefix="dejavu_benchmark_")
+        try:
+            t = time()
+            catalog_hashes = 0
+            catalog_seconds = 0
+            for index in range(self.songs):
+                if self.files:
+                    path = self.files[index]
+                else:
+                    path = os.path.join(folder, f"song_{index}.wav")
+                    write_wav(path, synthesize(self._kind(index), self.seconds, seed=self.seed + index))
+                hashes, audio_duration = self._insert(path, f"benchmark_{self.seed}_{index}")
+                catalog_hashes += hashes
+                catalog_seconds += audio_duration / 1000
+            catalog_time = time() - t
+
+            t = time()
+            correct = defaultdict(int)
+            for index, song_id in enumerate(self.song_ids):
+                path = os.path.join(folder, f"query_{index}.wav")
+                samples, fs = self._samples(index)
+                rng = np.random.RandomState(self.seed + index)
+                start = int(rng.uniform(0, max(samples.size / fs - self.query_seconds, 0)) * fs)
+                write_wav(path, add_noise(samples[start: start + int(self.query_seconds * fs)], self.snr,
+                                          seed=self.seed + index), fs)
+                for _ in range(self.repeat):
+                    started = time()
+                    results = self._recognize(path)
+                    self.latencies.append(time() - started)
+                    correct[self._kind(index)] += 1 if results and results[0][SONG_ID] == song_id else 0
+            query_time = time() - t
+        finally:
+            rmtree(folder, ignore_errors=True)
+
+        queries = len(self.song_ids) * self.repeat
+        # synthetic signals differ a lot in how well they survive the noise, so accuracy is also given per kind.
+        kind_queries = {kind: sum(self.repeat for index in range(self.songs) if self._kind(index) == kind)
+                        for kind in self.signals}
+        accuracy = {kind: correct[kind] / kind_queries[kind] for kind in self.signals if kind_queries[kind]}
+        latencies = np.array(self.latencies)
+        return {
+            "parameters": {"songs": self.songs, "seconds": self.seconds, "query_seconds": self.query_seconds,
+                           "snr": self.snr, "signals": list(self.signals), "seed": self.seed,
+                           "repeat": self.repeat, "files": self.files},
+            "environment": environment(self.dejavu),
+            "stages": self.timer.summary(),
+            "throughput": {
+                # seconds of audio fingerprinted and inserted per second.
+                "catalog_realtime_factor": catalog_seconds / catalog_time if catalog_time else 0,
+                "catalog_hashes": catalog_hashes,
+                "queries_per_second": queries / query_time if query_time else 0
+            },
+            "storage": {
+                "catalog_seconds": catalog_seconds,
+                "hashes_per_second": catalog_hashes / catalog_seconds if catalog_seconds else 0,
+                "bytes": storage_bytes(catalog_hashes),
+                "bytes_per_second": storage_bytes(catalog_hashes) / catalog_seconds if catalog_seconds else 0
+            },
+            "latency": {
+                "mean": float(latencies.mean()) if latencies.size else 0,
+                "p50": float(np.percentile(latencies, 50)) if latencies.size else 0,
+                "p95": float(np.percentile(latencies, 95)) if latencies.size else 0,
+                "p99": float(np.percentile(latencies, 99)) if latencies.size else 0
+            },
+            "accuracy": {"queries": queries, "correct": sum(correct.values()),
+                         "ratio": sum(correct.values()) / queries if queries else 0, "signals": accuracy}
+        }
+
+    def cleanup(self) -> None:
+        """
+        Deletes the songs inserted by the benchmark from the database.
+        """
+        if self.song_ids:
+            self.dejavu.delete_songs_by_id(self.song_ids)
+            self.song_ids = []
+
+    def _kind(self, index: int) -> str:
+        return self.signals[index % len(self.signals)]
+
+    def _samples(self, index: int) -> Tuple[np.ndarray, int]:
+        # audio of a song of the catalog and its sampling rate, to cut its query from.
+        if self.files:
+            channels, fs, _, _ = decoder.read(self.files[index])
+            return np.asarray(channels[0], dtype=np.int16), fs
+        return synthesize(self._kind(index), self.seconds, seed=self.seed + index), DEFAULT_FS
+
+    def _fingerprint(self, path: str) -> Tuple[List[Tuple[str, int]], float, str]:
+        with self.timer('decode'):
+            channels, frame_rate, file_hash, audio_duration = decoder.read(path)
+
+        hashes = set()
+        for channel in channels:
+            with self.timer('specgram'):
+                arr2D = spectrogram(channel, Fs=frame_rate)
+            with self.timer('peaks'):
+                peaks = get_2D_peaks(arr2D)
+            with self.timer('hashes'):
+                hashes |= set(generate_hashes(peaks))
+        return list(hashes), audio_duration, file_hash
+
+    def _insert(self, path: str, song_name: str) -> Tuple[int, float]:
+        hashes, audio_duration, file_hash = self._fingerprint(path)
+        db = self.dejavu.db
+        with self.timer('insert'):
+            song_id = db.insert_song(song_name, file_hash, len(hashes), audio_duration)
+            db.insert_hashes(song_id, hashes)
+            db.set_song_fingerprinted(song_id)
+        self.song_ids.append(song_id)
+        return len(hashes), audio_duration
+
+    def _recognize(self, path: str) -> List[Dict[str, any]]:
+        hashes, _, _ = self._fingerprint(path)
+        with self.timer('return_matches'):
+            matches, dedup_hashes = self.dejavu.db.return_matches(hashes, subset=self.dejavu.subset)
+        with self.timer('align'):
+            return self.dejavu.align_matches(matches, dedup_hashes, len(hashes))
+
+
+def chunk_scaling(djv, executors: Tuple[str, ...] = CHUNK_EXECUTORS, workers: Tuple[int, ...] = (1, 2, 4),
+                  seconds: float = 60, seed: int = 0, repeat: int = 3) -> List[Dict[str, any]]:
+    """
+    Times the recognition by chunks of a synthetic file with each executor and number of workers, to see
+    how it scales with the cores. The file is inserted in the catalog first, so every chunk is matched and
+    aligned too, and deleted at the end.
+
+    :param djv: Dejavu instance whose database is used.
+    :param executors: executors to time, 'inline' is only run once as it has no workers.
+    :param workers: numbers of workers to time the other executors with.
+    :param seconds: length of the file.
+    :param seed: seed the audio is generated from.
+    :param repeat: number of recognitions timed for each configuration, the fastest one is kept.
+    :return: for each configuration the seconds taken, the seconds of audio recognized per second, the
+     number of chunks detected and the speedup over 'inline' (or over the first configuration without it).
+    """
+    samples = synthesize('mixed', seconds, seed=seed)
+    hashes, _ = djv.generate_fingerprints(samples, Fs=DEFAULT_FS)
+    song_id = djv.db.insert_song(f"chunk_scaling_{seed}", f"chunk_scaling_{seed}", len(hashes),
+                                 int(seconds * 1000))
+    djv.db.insert_hashes(song_id, hashes)
+    djv.db.set_song_fingerprinted(song_id)
+
+    runs = []
+    try:
+        for executor in executors:
+            for count in ((1,) if executor == 'inline' else workers):
+                recognizer = FileRecognizerChunks(djv, executor, count)
+                # the first recognition starts the pool of the executor, it is not timed.
+                recognizer.recognize_chunks([samples], DEFAULT_FS, {})
+                times = []
+                for _ in range(repeat):
+                    t = time()
+                    detections = recognizer.recognize_chunks([samples], DEFAULT_FS, {})
+                    times.append(time() - t)
+                runs.append({"executor": executor, "workers": count, "seconds": min(times),
+                             "realtime_factor": seconds / min(times) if min(times) else 0,
+                             "detections": len(detections)})
+    finally:
+        djv.delete_songs_by_id([song_id])
+
+    baseline = next((run for run in runs if run["executor"] == 'inline'), runs[0] if runs else None)
+    for run in runs:
+        run["speedup"] = baseline["seconds"] / run["seconds"] if run["seconds"] else None
+    return runs
+
+
+def storage_bytes(hashes: int) -> int:
+    """
+    Estimates the space the fingerprints take in the MySQL schema: the row (hash, song id, offset, two
+    datetimes and the hidden row id of InnoDB) plus the entries of the hash index and of the unique key.
+    Page and fill factor overheads are left out, so it is only good to compare settings with each other.
+
+    :param hashes: number of fingerprints stored.
+    :return: estimated bytes.
+    """
+    hash_bytes = FINGERPRINT_REDUCTION // 2
+    row = hash_bytes + 3 + 4 + 2 * 5 + 6
+    hash_index = hash_bytes + 6
+    unique_key = 3 + 4 + hash_bytes + 6
+    return hashes * (row + hash_index + unique_key)
+
+
+def environment(djv) -> Dict[str, any]:
+    """
+    :param djv: Dejavu instance benchmarked.
+    :return: what the timings depend on besides the code: versions, machine, database and the
+     fingerprinting settings.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "database": djv.db.type,
+        "settings": {
+            "DEFAULT_FS": DEFAULT_FS, "DEFAULT_WINDOW_SIZE": DEFAULT_WINDOW_SIZE,
+            "DEFAULT_OVERLAP_RATIO": DEFAULT_OVERLAP_RATIO, "DEFAULT_FAN_VALUE": DEFAULT_FAN_VALUE,
+            "DEFAULT_AMP_MIN": DEFAULT_AMP_MIN, "PEAK_NEIGHBORHOOD_SIZE": PEAK_NEIGHBORHOOD_SIZE,
+            "CONNECTIVITY_MASK": CONNECTIVITY_MASK, "PEAK_SORT": PEAK_SORT,
+            "MIN_HASH_TIME_DELTA": MIN_HASH_TIME_DELTA, "MAX_HASH_TIME_DELTA": MAX_HASH_TIME_DELTA,
+            "FINGERPRINT_REDUCTION": FINGERPRINT_REDUCTION
+        }
+    }
+
+
+def compare(baseline: Dict[str, any], current: Dict[str, any]) -> Dict[str, any]:
+    """
+    Compares two benchmark results, for instance before and after a change.
+
+    :param baseline: results of the reference run.
+    :param current: results of the new run.
+    :return: for each stage in both runs the mean seconds of each one and their ratio (below 1 means the
+     current run is faster), and the accuracy of both runs.
+    """
+    stages = {}
+    for stage in STAGES:
+        if stage in baseline["stages"] and stage in current["stages"]:
+            before, after = baseline["stages"][stage]["mean"], current["stages"][stage]["mean"]
+            stages[stage] = {"baseline": before, "current": after, "ratio": after / before if before else None}
+
+    return {
+        "stages": stages,
+        "accuracy": {"baseline": baseline["accuracy"]["ratio"], "current": current["accuracy"]["ratio"]},
+        "same_parameters": baseline["parameters"] == current["parameters"]
+    }
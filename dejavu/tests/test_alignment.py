@@ -0,0 +1,62 @@
+from itertools import groupby
+
+import numpy as np
+import pytest
+
+from dejavu.logic.alignment import (grouped_histogram, grouped_top_matches,
+                                    offset_histogram, top_matches)
+
+
+def groupby_top_matches(song_ids, offsets, topn):
+    # the sort/groupby implementation top_matches replaced.
+    counts = list(zip(*(column.tolist() for column in offset_histogram(song_ids, offsets))))
+    songs_matches = sorted(
+        [max(list(group), key=lambda g: g[2]) for key, group in groupby(counts, key=lambda count: count[0])],
+        key=lambda count: count[2], reverse=True
+    )
+    return songs_matches[0:topn]
+
+
+def matches(seed, size=2000, songs=20, offsets=10):
+    # few songs and offsets so counts tie often, both within a song and between songs.
+    rng = np.random.RandomState(seed)
+    return rng.randint(1, songs + 1, size), rng.randint(-offsets, offsets, size)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("topn", [0, 1, 2, 5, 19, 20, 50])
+def test_same_as_groupby(seed, topn):
+    song_ids, offsets = matches(seed)
+    result = list(zip(*(column.tolist() for column in top_matches(song_ids, offsets, topn=topn))))
+    assert result == groupby_top_matches(song_ids, offsets, topn)
+
+
+def test_ties_resolved_by_lowest_offset_then_song_id():
+    song_ids = np.array([3, 3, 3, 3, 1, 1, 2, 2])
+    offsets = np.array([5, 5, 2, 2, 7, 7, 4, 4])
+    result = list(zip(*(column.tolist() for column in top_matches(song_ids, offsets, topn=2))))
+    assert result == [(1, 7, 2), (2, 4, 2)] == groupby_top_matches(song_ids, offsets, 2)
+
+
+@pytest.mark.parametrize("topn", [0, -1])
+def test_no_songs_requested(topn):
+    song_ids, offsets = matches(0)
+    assert all(column.size == 0 for column in top_matches(song_ids, offsets, topn=topn))
+
+
+def test_no_matches():
+    empty = np.empty(0, dtype=np.int64)
+    assert all(column.size == 0 for column in top_matches(empty, empty, topn=5))
+
+
+@pytest.mark.parametrize("topn", [0, 1, 3, 30])
+def test_grouped_same_as_each_group_alone(topn):
+    rng = np.random.RandomState(0)
+    groups = rng.randint(0, 4, 4000)
+    song_ids, offsets = matches(1, size=4000)
+    result = grouped_top_matches(*grouped_histogram(groups, song_ids, offsets), topn=topn)
+
+    for group in range(4):
+        mine = result[0] == group
+        alone = top_matches(song_ids[groups == group], offsets[groups == group], topn=topn)
+        assert all(np.array_equal(column[mine], expected) for column, expected in zip(result[1:], alone))
@@ -0,0 +1,80 @@
+import hashlib
+
+import numpy as np
+
+from dejavu.database_handler.memory_database import MemoryDatabase
+from dejavu.logic.bloom import BloomFilter
+
+
+def hashes(count, seed=0):
+    return [hashlib.sha1(f"{seed}-{index}".encode()).hexdigest()[:20].upper() for index in range(count)]
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(10000, 0.01)
+    stored = hashes(10000)
+    bloom.add(stored)
+    assert bloom.contains(stored).all()
+
+
+def test_error_rate_close_to_configured():
+    bloom = BloomFilter(10000, 0.01)
+    bloom.add(hashes(10000))
+    assert bloom.contains(hashes(10000, seed=1)).mean() < 0.03
+
+
+def test_no_false_negatives_over_capacity():
+    bloom = BloomFilter(100, 0.01)
+    stored = hashes(5000)
+    bloom.add(stored)
+    assert bloom.contains(stored).all()
+
+
+def test_save_load_round_trip(tmp_path):
+    bloom = BloomFilter(1000, 0.01)
+    bloom.add(hashes(1000))
+    path = str(tmp_path / "bloom")
+    assert bloom.save(path) is not None
+
+    loaded = BloomFilter.load(path)
+    assert (loaded.size, loaded.probes, loaded.count, loaded.capacity) == (bloom.size, bloom.probes, 1000, 1000)
+    assert np.array_equal(loaded.bits, bloom.bits)
+    assert loaded.contains(hashes(1000)).all()
+
+
+def test_merge_requires_same_size():
+    assert not BloomFilter(1000).merge(BloomFilter(2000))
+
+    first, second = BloomFilter(1000), BloomFilter(1000)
+    first.add(hashes(100))
+    second.add(hashes(100, seed=1))
+    assert first.merge(second)
+    assert first.contains(hashes(100) + hashes(100, seed=1)).all()
+    assert 180 <= first.count <= 220
+
+
+def test_concurrent_saves_keep_every_hash(tmp_path):
+    # two processes fingerprinting at the same time, each one saving the filter after its songs.
+    path = str(tmp_path / "bloom")
+    first, second = MemoryDatabase(), MemoryDatabase()
+    first.use_bloom_filter(path)
+    second.use_bloom_filter(path)
+
+    first.insert_hashes(1, [(hsh, 0) for hsh in hashes(500)])
+    second.insert_hashes(2, [(hsh, 0) for hsh in hashes(500, seed=1)])
+    first.save_bloom_filter()
+    second.save_bloom_filter()
+
+    assert BloomFilter.load(path).contains(hashes(500) + hashes(500, seed=1)).all()
+
+
+def test_filter_rebuilt_once_over_capacity(tmp_path, monkeypatch):
+    monkeypatch.setattr("dejavu.base_classes.common_database.BLOOM_FILTER_MIN_CAPACITY", 100)
+    db = MemoryDatabase()
+    db.use_bloom_filter(str(tmp_path / "bloom"))
+    assert db.bloom.capacity == 100
+
+    db.insert_hashes(1, [(hsh, 0) for hsh in hashes(1000)])
+    db.save_bloom_filter()
+    assert db.bloom.capacity >= 1000
+    assert BloomFilter.load(str(tmp_path / "bloom")).contains(hashes(1000)).all()
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from dejavu import Dejavu
+from dejavu.logic.recognizer.file_recognizer import FileRecognizerChunks
+
+
+@pytest.fixture
+def recognizer():
+    return FileRecognizerChunks(Dejavu({"database_type": "memory"}))
+
+
+def test_overlapping_chunks(recognizer):
+    channel = np.arange(100, dtype=np.int16)
+    chunks = recognizer.make_chunks([channel], 10, 4, 1)
+    assert [start for start, _ in chunks] == list(range(0, 100, 30))
+    assert all(np.array_equal(chunk[0], channel[start:start + 40]) for start, chunk in chunks)
+
+
+@pytest.mark.parametrize("overlap", [4, 5, -1])
+def test_overlap_not_smaller_than_chunk_rejected(recognizer, overlap):
+    with pytest.raises(ValueError, match="DJV_CHUNK_OVERLAP"):
+        recognizer.make_chunks([np.zeros(100, dtype=np.int16)], 10, 4, overlap)
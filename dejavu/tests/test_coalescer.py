@@ -0,0 +1,17 @@
+from dejavu.database_handler.memory_database import MemoryDatabase
+from dejavu.logic.coalescer import LookupCoalescer
+
+
+def test_last_request_forgotten_on_reset():
+    db = MemoryDatabase()
+    db.insert_hashes(1, [("A" * 20, 0), ("B" * 20, 1)])
+    lookups = LookupCoalescer(db, window=0)
+    assert lookups.last_request() is None
+
+    matches, dedup_hashes = lookups.return_matches([("A" * 20, 5)])
+    assert dedup_hashes == {1: 1}
+    assert lookups.last_request()["batch_requests"] == 1
+
+    # the next request is answered without a lookup, a result cache hit for instance.
+    lookups.reset_request()
+    assert lookups.last_request() is None
@@ -0,0 +1,103 @@
+import multiprocessing
+
+import pytest
+
+import dejavu.logic.decoder as decoder
+from dejavu import Dejavu
+from dejavu.config.settings import QUERIED_HASHES, RESULTS, SONG_ID
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.recognizer.directory_recognizer import DirectoryRecognizer, fingerprint_file
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+from dejavu.tests.benchmark import add_noise, synthesize, write_wav
+
+FS = 44100
+# marks where the fake pool has nothing ready yet.
+PENDING = object()
+
+
+class FakeIterator:
+    """
+    Results of a pool as `Pool.imap` gives them: waiting without a timeout skips what is still pending.
+    """
+    def __init__(self, items):
+        self.items = list(items)
+
+    def next(self, timeout=None):
+        while self.items:
+            item = self.items.pop(0)
+            if item is not PENDING:
+                return item
+            if timeout is not None:
+                raise multiprocessing.TimeoutError
+        raise StopIteration
+
+
+def test_batches_take_what_is_ready(monkeypatch):
+    recognizer = DirectoryRecognizer(Dejavu({"database_type": "memory"}))
+    recognizer.batch_files = 3
+    iterator = FakeIterator([1, 2, PENDING, 3, 4, 5, 6, PENDING, PENDING, 7])
+    assert list(recognizer._batches(iterator)) == [[1, 2], [3, 4, 5], [6], [7]]
+
+
+@pytest.fixture
+def files(tmp_path):
+    # songs a and b are in the catalog, the queries are noisy excerpts of them and one file can't be read.
+    paths, songs = [], {}
+    for seed, name in enumerate(("a", "b")):
+        songs[name] = synthesize("mixed", 15, seed=seed)
+        path = str(tmp_path / f"query_{name}.wav")
+        write_wav(path, add_noise(songs[name][3 * FS: 9 * FS], 10, seed=seed))
+        paths.append(path)
+    paths.insert(1, str(tmp_path / "missing.wav"))
+    return songs, paths
+
+
+def catalog(songs, **config):
+    djv = Dejavu({"database_type": "memory", **config})
+    for name, samples in songs.items():
+        hashes = set(fingerprint(samples, Fs=FS))
+        song_id = djv.db.insert_song(name, name * 40, len(hashes), len(samples) * 1000 // FS)
+        djv.db.insert_hashes(song_id, hashes)
+        djv.db.set_song_fingerprinted(song_id)
+    return djv
+
+
+@pytest.mark.parametrize("config", [{}, {"progressive_matching": True}, {"two_stage_matching": True}])
+def test_same_results_as_file_recognizer(files, config):
+    songs, paths = files
+    djv = catalog(songs, **config)
+    records = DirectoryRecognizer(djv)._match([fingerprint_file((path, None, djv.progressive)) for path in paths])
+
+    assert [record["file"] for record in records] == paths
+    assert "error" in records[1] and RESULTS not in records[1]
+    for record in records[:1] + records[2:]:
+        expected = FileRecognizer(djv).recognize_file(record["file"])
+        assert record[RESULTS] == expected[RESULTS]
+        assert record[QUERIED_HASHES] == expected[QUERIED_HASHES]
+    assert [record[RESULTS][0][SONG_ID] for record in records[::2]] == [1, 2]
+
+
+def test_result_cache_shared_with_file_recognizer(files, monkeypatch):
+    songs, paths = files
+    djv = catalog(songs, result_cache_size=10)
+    records = DirectoryRecognizer(djv)._match([fingerprint_file((path, None, False)) for path in paths])
+
+    def lookup(*args, **kwargs):
+        raise AssertionError("the database was queried for a file already recognized")
+
+    monkeypatch.setattr(djv.db, "return_matches_batch", lookup)
+    assert FileRecognizer(djv).recognize_file(paths[0])[RESULTS] == records[0][RESULTS]
+    again = DirectoryRecognizer(djv)._match([fingerprint_file((path, None, False)) for path in paths])
+    assert [record.get(RESULTS) for record in again] == [record.get(RESULTS) for record in records]
+
+
+def test_catalog_file_not_looked_up(files, tmp_path):
+    songs, _ = files
+    djv = catalog(songs, result_cache_size=10)
+    path = str(tmp_path / "a.wav")
+    write_wav(path, songs["a"])
+    djv.db.insert_song("a copy", decoder.unique_hash(path), 1, 15000)
+    djv.db.set_song_fingerprinted(3)
+
+    record, = DirectoryRecognizer(djv)._match([fingerprint_file((path, None, False))])
+    assert record[RESULTS][0][SONG_ID] == 3 and record[QUERIED_HASHES] == 0
@@ -0,0 +1,58 @@
+import pytest
+
+import dejavu.logic.decoder as decoder
+from dejavu import Dejavu
+from dejavu.config.settings import AUDIO_DURATION, RESULTS, SONG_ID
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+from dejavu.tests.benchmark import synthesize, write_wav
+
+FS = 44100
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    # song a is inserted from its own file, song b only by its fingerprints.
+    djv = Dejavu({"database_type": "memory", "result_cache_size": 10})
+    paths = {}
+    for seed, name in enumerate(("a", "b")):
+        samples = synthesize("mixed", 10, seed=seed)
+        paths[name] = str(tmp_path / f"{name}.wav")
+        write_wav(paths[name], samples)
+        hashes = set(fingerprint(samples, Fs=FS))
+        song_id = djv.db.insert_song(name, decoder.unique_hash(paths[name]) if name == "a" else name * 40,
+                                     len(hashes), len(samples) * 1000 // FS)
+        djv.db.insert_hashes(song_id, hashes)
+        djv.db.set_song_fingerprinted(song_id)
+    return djv, paths
+
+
+def test_catalog_file_answered_once_then_cached(catalog, monkeypatch):
+    djv, paths = catalog
+    results = FileRecognizer(djv).recognize_file(paths["a"])
+    assert results[RESULTS][0][SONG_ID] == 1
+    assert djv.result_cache.stats()["catalog_hits"] == 1
+
+    def lookup(file_hashes, batch_size=1000):
+        raise AssertionError("the catalog was queried on a cache hit")
+
+    monkeypatch.setattr(djv.db, "get_songs_by_hashes", lookup)
+    assert FileRecognizer(djv).recognize_file(paths["a"])[RESULTS] == results[RESULTS]
+    assert djv.result_cache.stats()["memory_hits"] == 1
+
+
+def test_catalog_match_reports_song_duration(catalog, monkeypatch):
+    djv, paths = catalog
+    monkeypatch.setattr("dejavu.RETURN_AUDIO_INFO", False)
+    assert FileRecognizer(djv).recognize_file(paths["a"])[AUDIO_DURATION] == 10000
+
+
+def test_catalog_match_respects_subset(catalog):
+    djv, paths = catalog
+    djv.db.register_subset("b_only", [2])
+    djv.subset = "b_only"
+    assert djv.catalog_match(decoder.unique_hash(paths["a"])) is None
+
+    results = FileRecognizer(djv).recognize_file(paths["a"])
+    assert djv.result_cache.stats()["catalog_hits"] == 0
+    assert all(match[SONG_ID] == 2 for match in results[RESULTS])
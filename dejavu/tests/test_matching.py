@@ -0,0 +1,85 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from dejavu.base_classes.common_database import CommonDatabase
+from dejavu.database_handler.memory_database import MemoryDatabase
+from dejavu.logic.matches import MatchAccumulator, QueryHashes
+
+# a small pool of hashes, so they repeat within and across songs.
+POOL = [f"{index:020X}" for index in range(60)]
+
+
+@pytest.fixture
+def db(monkeypatch):
+    # small fetches, so every lookup reads its rows in several batches.
+    monkeypatch.setattr(MemoryDatabase, "_fetch_batches",
+                        staticmethod(lambda cur, batch_size=7: CommonDatabase._fetch_batches(cur, 7)))
+    rng = np.random.RandomState(0)
+    db = MemoryDatabase()
+    for song_id in range(1, 6):
+        db.insert_hashes(song_id, [(POOL[rng.randint(50)], rng.randint(200)) for _ in range(150)])
+    return db
+
+
+def query(seed, size=80):
+    # hashes in lower case and some missing from the catalog, with repeated hashes and (hash, offset) pairs.
+    rng = np.random.RandomState(seed)
+    hashes = [(POOL[rng.randint(60)].lower(), rng.randint(100)) for _ in range(size)]
+    return hashes + hashes[:10]
+
+
+def old_return_matches(db, hashes):
+    # the per row loop of return_matches_OLD, reading the rows of the memory catalog.
+    mapper = {}
+    for hsh, offset in hashes:
+        mapper.setdefault(hsh.upper(), []).append(offset)
+
+    dedup_hashes = {}
+    results = []
+    for hsh in mapper:
+        for sid, offset in db.query(hsh):
+            dedup_hashes[sid] = dedup_hashes.get(sid, 0) + 1
+            for song_sampled_offset in mapper[hsh]:
+                results.append((sid, offset - song_sampled_offset))
+    return results, dedup_hashes
+
+
+def histogram(matches):
+    return Counter({(sid, offset): count for sid, offset, count in zip(*(column.tolist()
+                                                                         for column in matches.histogram()))})
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_return_matches_same_as_old(db, seed):
+    hashes = query(seed)
+    matches, dedup_hashes = db.return_matches(hashes)
+    results, old_dedup_hashes = old_return_matches(db, hashes)
+
+    assert histogram(matches) == Counter(results)
+    assert dedup_hashes == old_dedup_hashes
+
+
+def test_batch_same_as_each_query_alone(db):
+    # the rows of every query are counted apart from those of the others in its batch.
+    queries = [query(seed, size) for seed, size in ((0, 80), (1, 5), (2, 40))] + [[]]
+    accumulators = [MatchAccumulator() for _ in queries]
+    db.return_matches_batch([(QueryHashes(hashes), matches) for hashes, matches in zip(queries, accumulators)])
+
+    for hashes, matches in zip(queries, accumulators):
+        results, dedup_hashes = old_return_matches(db, hashes)
+        assert histogram(matches) == Counter(results)
+        assert matches.dedup_hashes == dedup_hashes
+
+
+def test_chunks_same_as_old(db):
+    # chunks share hashes, so every row is counted for each chunk holding its hash.
+    chunks = {index: {"hashes": set(query(seed))} for index, seed in ((0, 0), (3, 1), (7, 0), (9, 2))}
+    chunks[5] = {"hashes": set()}
+    db.return_matches_chunk(chunks, {})
+
+    for chunk in chunks.values():
+        results, dedup_hashes = old_return_matches(db, chunk["hashes"])
+        assert histogram(chunk["matches"]) == Counter(results)
+        assert chunk["dedup_hashes"] == dedup_hashes
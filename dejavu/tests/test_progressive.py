@@ -0,0 +1,40 @@
+from dejavu import Dejavu
+from dejavu.database_handler.memory_database import MemoryDatabase
+
+
+def test_hash_frequencies_of_most_repeated():
+    db = MemoryDatabase()
+    db.insert_hashes(1, [("A" * 20, 0), ("B" * 20, 0), ("C" * 20, 0)])
+    db.insert_hashes(2, [("A" * 20, 1), ("B" * 20, 1)])
+    db.insert_hashes(3, [("A" * 20, 2)])
+    assert db.get_hash_frequencies(10) == {"A" * 20: 3, "B" * 20: 2}
+    assert db.get_hash_frequencies(1) == {"A" * 20: 3}
+
+
+def test_rarest_then_strongest_first(monkeypatch):
+    djv = Dejavu({"database_type": "memory", "progressive_frequent_hashes": 10})
+    for song_id in range(1, 4):
+        djv.db.insert_hashes(song_id, [("a" * 20, song_id)] + [("b" * 20, song_id)] * (song_id > 1))
+
+    queried = []
+    monkeypatch.setattr(djv.lookups, "return_matches", lambda batch, matches, subset=None: queried.extend(batch))
+    hashes = {("a" * 20, 0): 50, ("b" * 20, 0): 90, ("c" * 20, 0): 10, ("d" * 20, 0): 20}
+    djv.find_matches_progressive(hashes, batch_size=1, min_count=10 ** 6)
+    assert [hsh[0] for hsh, _ in queried] == ["d", "c", "b", "a"]
+
+    # without frequencies only the strength counts.
+    djv.frequent_hashes = 0
+    djv.hash_frequencies = None
+    queried.clear()
+    djv.find_matches_progressive(hashes, batch_size=1, min_count=10 ** 6)
+    assert [hsh[0] for hsh, _ in queried] == ["b", "a", "d", "c"]
+
+
+def test_frequencies_reloaded_after_catalog_changes():
+    djv = Dejavu({"database_type": "memory"})
+    djv.db.insert_hashes(1, [("A" * 20, 0)])
+    djv.db.insert_hashes(2, [("A" * 20, 0)])
+    assert djv.get_hash_frequencies() == {"A" * 20: 2}
+
+    djv.delete_songs_by_id([2])
+    assert djv.get_hash_frequencies() == {}
@@ -0,0 +1,57 @@
+import os
+from time import time
+
+from dejavu.logic.result_cache import ResultCache
+
+
+def files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".pkl"))
+
+
+def test_disk_results_shared_between_caches(tmp_path):
+    ResultCache(10, 3600, str(tmp_path)).put("key", {"song_id": 1})
+    other = ResultCache(10, 3600, str(tmp_path))
+    assert other.get("key") == {"song_id": 1}
+    assert other.stats()["disk_hits"] == 1
+
+
+def test_invalidate_deletes_older_generations(tmp_path):
+    cache = ResultCache(10, 3600, str(tmp_path))
+    for index in range(5):
+        cache.put(f"key{index}", index)
+    assert len(files(tmp_path)) == 5
+
+    cache.invalidate()
+    assert files(tmp_path) == []
+    assert ResultCache(10, 3600, str(tmp_path)).get("key0") is None
+
+
+def test_directory_capped_by_least_recently_used(tmp_path):
+    cache = ResultCache(10, 3600, str(tmp_path), max_bytes=10 ** 9)
+    for index in range(10):
+        cache.put(f"key{index}", b"x" * 1000)
+    size = os.path.getsize(os.path.join(tmp_path, files(tmp_path)[0]))
+    # the first results are the least recently used, except the one read again.
+    for index, name in enumerate(files(tmp_path)):
+        os.utime(os.path.join(tmp_path, name), (time() - 100 + index, time() - 100 + index))
+    other = ResultCache(10, 3600, str(tmp_path), max_bytes=10 ** 9)
+    assert other.get("key0") == b"x" * 1000
+
+    other.max_bytes = 5 * size
+    other.put("key10", b"x" * 1000)
+    assert len(files(tmp_path)) <= 5
+    assert other.stats()["disk_evictions"] >= 6
+    remaining = ResultCache(10, 3600, str(tmp_path))
+    assert remaining.get("key0") is not None
+    assert remaining.get("key10") is not None
+    assert remaining.get("key1") is None
+
+
+def test_expired_files_swept(tmp_path):
+    cache = ResultCache(10, 60, str(tmp_path))
+    cache.put("key", 1)
+    path = os.path.join(tmp_path, files(tmp_path)[0])
+    os.utime(path, (time() - 120, time() - 120))
+
+    ResultCache(10, 60, str(tmp_path))
+    assert files(tmp_path) == []
@@ -0,0 +1,73 @@
+import io
+import os
+import threading
+import wave
+
+import numpy as np
+import pytest
+
+from dejavu import Dejavu
+from dejavu.logic.fingerprint import fingerprint
+from dejavu.logic.recognizer.stream_recognizer import StreamRecognizer
+from dejavu.tests.benchmark import synthesize
+
+FS = 44100
+
+
+@pytest.fixture(scope="module")
+def songs():
+    return {name: synthesize(kind, 20, seed=seed) for seed, (name, kind) in enumerate((("a", "mixed"), ("b", "noise")))}
+
+
+@pytest.fixture
+def djv(songs):
+    djv = Dejavu({"database_type": "memory"})
+    for name, samples in songs.items():
+        hashes = set(fingerprint(samples, Fs=FS))
+        song_id = djv.db.insert_song(name, name * 40, len(hashes), len(samples) * 1000 // FS)
+        djv.db.insert_hashes(song_id, hashes)
+        djv.db.set_song_fingerprinted(song_id)
+    return djv
+
+
+def wav_bytes(samples: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(FS)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def test_listen_to_piped_wav(djv, songs):
+    # 12 s of song b from its 5th second, written to a pipe as an external decoder would.
+    data = wav_bytes(songs["b"][5 * FS: 17 * FS])
+    read_fd, write_fd = os.pipe()
+
+    def write():
+        with open(write_fd, 'wb') as pipe:
+            pipe.write(data)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    with open(read_fd, 'rb') as pipe:
+        events = list(StreamRecognizer(djv).listen(pipe))
+    writer.join()
+
+    assert events
+    assert all(event["results"][0]["song_name"] == "b" for event in events)
+    offsets = [event["stream_offset"] for event in events]
+    assert offsets == sorted(offsets)
+
+
+def test_recognize_hands_events_to_callback_without_keeping_them(djv, songs, tmp_path):
+    path = tmp_path / "stream.wav"
+    path.write_bytes(wav_bytes(songs["a"][: 12 * FS]))
+
+    received = []
+    assert StreamRecognizer(djv).recognize(str(path), on_match=received.append) == []
+    assert received and received[0]["results"][0]["song_name"] == "a"
+
+    events = StreamRecognizer(djv).recognize(str(path))
+    assert [event["stream_offset"] for event in events] == [event["stream_offset"] for event in received]
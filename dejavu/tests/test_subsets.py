@@ -0,0 +1,59 @@
+import pytest
+
+from dejavu import Dejavu
+from dejavu.database_handler.memory_database import MemoryDatabase
+
+HASHES = [f"{index:020X}" for index in range(4)]
+
+
+@pytest.fixture(params=["server", "memory"])
+def db(request):
+    # every song holds every hash, so lookups match all of them unless a subset filters them.
+    db = MemoryDatabase()
+    db.subset_filter = request.param
+    for song_id in range(1, 5):
+        db.insert_hashes(song_id, [(hsh, song_id) for hsh in HASHES])
+    db.register_subset("odd", [1, 3])
+    return db
+
+
+def test_lookup_restricted_to_subset(db):
+    _, dedup_hashes = db.return_matches([(hsh, 0) for hsh in HASHES], subset="odd")
+    assert dedup_hashes == {1: 4, 3: 4}
+
+
+def test_song_filter_within_subset(db):
+    _, dedup_hashes = db.return_matches([(hsh, 0) for hsh in HASHES], song_filter=[2, 3], subset="odd")
+    assert dedup_hashes == {3: 4}
+
+
+def test_chunks_restricted_to_subset(db):
+    chunks = db.return_matches_chunk({0: {"hashes": {(hsh, 0) for hsh in HASHES}}}, {"subset": "odd"})
+    assert chunks[0]["dedup_hashes"] == {1: 4, 3: 4}
+
+
+def test_unknown_subset_rejected(db):
+    with pytest.raises(ValueError, match="Unknown or empty song subset: even"):
+        db.return_matches([(HASHES[0], 0)], subset="even")
+    with pytest.raises(ValueError):
+        db.return_matches_chunk({0: {"hashes": {(HASHES[0], 0)}}}, {"subset": "even"})
+
+
+def test_deleted_and_emptied_subsets_forgotten(db):
+    db.delete_subset("odd")
+    with pytest.raises(ValueError):
+        db.return_matches([(HASHES[0], 0)], subset="odd")
+
+    db.register_subset("odd", [1, 3])
+    db.empty()
+    with pytest.raises(ValueError):
+        db.get_subset("odd")
+
+
+def test_recognition_restricted_to_configured_subset():
+    djv = Dejavu({"database_type": "memory", "subset": "odd"})
+    for song_id in range(1, 5):
+        djv.db.insert_hashes(song_id, [(hsh, song_id) for hsh in HASHES])
+    djv.db.register_subset("odd", [1, 3])
+    _, dedup_hashes, _ = djv.find_matches([(hsh, 0) for hsh in HASHES])
+    assert dedup_hashes == {1: 4, 3: 4}
@@ -0,0 +1,48 @@
+import dejavu.logic.timeline as timeline
+from dejavu.logic.timeline import Segment, TimelineBuilder, build_timeline
+
+
+def detection(song_id, song_start, duration=None):
+    return {"song_id": song_id, "song_name": f"song_{song_id}", "ofsset_detection": song_start,
+            "avg_counts_hashes_matched": 50.0, "count": 10, "audio_duration": duration}
+
+
+def chunks(song_id, song_start, duration, start, end, size=5):
+    return [dict(detection(song_id, song_start, duration), chunk_start=t, chunk_end=t + size)
+            for t in range(start, end, size)]
+
+
+def test_segment_end_clamped_to_song_duration_in_milliseconds():
+    # a 180 s song that started 175 s before the audio can only be heard for its first 5 s.
+    segments = build_timeline(chunks(1, -175, 180000, 0, 20))
+    assert len(segments) == 1
+    assert segments[0]["start"] == 0
+    assert segments[0]["end"] == 5
+
+
+def test_segment_not_clamped_by_long_song():
+    segments = build_timeline(chunks(1, -10, 180000, 0, 20))
+    assert (segments[0]["start"], segments[0]["end"]) == (0, 20)
+
+
+def test_segment_without_duration_covers_its_chunks():
+    segment = Segment(1, "song_1")
+    segment.add(10, 15, 8, 50.0, 10)
+    segment.add(15, 20, 8, 50.0, 10)
+    assert (segment.as_dict()["start"], segment.as_dict()["end"]) == (10, 20)
+
+
+def test_placeholder_duration_ignored_without_audio_info(monkeypatch):
+    # without RETURN_AUDIO_INFO matches report a duration of 1, which must not collapse the segments.
+    monkeypatch.setattr(timeline, "RETURN_AUDIO_INFO", False)
+    segments = build_timeline(chunks(1, -30, 1, 0, 20))
+    assert (segments[0]["start"], segments[0]["end"]) == (0, 20)
+
+
+def test_same_song_twice_gives_two_segments():
+    builder = TimelineBuilder(max_gap=10)
+    closed = []
+    for chunk in chunks(1, 0, 60000, 0, 30) + chunks(1, 100, 60000, 100, 130):
+        closed += builder.add(chunk["chunk_start"], chunk["chunk_end"], chunk)
+    closed += builder.flush()
+    assert [(segment["start"], segment["end"]) for segment in closed] == [(0, 30), (100, 130)]
@@ -0,0 +1,43 @@
+from dejavu import Dejavu
+
+# the last four digits of a hash decide whether it is sampled: '0000' always is, 'FFFF' never below a rate of 1.
+SAMPLED = [f"{index:016X}0000" for index in range(6)]
+UNSAMPLED = f"{0:016X}FFFF"
+
+
+def catalog():
+    # song 1 matches three sampled hashes, song 2 two and song 3 one, all of them match the unsampled one.
+    djv = Dejavu({"database_type": "memory"})
+    for song_id, sampled in ((1, SAMPLED[:3]), (2, SAMPLED[3:5]), (3, SAMPLED[5:])):
+        djv.db.insert_hashes(song_id, [(hsh, 10) for hsh in sampled] + [(UNSAMPLED, 20)])
+    return djv
+
+
+def test_second_stage_restricted_to_best_candidates():
+    djv = catalog()
+    hashes = [(hsh, 0) for hsh in SAMPLED + [UNSAMPLED]]
+    matches, dedup_hashes = djv.find_matches_two_stage(hashes, sample_rate=0.5, candidates=2)
+    # every hash is looked up on the second stage, but only against songs 1 and 2.
+    assert dedup_hashes == {1: 4, 2: 3}
+    assert len(matches) == 7
+
+
+def test_ties_between_candidates_keep_the_lowest_song_id():
+    djv = catalog()
+    hashes = [(hsh, 0) for hsh in SAMPLED[2:4] + [UNSAMPLED]]
+    _, dedup_hashes = djv.find_matches_two_stage(hashes, sample_rate=0.5, candidates=1)
+    assert dedup_hashes == {1: 2}
+
+
+def test_empty_sample_looks_every_hash_up():
+    djv = catalog()
+    hashes = [(hsh, 0) for hsh in SAMPLED + [UNSAMPLED]]
+    _, dedup_hashes = djv.find_matches_two_stage(hashes, sample_rate=0, candidates=1)
+    assert dedup_hashes == {1: 4, 2: 3, 3: 2}
+
+
+def test_no_votes_no_matches():
+    djv = catalog()
+    hashes = [(f"{99:016X}0000", 0), (UNSAMPLED, 0)]
+    matches, dedup_hashes = djv.find_matches_two_stage(hashes, sample_rate=0.5, candidates=2)
+    assert len(matches) == 0 and dedup_hashes == {}
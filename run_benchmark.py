@@ -0,0 +1,80 @@
+import argparse
+import json
+import sys
+
+from dejavu import Dejavu
+from dejavu.tests.benchmark import CHUNK_EXECUTORS, SIGNALS, Benchmark, chunk_scaling, compare
+
+
+def main(config_file: str, songs: int, seconds: float, query_seconds: float, snr: float, signals: list,
+         seed: int, repeat: int, output: str, baseline: str, files: list = None, chunk_executors: list = None,
+         chunk_workers: list = None, chunk_seconds: float = 60):
+
+    # without a configuration the catalog lives in memory, so only the engine is measured
+    config = {"database_type": "memory"}
+    if config_file:
+        with open(config_file) as f:
+            config = json.load(f)
+
+    djv = Dejavu(config)
+    benchmark = Benchmark(djv, songs=songs, seconds=seconds, query_seconds=query_seconds, snr=snr,
+                          signals=signals, seed=seed, repeat=repeat, files=files)
+    try:
+        results = benchmark.run()
+    finally:
+        # leave the database as it was
+        benchmark.cleanup()
+
+    if chunk_executors:
+        results["chunk_scaling"] = chunk_scaling(djv, chunk_executors, chunk_workers, chunk_seconds, seed, repeat)
+
+    if baseline:
+        with open(baseline) as f:
+            results["comparison"] = compare(json.load(f), results)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks each stage of dejavu on deterministic synthetic '
+                                                 'audio, in-process, and writes the timings as JSON.')
+
+    parser.add_argument("-c", "--config", action="store", default=None,
+                        help='Configuration file of the database to benchmark, an in-memory database if not given.')
+    parser.add_argument("-n", "--songs", action="store", default=10, type=int,
+                        help='Number of songs in the catalog.')
+    parser.add_argument("-sec", "--seconds", action="store", default=30, type=float,
+                        help='Length in seconds of each song.')
+    parser.add_argument("-q", "--query-seconds", action="store", default=5, type=float,
+                        help='Length in seconds of each query.')
+    parser.add_argument("--snr", action="store", default=20, type=float,
+                        help='Signal to noise ratio of the queries, in dB.')
+    parser.add_argument("--signals", nargs='+', default=list(SIGNALS), choices=SIGNALS,
+                        help='Kinds of synthetic audio the songs cycle through.')
+    parser.add_argument("-f", "--files", nargs='+', default=None,
+                        help='Audio files the catalog is made of, instead of synthetic songs. Queries are noisy '
+                             'excerpts of them.')
+    parser.add_argument("-sd", "--seed", action="store", default=0, type=int, help='Random seed.')
+    parser.add_argument("-r", "--repeat", action="store", default=1, type=int,
+                        help='Number of times each query is recognized.')
+    parser.add_argument("-ce", "--chunk-executors", nargs='+', default=None, choices=CHUNK_EXECUTORS,
+                        help='Executors the recognition by chunks of a synthetic file is also timed with, to '
+                             'measure how it scales.')
+    parser.add_argument("-cw", "--chunk-workers", nargs='+', default=[1, 2, 4], type=int,
+                        help='Numbers of workers the chunk executors are timed with.')
+    parser.add_argument("-cs", "--chunk-seconds", action="store", default=60, type=float,
+                        help='Length in seconds of the file recognized by chunks.')
+    parser.add_argument("-o", "--output", action="store", default=None,
+                        help='File the JSON results are written to, the standard output if not given.')
+    parser.add_argument("-b", "--baseline", action="store", default=None,
+                        help='JSON results of a previous run to compare against.')
+    args = parser.parse_args()
+
+    main(args.config, args.songs, args.seconds, args.query_seconds, args.snr, args.signals, args.seed,
+         args.repeat, args.output, args.baseline, args.files, args.chunk_executors, args.chunk_workers,
+         args.chunk_seconds)
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from itertools import product
+
+# fingerprinting settings that can be swept, each one is read from the DJV_<name> environment variable.
+SETTINGS = ('DEFAULT_FAN_VALUE', 'DEFAULT_AMP_MIN', 'PEAK_NEIGHBORHOOD_SIZE', 'CONNECTIVITY_MASK',
+            'MIN_HASH_TIME_DELTA', 'MAX_HASH_TIME_DELTA', 'PEAK_SORT', 'FINGERPRINT_REDUCTION')
+
+
+def parse_param(param: str) -> tuple:
+    """
+    :param param: a setting and the values it takes, e.g. DEFAULT_FAN_VALUE=5,10,15.
+    :return: the setting name and its values.
+    """
+    name, _, values = param.partition('=')
+    name = name.strip().upper()
+    if name not in SETTINGS:
+        raise argparse.ArgumentTypeError(f"Unknown setting: {name}, expected one of {', '.join(SETTINGS)}")
+    try:
+        return name, [int(value) for value in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Values of {name} must be integers separated by commas: {values}")
+
+
+def run_config(settings: dict, benchmark_args: list) -> dict:
+    """
+    Runs the benchmark with some settings, in its own process since settings are read when dejavu is imported.
+
+    :param settings: setting name => value.
+    :param benchmark_args: arguments of run_benchmark.py.
+    :return: the benchmark results.
+    """
+    env = dict(os.environ, **{f"DJV_{name}": str(value) for name, value in settings.items()})
+    fd, output = tempfile.mkstemp(prefix="dejavu_sweep_", suffix=".json")
+    os.close(fd)
+    try:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_benchmark.py')
+        process = subprocess.run([sys.executable, script, *benchmark_args, '--output', output], env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else
+                               f"exit code {process.returncode}")
+        with open(output) as f:
+            return json.load(f)
+    finally:
+        os.remove(output)
+
+
+def summarize(settings: dict, results: dict) -> dict:
+    """
+    :return: what a configuration costs and how well it recognizes, out of its benchmark results.
+    """
+    return {
+        "settings": settings,
+        "accuracy": results["accuracy"]["ratio"],
+        "hashes_per_second": results["storage"]["hashes_per_second"],
+        "storage_bytes": results["storage"]["bytes"],
+        "storage_bytes_per_second": results["storage"]["bytes_per_second"],
+        "latency": results["latency"],
+        "catalog_realtime_factor": results["throughput"]["catalog_realtime_factor"],
+        "stages": {stage: values["mean"] for stage, values in results["stages"].items()}
+    }
+
+
+def cheapest(configs: list, target: float) -> dict:
+    """
+    :param configs: summaries of the configurations.
+    :param target: minimum accuracy.
+    :return: the configuration reaching the target accuracy with the least storage, and then the lowest 95th
+     percentile latency, None if none reaches it.
+    """
+    eligible = [config for config in configs if "error" not in config and config["accuracy"] >= target]
+    if not eligible:
+        return None
+    return min(eligible, key=lambda config: (config["storage_bytes"], config["latency"]["p95"]))
+
+
+def main(params: list, target: float, benchmark_args: list, output: str):
+    names = [name for name, _ in params]
+    configs = []
+    for values in product(*[values for _, values in params]):
+        settings = dict(zip(names, values))
+        print(f"Benchmarking {json.dumps(settings)}", file=sys.stderr)
+        try:
+            configs.append(summarize(settings, run_config(settings, benchmark_args)))
+        except Exception as e:
+            print(f"Failed: {e}", file=sys.stderr)
+            configs.append({"settings": settings, "error": str(e)})
+
+    results = {"target": target, "configs": configs, "cheapest": cheapest(configs, target)}
+
+    print(f"{'settings':60} {'accuracy':>8} {'hashes/s':>9} {'bytes':>12} {'p50 ms':>8} {'p95 ms':>8}",
+          file=sys.stderr)
+    for config in configs:
+        settings = " ".join(f"{name}={value}" for name, value in config["settings"].items())
+        if "error" in config:
+            print(f"{settings:60} failed", file=sys.stderr)
+            continue
+        print(f"{settings:60} {config['accuracy']:8.3f} {config['hashes_per_second']:9.1f} "
+              f"{config['storage_bytes']:12d} {config['latency']['p50'] * 1000:8.1f} "
+              f"{config['latency']['p95'] * 1000:8.1f}", file=sys.stderr)
+    if results["cheapest"] is None:
+        print(f"No configuration reaches an accuracy of {target}", file=sys.stderr)
+    else:
+        print(f"Cheapest with an accuracy of at least {target}: {json.dumps(results['cheapest']['settings'])}",
+              file=sys.stderr)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweeps fingerprinting settings: every combination of the values '
+                                                 'given is benchmarked with run_benchmark.py on a scratch catalog, '
+                                                 'and the accuracy, storage and latency of each one are reported.')
+
+    parser.add_argument("-p", "--param", action="append", type=parse_param, required=True,
+                        help=f'Setting and the values it takes, e.g. DEFAULT_FAN_VALUE=5,10,15. Can be repeated, '
+                             f'one of {", ".join(SETTINGS)}.')
+    parser.add_argument("-t", "--target", action="store", default=0.9, type=float,
+                        help='Accuracy the cheapest configuration must reach.')
+    parser.add_argument("-c", "--config", action="store", default=None,
+                        help='Configuration file of a scratch database, an in-memory database if not given.')
+    parser.add_argument("-f", "--files", nargs='+', default=None,
+                        help='Audio files the catalog is made of, instead of synthetic songs.')
+    parser.add_argument("-n", "--songs", action="store", default=10, type=int,
+                        help='Number of synthetic songs in the catalog.')
+    parser.add_argument("-sec", "--seconds", action="store", default=30, type=float,
+                        help='Length in seconds of each synthetic song.')
+    parser.add_argument("-q", "--query-seconds", action="store", default=5, type=float,
+                        help='Length in seconds of each query.')
+    parser.add_argument("--snr", action="store", default=20, type=float,
+                        help='Signal to noise ratio of the queries, in dB.')
+    parser.add_argument("-sd", "--seed", action="store", default=0, type=int, help='Random seed.')
+    parser.add_argument("-r", "--repeat", action="store", default=1, type=int,
+                        help='Number of times each query is recognized.')
+    parser.add_argument("-o", "--output", action="store", default=None,
+                        help='File the JSON results are written to, the standard output if not given.')
+    args = parser.parse_args()
+
+    benchmark_args = ['--songs', str(args.songs), '--seconds', str(args.seconds), '--query-seconds',
+                      str(args.query_seconds), '--snr', str(args.snr), '--seed', str(args.seed),
+                      '--repeat', str(args.repeat)]
+    if args.config:
+        benchmark_args += ['--config', args.config]
+    if args.files:
+        benchmark_args += ['--files', *args.files]
+
+    main(args.param, args.target, benchmark_args, args.output)
@@ -0,0 +1,84 @@
+import argparse
+import json
+import sys
+
+import numpy as np
+
+from dejavu import Dejavu
+from dejavu.config.settings import (QUERY_TIME, ALIGN_TIME, RESULTS, SONG_NAME,
+                                    TWO_STAGE_CANDIDATES, TWO_STAGE_SAMPLE_RATE)
+from dejavu.logic.decoder import find_files, get_audio_name_from_path
+from dejavu.logic.recognizer.file_recognizer import FileRecognizer
+
+DEFAULT_CONFIG_FILE = "dejavu.cnf.SAMPLE"
+
+
+def expected_song(file_path: str) -> str:
+    """
+    Test files are named XXXX_offset_length (see `generate_test_files`), XXXX may have underscores.
+    """
+    return "_".join(get_audio_name_from_path(file_path).split("_")[:-2])
+
+
+def top_song(result) -> str:
+    return result[RESULTS][0][SONG_NAME] if result[RESULTS] else None
+
+
+def summary(name, hits, agreements, latencies):
+    latencies = np.array(latencies) * 1000
+    print(f"{name}: recall {np.mean(hits) * 100:.1f}% | agreement with exhaustive {np.mean(agreements) * 100:.1f}% "
+          f"| query+align p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms")
+
+
+def main(config_file: str, src: str, extensions: list, sample_rate: float, candidates: int, output: str):
+    with open(config_file) as f:
+        config = json.load(f)
+
+    djv = Dejavu(config)
+    djv.two_stage_sample_rate = sample_rate
+    djv.two_stage_candidates = candidates
+
+    files = [file_path for file_path, _ in find_files(src, extensions)]
+    if not files:
+        print(f"No {extensions} files found in {src}")
+        sys.exit(1)
+
+    rows = []
+    for file_path in files:
+        row = {"file": file_path, "expected": expected_song(file_path)}
+        for mode, two_stage in (("exhaustive", False), ("two_stage", True)):
+            djv.two_stage = two_stage
+            result = djv.recognize(FileRecognizer, file_path)
+            row[mode] = {
+                "song": top_song(result),
+                "latency": result[QUERY_TIME] + result[ALIGN_TIME]
+            }
+        rows.append(row)
+
+    for mode in ("exhaustive", "two_stage"):
+        summary(mode,
+                [row[mode]["song"] == row["expected"] for row in rows],
+                [row[mode]["song"] == row["exhaustive"]["song"] for row in rows],
+                [row[mode]["latency"] for row in rows])
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two-stage matching against exhaustive matching, in '
+                                                 'recall and query latency, over a folder of test files as '
+                                                 'generated by run_tests.py (XXXX_offset_length.ext).')
+    parser.add_argument('-c', '--config', default=DEFAULT_CONFIG_FILE, help='Path to configuration file.')
+    parser.add_argument('-e', '--extensions', nargs='+', default=['mp3', 'wav'], help='Test file extensions.')
+    parser.add_argument('-sr', '--sample-rate', type=float, default=TWO_STAGE_SAMPLE_RATE,
+                        help='Fraction of the hashes looked up on the first stage.')
+    parser.add_argument('-k', '--candidates', type=int, default=TWO_STAGE_CANDIDATES,
+                        help='Number of candidate songs kept for the second stage.')
+    parser.add_argument('-o', '--output', default=None, help='Writes the per file results as JSON.')
+    parser.add_argument("src", type=str, help='Folder with the test files.')
+
+    args = parser.parse_args()
+
+    main(args.config, args.src, args.extensions, args.sample_rate, args.candidates, args.output)